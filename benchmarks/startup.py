@@ -0,0 +1,75 @@
+"""Cold start benchmark of the command-line interface.
+
+Runs light commands of yeelight-control.py in fresh interpreters and fails
+if they import heavy modules or take longer than the budget on top of the
+bare interpreter startup.
+
+Usage:
+    python benchmarks/startup.py --runs 10 --budget 150
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# commands which must not import yeelight, numpy or PIL
+COMMANDS = [
+    ['scene', 'list'],
+    ['preset', 'list'],
+    ['bulb', 'list'],
+]
+HEAVY = ('yeelight', 'numpy', 'PIL', 'cv2')
+
+def run(argv: list, cwd: str) -> float:
+    """Runs a command in a fresh interpreter, returns its wall time in seconds."""
+
+    start = time.perf_counter()
+    subprocess.run(argv, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def heavy_imports(argv: list, cwd: str) -> list:
+    """Returns heavy top level modules imported by a command."""
+
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + argv[1:], cwd=cwd, check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imported = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            imported.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return sorted(imported.intersection(HEAVY))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cold start of yeelight-control.py.')
+    parser.add_argument('--runs', type=int, default=10, help='runs of every command')
+    parser.add_argument('--budget', type=float, default=150, help='allowed milliseconds over the bare interpreter startup')
+    args = parser.parse_args()
+
+    failed = False
+    # run in a temporary directory, so the database and the log are thrown away
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline = statistics.median(run([sys.executable, '-c', 'pass'], tmp) for i in range(args.runs))
+        print('{0:<20}{1:>8.1f} ms'.format('python', baseline * 1000))
+
+        for command in COMMANDS:
+            argv = [sys.executable, os.path.join(ROOT, 'yeelight-control.py')] + command
+            heavy = heavy_imports(argv, tmp)
+            elapsed = statistics.median(run(argv, tmp) for i in range(args.runs))
+            over = (elapsed - baseline) * 1000
+            status = 'ok'
+            if heavy:
+                status = 'imports ' + ', '.join(heavy)
+            elif over > args.budget:
+                status = 'over budget'
+            failed = failed or status != 'ok'
+            print('{0:<20}{1:>8.1f} ms  +{2:.1f} ms  {3}'.format(' '.join(command), elapsed * 1000, over, status))
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
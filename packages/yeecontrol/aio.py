@@ -0,0 +1,640 @@
+"""Asyncio client of the Yeelight JSON-RPC line protocol.
+
+Several commands may be in flight on a single connection, responses are
+matched to requests by id. A single event loop thread can drive hundreds
+of bulbs.
+
+Usage:
+    client = Client()
+    report = await AsyncScene(scenes).set('evening', AsyncBulb(bulbs, client), presets)
+    await client.close()
+"""
+
+import asyncio
+import itertools
+import json
+import threading
+import time
+
+from . import parallel
+from .bulbs import BulbExc
+from .dispatch import TokenBucket
+from .presets import compile_preset
+from .state import PROPERTIES
+
+class AioExc(Exception):
+    """Generic exception for the asyncio client.
+    error holds the error reported by the bulb, None for connection failures.
+    """
+    def __init__(self, message, head="AioException", error: dict = None):
+        super().__init__(message)
+        self.head = head
+        self.message = message
+        self.error = error
+
+class Connection():
+    """A class to represent a single control connection to a bulb.
+
+    Methods:
+    --------
+    open(timeout)
+        Connects to the bulb.
+    stage(commands)
+        Serializes commands without sending them, returns the payload and futures of their results.
+    write(payload)
+        Sends a staged payload.
+    request(method, params)
+        Sends a command without waiting, returns a future of its result.
+    call(method, params, timeout)
+        Sends a command and waits for its result.
+    close()
+        Closes the connection and fails the pending commands.
+    """
+
+    def __init__(self, ip: str, port: int = 55443, on_props=None):
+        """
+        Parameters:
+        ----------
+        ip:
+            IP address of the bulb.
+        port:
+            Control port of the bulb.
+        on_props:
+            Callable taking the ip and a dict of changed properties, called on props notifications.
+        """
+
+        self.ip = ip
+        self.port = port
+        self.on_props = on_props
+        self.closed = True
+
+        self.__ids = itertools.count(1)
+        self.__pending = {} # command id -> Future
+        self.__writer = None
+        self.__task = None
+
+    async def open(self, timeout: float = 5.0):
+        """Connects to the bulb, raises AioExc on failure."""
+
+        try:
+            reader, self.__writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise AioExc('Cannot connect to bulb ' + self.ip) from e
+        self.closed = False
+        self.__task = asyncio.ensure_future(self.__read(reader))
+
+    async def __read(self, reader):
+        """Resolves pending commands with the responses of the bulb."""
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line.decode('utf8'))
+                except ValueError:
+                    continue
+                if message.get('method') == 'props':
+                    if self.on_props != None:
+                        self.on_props(self.ip, message.get('params', {}))
+                    continue
+                future = self.__pending.pop(message.get('id'), None)
+                if future == None or future.done():
+                    continue # answered after its caller gave up
+                if 'error' in message:
+                    future.set_exception(AioExc(str(message['error'].get('message')), error=message['error']))
+                else:
+                    future.set_result(message.get('result'))
+        except OSError:
+            pass
+        finally:
+            self.__fail('Connection to bulb ' + self.ip + ' closed')
+
+    def __fail(self, message: str):
+        """Marks the connection closed and fails the pending commands."""
+
+        self.closed = True
+        pending, self.__pending = self.__pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(AioExc(message))
+
+    def stage(self, commands: list) -> tuple:
+        """Serializes commands without sending them.
+        Returns the payload to be passed to write() and a list of futures resolved with the results.
+        """
+
+        if self.closed:
+            raise AioExc('Connection to bulb ' + self.ip + ' closed')
+        loop = asyncio.get_running_loop()
+        lines = []
+        futures = []
+        for method, params in commands:
+            cmd_id = next(self.__ids)
+            future = loop.create_future()
+            self.__pending[cmd_id] = future
+            futures.append(future)
+            lines.append(json.dumps({'id': cmd_id, 'method': method, 'params': list(params)}) + '\r\n')
+        return ''.join(lines).encode('utf8'), futures
+
+    def write(self, payload: bytes):
+        """Sends a payload returned by stage()."""
+
+        self.__writer.write(payload)
+
+    def request(self, method: str, params: list) -> asyncio.Future:
+        """Writes a command and returns a future resolved with its result list.
+        Commands are written in the order of the calls.
+        """
+
+        payload, futures = self.stage([(method, params)])
+        self.write(payload)
+        return futures[0]
+
+    async def call(self, method: str, params: list, timeout: float = 5.0) -> list:
+        """Sends a command and returns its result list.
+        Raises AioExc if the bulb reports an error or the connection fails,
+        asyncio.TimeoutError if the bulb does not respond in time.
+        """
+
+        return await asyncio.wait_for(self.request(method, params), timeout)
+
+    def close(self):
+        """Closes the connection and fails the pending commands."""
+
+        if self.__writer != None:
+            self.__writer.close()
+        if self.__task != None:
+            self.__task.cancel()
+        self.__fail('Connection to bulb ' + self.ip + ' closed')
+
+class Client():
+    """A class to represent asyncio connections to many bulbs, one per bulb ip.
+    Commands to each bulb are limited to the bulb quota, like the Dispatcher does.
+
+    Methods:
+    --------
+    call(ip, method, params)
+        Sends a command to a bulb and returns its result.
+    send(ip, commands)
+        Sends a list of commands to a bulb at once.
+    send_synchronized(targets, deadline)
+        Sends commands to many bulbs at the same instant.
+    close()
+        Closes all connections.
+    """
+
+    def __init__(self, port: int = 55443, timeout: float = 5.0, quota: int = 60, period: float = 60.0,
+                 burst: int = 20, on_props=None, health=None, metrics=None, journal=None, dispatcher=None):
+        """
+        Parameters:
+        ----------
+        port:
+            Control port of the bulbs.
+        timeout:
+            Time in seconds to wait for a connection or a response.
+        quota:
+            Number of commands a bulb accepts per period.
+        period:
+            Length of the quota period in seconds.
+        burst:
+            Number of commands which may be sent at once before rate limiting applies.
+        on_props:
+            Callable taking an ip and a dict of changed properties, called on props notifications.
+        health:
+            HealthMonitor object recording the outcome of the commands.
+        metrics:
+            Metrics object recording the latency and the outcome of the commands.
+        journal:
+            Journal object recording every command and response.
+        dispatcher:
+            Dispatcher whose quota the commands are taken from, so they share it with the commands
+            sent through the pool. The client keeps its own quota if not given.
+        """
+
+        self.port = port
+        self.timeout = timeout
+        self.quota = quota
+        self.period = period
+        self.burst = burst
+        self.on_props = on_props
+        self.health = health
+        self.metrics = metrics
+        self.journal = journal
+        self.dispatcher = dispatcher
+
+        self.__connections = {} # ip -> Connection
+        self.__locks = {} # ip -> Lock guarding connecting
+        self.__buckets = {} # ip -> TokenBucket
+
+    async def __connection(self, ip: str) -> tuple:
+        """Returns an open connection to the bulb and whether it was reused."""
+
+        lock = self.__locks.setdefault(ip, asyncio.Lock())
+        async with lock:
+            connection = self.__connections.get(ip)
+            if connection != None and not connection.closed:
+                return connection, True
+            connection = Connection(ip, self.port, self.on_props)
+            if self.metrics != None:
+                self.metrics.inc('yeelight_connections_total', ip=ip)
+            await connection.open(self.timeout)
+            self.__connections[ip] = connection
+            return connection, False
+
+    def __token(self, ip: str) -> float:
+        """Takes a token of the bulb quota, returns 0 or the seconds until one is available."""
+
+        if self.dispatcher != None:
+            return self.dispatcher.take(ip)
+        bucket = self.__buckets.setdefault(ip, TokenBucket(self.quota / self.period, self.burst))
+        return bucket.take()
+
+    async def __take(self, ip: str, count: int, until: float = None) -> bool:
+        """Waits until the bulb quota allows sending count commands.
+        Returns False if that would take past until (time.monotonic()).
+        """
+
+        for i in range(count):
+            wait = self.__token(ip)
+            while wait > 0:
+                if until != None and time.monotonic() + wait > until:
+                    return False
+                await asyncio.sleep(wait)
+                wait = self.__token(ip)
+        return True
+
+    async def send(self, ip: str, commands: list) -> list:
+        """Sends commands to a bulb without waiting for each response and returns their results.
+        A reused connection may have been closed by the bulb in the meantime,
+        in such case the commands are sent again once on a fresh connection.
+        Errors reported by the bulb are not retried.
+
+        Parameters:
+        -----------
+        ip:
+            IP address of the bulb.
+        commands:
+            List of (method, params) tuples, as returned by compile_preset().
+        """
+
+        t0 = time.monotonic()
+        await self.__take(ip, len(commands))
+        try:
+            connection, reused = await self.__connection(ip)
+            try:
+                result = await self.__send(connection, commands)
+            except AioExc as e:
+                if e.error != None or not reused:
+                    raise
+                if self.metrics != None:
+                    self.metrics.inc('yeelight_reconnects_total', ip=ip)
+                connection, reused = await self.__connection(ip)
+                result = await self.__send(connection, commands)
+        except Exception as e:
+            self.__record(ip, e, 'send', time.monotonic() - t0)
+            raise
+        self.__record(ip, None, 'send', time.monotonic() - t0)
+        return result
+
+    def __record(self, ip: str, exc: Exception = None, command: str = 'send', latency: float = None):
+        if self.health != None:
+            self.health.record(ip, exc)
+        if self.metrics != None:
+            if latency != None:
+                self.metrics.observe('yeelight_command_seconds', latency, ip=ip, command=command)
+            self.metrics.inc('yeelight_commands_total', ip=ip, command=command,
+                             status=parallel.OK if exc == None else parallel.classify(exc))
+
+    async def __send(self, connection: Connection, commands: list) -> list:
+        sent = time.monotonic()
+        futures = [connection.request(method, params) for method, params in commands]
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*futures), self.timeout)
+        except asyncio.TimeoutError:
+            connection.close() # responses may still come, do not mix them with new commands
+            self.__journal(connection.ip, commands, futures, sent)
+            raise AioExc('Bulb ' + connection.ip + ' did not respond') from TimeoutError()
+        except AioExc as e:
+            if e.error == None:
+                connection.close()
+            self.__journal(connection.ip, commands, futures, sent)
+            raise
+        self.__journal(connection.ip, commands, futures, sent)
+        return results
+
+    def __journal(self, ip: str, commands: list, futures: list, sent: float, received: float = None):
+        """Records commands and the results or errors of their futures into the journal."""
+
+        if self.journal == None:
+            return
+        for (method, params), future in zip(commands, futures):
+            if not future.done() or future.cancelled():
+                self.journal.record(ip, method, params, sent, error=TimeoutError('No response'))
+            elif future.exception() != None:
+                self.journal.record(ip, method, params, sent, error=future.exception(), received=received)
+            else:
+                self.journal.record(ip, method, params, sent, future.result(), received=received)
+
+    async def send_synchronized(self, targets: dict, deadline: float = 5.0) -> dict:
+        """Sends commands to many bulbs at the same instant.
+        Connections and serialized payloads of all bulbs are staged first,
+        then all payloads are written at once from a single loop.
+
+        Parameters:
+        -----------
+        targets:
+            Dictionary of name -> (ip, commands).
+        deadline:
+            Overall time limit in seconds for staging and acknowledgements.
+
+        Returns a report as parallel.run_all() does. Latency of the sent bulbs is
+        measured from the moment the payloads were released, so the spread of the
+        latencies is the skew between the bulbs, see parallel.skew().
+        """
+
+        t0 = time.monotonic()
+        connected = await run_all({name: lambda ip=ip: self.__connection(ip) for name, (ip, commands) in targets.items()},
+                                  deadline)
+        report = {}
+        staged = {}
+        for name, result in connected.items():
+            if result['status'] != parallel.OK:
+                self.__record(targets[name][0], ConnectionError(result['error']), 'sync') # the bulb was not reached
+                report[name] = result
+                continue
+            ip, commands = targets[name]
+            if not await self.__take(ip, len(commands), t0 + deadline):
+                report[name] = {'status': parallel.TIMEOUT, 'latency': time.monotonic() - t0,
+                                'error': 'Bulb quota would be exceeded within the deadline'}
+                continue
+            connection = result['value'][0]
+            staged[name] = (connection,) + connection.stage(commands)
+
+        # barrier: nothing is sent until every bulb is staged
+        released = time.monotonic()
+        for connection, payload, futures in staged.values():
+            connection.write(payload)
+
+        acked = {}
+
+        async def ack(name, futures):
+            try:
+                return await asyncio.gather(*futures)
+            finally:
+                acked[name] = time.monotonic()
+
+        acks = {name: asyncio.ensure_future(ack(name, futures)) for name, (connection, payload, futures) in staged.items()}
+        if acks:
+            await asyncio.wait(acks.values(), timeout=max(0.0, deadline - (released - t0)))
+        for name, future in acks.items():
+            ip = targets[name][0]
+            self.__journal(ip, targets[name][1], staged[name][2], released, acked.get(name))
+            if not future.done():
+                future.cancel()
+                staged[name][0].close() # late responses must not be mixed with new commands
+                report[name] = {'status': parallel.TIMEOUT, 'latency': time.monotonic() - released, 'error': 'Deadline exceeded'}
+                self.__record(ip, TimeoutError(), 'sync', report[name]['latency'])
+            elif future.exception() != None:
+                self.__record(ip, future.exception(), 'sync', acked[name] - released)
+                report[name] = {'status': parallel.classify(future.exception()), 'latency': acked[name] - released,
+                                'error': str(future.exception())}
+            else:
+                self.__record(ip, None, 'sync', acked[name] - released)
+                report[name] = {'status': parallel.OK, 'latency': acked[name] - released, 'value': future.result()}
+        return report
+
+    async def call(self, ip: str, method: str, params: list) -> list:
+        """Sends a command to a bulb and returns its result list."""
+
+        return (await self.send(ip, [(method, params)]))[0]
+
+    async def close(self):
+        """Closes all connections."""
+
+        for connection in self.__connections.values():
+            connection.close()
+        self.__connections.clear()
+        await asyncio.sleep(0) # let the readers finish
+
+async def run_all(tasks: dict, deadline: float = 5.0) -> dict:
+    """Runs all coroutines at once and waits for them under a single deadline.
+    The asyncio counterpart of parallel.run_all().
+
+    Parameters:
+    -----------
+    tasks: dict
+        Dictionary of task name -> callable taking no arguments and returning a coroutine.
+    deadline: float
+        Overall time limit in seconds for all of the tasks.
+
+    Returns a dictionary of task name -> result, see parallel.run_all().
+    """
+
+    report = {}
+    if len(tasks) == 0:
+        return report
+
+    finished = {}
+
+    async def timed(name, task):
+        try:
+            return await task()
+        finally:
+            finished[name] = time.monotonic()
+
+    t0 = time.monotonic()
+    futures = {name: asyncio.ensure_future(timed(name, task)) for name, task in tasks.items()}
+    await asyncio.wait(futures.values(), timeout=deadline)
+
+    for name, future in futures.items():
+        if not future.done():
+            future.cancel()
+            report[name] = {'status': parallel.TIMEOUT, 'latency': time.monotonic() - t0, 'error': 'Deadline exceeded'}
+            continue
+        latency = finished[name] - t0
+        exc = future.exception()
+        if exc is None:
+            report[name] = {'status': parallel.OK, 'latency': latency, 'value': future.result()}
+        else:
+            report[name] = {'status': parallel.classify(exc), 'latency': latency, 'error': str(exc)}
+
+    return report
+
+class AsyncBulb():
+    """Asyncio counterpart of the Bulb class.
+    Bulb names are resolved through the registry of a Bulb object, so it must be
+    used from the thread owning the database connection.
+
+    Methods:
+    --------
+    probe(ip)
+        Reads the state of a bulb at a given ip.
+    status_all(deadline)
+        Returns a status snapshot of all bulbs.
+    set(name, preset)
+        Sets named bulb to a selected state.
+    send(ip, commands)
+        Sends compiled preset commands to a bulb at a given ip.
+    """
+
+    def __init__(self, bulbs, client: Client = None):
+        """
+        Parameters:
+        ----------
+        bulbs:
+            Bulb object holding the saved bulbs.
+        client:
+            Client object used to talk to the bulbs. A new client taking the quota of the dispatcher
+            and recording into the health monitor, the metrics and the journal of bulbs is created if not given.
+        """
+
+        self.bulbs = bulbs
+        self.client = client if client != None else Client(quota=bulbs.dispatcher.quota, health=bulbs.health,
+                                                           metrics=bulbs.metrics, journal=bulbs.journal,
+                                                           dispatcher=bulbs.dispatcher)
+
+    async def probe(self, ip: str) -> dict:
+        """Reads the state of a bulb at a given ip, see Bulb.probe()."""
+
+        t0 = time.monotonic()
+        result = await self.client.call(ip, 'get_prop', PROPERTIES)
+        rtt = time.monotonic() - t0
+        power, bright, ct, rgb, color_mode, hue, sat, flowing = [value if value != '' else None for value in result]
+
+        if rgb != None:
+            rgb = int(rgb)
+            rgb = (rgb >> 16 & 0xff, rgb >> 8 & 0xff, rgb & 0xff)
+
+        return {
+            'power': power,
+            'brightness': None if bright == None else int(bright),
+            'ct': None if ct == None else int(ct),
+            'rgb': rgb,
+            'color_mode': None if color_mode == None else int(color_mode),
+            'hue': None if hue == None else int(hue),
+            'sat': None if sat == None else int(sat),
+            'flowing': None if flowing == None else int(flowing),
+            'rtt': rtt
+        }
+
+    async def status_all(self, deadline: float = 3.0) -> dict:
+        """Probes all saved bulbs at once, see Bulb.status_all()."""
+
+        bulbs = self.bulbs.registry.items()
+        report = await run_all({name: lambda ip=ip: self.probe(ip) for name, ip in bulbs}, deadline)
+
+        snapshot = {}
+        for name, ip in bulbs:
+            result = report.get(name)
+            if result['status'] == parallel.OK:
+                state = result['value']
+                state.update({'ip': ip, 'reachable': True})
+            else:
+                state = {'ip': ip, 'power': None, 'brightness': None, 'ct': None, 'rgb': None,
+                         'reachable': False, 'rtt': None}
+            snapshot[name] = state
+        return snapshot
+
+    async def set(self, name: str, preset: dict):
+        """Sets a bulb to a defined state, see Bulb.set()."""
+
+        ip = self.bulbs.find_by_name(name)
+        if ip == None:
+            raise BulbExc(self.bulbs.missing(name))
+        commands = preset.get('commands')
+        await self.send(ip, commands if commands != None else compile_preset(preset))
+
+    async def send(self, ip: str, commands: list):
+        """Sends compiled commands to a bulb at a given ip, see Bulb.send()."""
+
+        if not self.bulbs.health.allow(ip):
+            self.bulbs.metrics.inc('yeelight_commands_total', ip=ip, command='send', status='offline')
+            raise BulbExc('Bulb is offline: ' + ip)
+        try:
+            await self.client.send(ip, commands)
+        finally:
+            # the bulb state is known to have changed
+            self.bulbs.invalidate(ip)
+
+class AsyncScene():
+    """Asyncio counterpart of the Scene class, sets scenes of a Scene object.
+
+    Methods:
+    --------
+    set(name, bulbs, presets, deadline)
+        Sets bulbs to a named scene, returns a per-bulb report.
+    """
+
+    def __init__(self, scenes):
+        """
+        Parameters:
+        ----------
+        scenes:
+            Scene object holding the saved scenes and their compiled plans.
+        """
+
+        self.scenes = scenes
+
+    async def set(self, name: str, bulbs: AsyncBulb, presets, deadline: float = 5.0) -> dict:
+        """Sets bulbs to a named scene, see Scene.set().
+
+        Parameters:
+        -----------
+        name
+            Name of the scene to set.
+        bulbs
+            AsyncBulb class object.
+        presets
+            Preset class object.
+        deadline
+            Time limit in seconds for setting all of the bulbs.
+        """
+
+        targets, report = self.scenes.targets(name, bulbs.bulbs, presets)
+        tasks = {bulb: lambda ip=ip, commands=commands: bulbs.send(ip, commands) for bulb, ip, commands in targets}
+        report.update(await run_all(tasks, deadline))
+        return report
+
+class Synchronizer():
+    """A class to represent a long-lived Client driven by its own event loop thread,
+    so synchronous code can send synchronized scenes over connections kept open between calls.
+
+    Methods:
+    --------
+    send_synchronized(targets, deadline)
+        Sends commands to many bulbs at the same instant.
+    close()
+        Closes the connections and stops the event loop.
+    """
+
+    def __init__(self, port: int = 55443, timeout: float = 5.0, quota: int = 60, dispatcher=None, health=None,
+                 metrics=None, journal=None):
+        """
+        Parameters:
+        ----------
+        See Client.
+        """
+
+        self.client = Client(port, timeout, quota, health=health, metrics=metrics, journal=journal, dispatcher=dispatcher)
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, daemon=True)
+        self.__thread.start()
+
+    def send_synchronized(self, targets: dict, deadline: float = 5.0) -> dict:
+        """Sends commands to many bulbs at the same instant.
+        See Client.send_synchronized() for the parameters and the report.
+        """
+
+        return asyncio.run_coroutine_threadsafe(self.client.send_synchronized(targets, deadline), self.__loop).result()
+
+    def close(self):
+        """Closes the connections and stops the event loop."""
+
+        if self.__thread != None:
+            asyncio.run_coroutine_threadsafe(self.client.close(), self.__loop).result()
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join()
+            self.__loop.close()
+            self.__thread = None
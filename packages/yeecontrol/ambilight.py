@@ -0,0 +1,345 @@
+import collections
+import threading
+import time
+
+import numpy
+
+class DropQueue():
+    """A bounded queue which drops the oldest item when full.
+    Used between ambient light stages so a slow stage always gets the newest frame.
+    """
+
+    def __init__(self, size: int = 1):
+        self.__items = collections.deque(maxlen=size)
+        self.__ready = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        """Adds an item, drops the oldest one if the queue is full."""
+
+        with self.__ready:
+            if len(self.__items) == self.__items.maxlen:
+                self.dropped += 1
+            self.__items.append(item)
+            self.__ready.notify()
+
+    def get(self, timeout: float = None):
+        """Returns the oldest item or None if the queue stays empty for timeout seconds."""
+
+        with self.__ready:
+            if not self.__items:
+                self.__ready.wait(timeout)
+            if not self.__items:
+                return None
+            return self.__items.popleft()
+
+def grab():
+    """Returns a screenshot as a PIL image."""
+
+    from PIL import ImageGrab
+    return ImageGrab.grab()
+
+def _downscale(frame, step: int):
+    """Returns every step-th pixel of a frame in both directions.
+    PIL images are resized before the conversion to an array, so only the kept pixels are copied.
+    """
+
+    if step <= 1:
+        return frame
+    if isinstance(frame, numpy.ndarray):
+        return frame[::step, ::step]
+    from PIL import Image
+
+    width, height = frame.size
+    return frame.resize((-(-width // step), -(-height // step)), Image.NEAREST)
+
+def zone_colors(pixels, regions: list) -> list:
+    """Returns (r, g, b, brightness) of every region of an RGB(A) pixel array,
+    using the RMS of every channel. Brightness is in the 1-100 range accepted by the bulbs.
+
+    All regions are reduced in one pass: squared pixels are summed into a
+    summed-area table, then each region's sum is read from its four corners.
+
+    Parameters:
+    -----------
+    pixels:
+        Array of shape (height, width, channels).
+    regions:
+        List of (left, top, right, bottom) screen fractions.
+    """
+
+    height, width = pixels.shape[:2]
+    rgb = pixels[..., :3].astype(numpy.float64) # squares of large regions overflow float32 precision
+    table = numpy.zeros((height + 1, width + 1, 3), dtype=numpy.float64)
+    table[1:, 1:] = (rgb * rgb).cumsum(axis=0).cumsum(axis=1)
+
+    bounds = numpy.array(regions, dtype=numpy.float64).reshape(-1, 4)
+    x0 = numpy.floor(bounds[:, 0] * width).astype(int)
+    y0 = numpy.floor(bounds[:, 1] * height).astype(int)
+    x1 = numpy.maximum(numpy.ceil(bounds[:, 2] * width).astype(int), x0 + 1).clip(max=width)
+    y1 = numpy.maximum(numpy.ceil(bounds[:, 3] * height).astype(int), y0 + 1).clip(max=height)
+
+    sums = table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+    counts = ((x1 - x0) * (y1 - y0)).reshape(-1, 1)
+    rms = numpy.sqrt(numpy.maximum(sums, 0) / counts)
+
+    colors = []
+    for r, g, b in rms:
+        colors.append((int(round(r)), int(round(g)), int(round(b)), max(1, int(round((r + g + b) / 3 * 100 / 255)))))
+    return colors
+
+def rgb_to_lab(r: float, g: float, b: float) -> tuple:
+    """Converts an sRGB color (0-255) to CIE L*a*b* (D65)."""
+
+    def linear(c):
+        c = c / 255
+        return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+
+    r, g, b = linear(r), linear(g), linear(b)
+    x = (0.4124 * r + 0.3576 * g + 0.1805 * b) / 0.95047
+    y = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    z = (0.0193 * r + 0.1192 * g + 0.9505 * b) / 1.08883
+
+    def f(t):
+        return t ** (1 / 3) if t > 0.008856 else 7.787 * t + 16 / 116
+
+    fx, fy, fz = f(x), f(y), f(z)
+    return 116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz)
+
+class ColorFilter():
+    """A class to represent a per-zone filter of streamed colors.
+    Colors are smoothed with an exponential moving average, and a color is
+    only passed on if it differs visibly from the last one passed.
+
+    Methods:
+    --------
+    apply(name, color)
+        Returns the color to send or None to skip it.
+    """
+
+    def __init__(self, threshold: float = 3.0, brightness_threshold: int = 2, smoothing: float = 0.5):
+        """
+        Parameters:
+        ----------
+        threshold:
+            Minimum color difference (CIE76 delta E) to send an update.
+            A delta E of about 2.3 is just noticeable.
+        brightness_threshold:
+            Minimum brightness difference (1-100 scale) to send an update.
+        smoothing:
+            Weight of the previous color in the moving average, 0 disables smoothing.
+        """
+
+        self.threshold = threshold
+        self.brightness_threshold = brightness_threshold
+        self.smoothing = smoothing
+        self.passed = 0
+        self.skipped = 0
+        self.__average = {} # zone -> smoothed (r, g, b, brightness)
+        self.__last = {} # zone -> (lab, brightness) of the last color passed
+
+    def apply(self, name: str, color: tuple) -> tuple:
+        """Returns the smoothed color if it should be sent, None otherwise.
+
+        Parameters:
+        -----------
+        name:
+            Name of the zone.
+        color:
+            (r, g, b, brightness) tuple.
+        """
+
+        average = self.__average.get(name)
+        if average != None:
+            color = tuple(a * self.smoothing + c * (1 - self.smoothing) for a, c in zip(average, color))
+        self.__average[name] = color
+
+        r, g, b, br = color
+        lab = rgb_to_lab(r, g, b)
+        last = self.__last.get(name)
+        if last != None:
+            delta = sum((p - q) ** 2 for p, q in zip(lab, last[0])) ** 0.5
+            if delta < self.threshold and abs(br - last[1]) < self.brightness_threshold:
+                self.skipped += 1
+                return None
+
+        self.__last[name] = (lab, br)
+        self.passed += 1
+        return int(round(r)), int(round(g)), int(round(b)), max(1, int(round(br)))
+
+class Ambilight():
+    """A class to represent the ambient lighting engine.
+    Capture, color and send stages run in separate threads connected by
+    single-item queues, so each stage works on the newest available frame.
+    Every frame yields one color per zone. Each zone has its own sender
+    thread with a single-item queue, so a slow bulb only coalesces its own
+    pending updates to the newest one.
+
+    Methods:
+    --------
+    start()
+        Starts the engine threads.
+    stop()
+        Stops the engine threads.
+    stats()
+        Returns frame counters and stage timings.
+    """
+
+    def __init__(self, send, zones: dict = None, capture=grab, fps: float = 10, step: int = 8,
+                 min_step: int = 1, max_step: int = 64, color_filter: ColorFilter = None, metrics=None):
+        """
+        Parameters:
+        ----------
+        send:
+            Callable taking a zone name and an (r, g, b, brightness) tuple.
+            Called concurrently for different zones.
+        zones:
+            Dictionary of zone name -> (left, top, right, bottom) screen fractions.
+            Defaults to a single full screen zone named 'full'.
+        capture:
+            Callable returning a frame as a PIL image or an array.
+        fps:
+            Target frame rate.
+        step:
+            Initial downsampling step, every step-th pixel in both directions is used.
+            Adjusted at run time to keep the color stage within the frame budget.
+        color_filter:
+            ColorFilter skipping updates which are not visible. No filtering if not given.
+        metrics:
+            Metrics object recording the stage times and errors.
+        """
+
+        self.send = send
+        self.zones = zones if zones != None else {'full': (0.0, 0.0, 1.0, 1.0)}
+        self.capture = capture
+        self.fps = fps
+        self.step = step
+        self.min_step = min_step
+        self.max_step = max_step
+        self.color_filter = color_filter
+        self.metrics = metrics
+
+        self.__frames = DropQueue()
+        self.__colors = DropQueue()
+        self.__running = threading.Event()
+        self.__threads = []
+        self.__lock = threading.Lock()
+        self.__counters = collections.Counter()
+        self.__timings = {} # stage -> average time in seconds
+        self.__colors_sent = {}
+        self.__pending = {} # zone -> DropQueue of colors waiting to be sent
+
+    def __timed(self, stage: str, seconds: float):
+        """Updates the moving average of a stage time."""
+
+        with self.__lock:
+            last = self.__timings.get(stage)
+            self.__timings[stage] = seconds if last == None else last * 0.9 + seconds * 0.1
+            self.__counters[stage] += 1
+        if self.metrics != None:
+            self.metrics.observe('yeelight_ambilight_stage_seconds', seconds, stage=stage)
+
+    def __failed(self, stage: str):
+        """Counts a failed stage."""
+
+        with self.__lock:
+            self.__counters[stage + '_errors'] += 1
+        if self.metrics != None:
+            self.metrics.inc('yeelight_ambilight_errors_total', stage=stage)
+
+    def __capture_loop(self):
+        while self.__running.is_set():
+            t0 = time.monotonic()
+            try:
+                frame = self.capture()
+            except Exception:
+                self.__failed('capture')
+            else:
+                self.__frames.put(frame)
+                self.__timed('capture', time.monotonic() - t0)
+            # sleeping the rest of the frame budget
+            left = 1 / self.fps - (time.monotonic() - t0)
+            if left > 0:
+                time.sleep(left)
+
+    def __color_loop(self):
+        while self.__running.is_set():
+            frame = self.__frames.get(0.5)
+            if frame is None:
+                continue
+            t0 = time.monotonic()
+            pixels = numpy.asarray(_downscale(frame, self.step))
+            colors = dict(zip(self.zones.keys(), zone_colors(pixels, list(self.zones.values()))))
+            elapsed = time.monotonic() - t0
+            self.__timed('color', elapsed)
+            self.__adapt(elapsed)
+            self.__colors.put(colors)
+
+    def __adapt(self, elapsed: float):
+        """Adjusts the downsampling step so the color stage fits in a quarter of the frame budget."""
+
+        budget = 1 / self.fps
+        if elapsed > budget / 4 and self.step < self.max_step:
+            self.step *= 2
+        elif elapsed < budget / 32 and self.step > self.min_step:
+            self.step //= 2
+
+    def __filter_loop(self):
+        while self.__running.is_set():
+            colors = self.__colors.get(0.5)
+            if colors is None:
+                continue
+            for name, color in colors.items():
+                if self.color_filter != None:
+                    color = self.color_filter.apply(name, color)
+                if color != None:
+                    self.__pending[name].put(color)
+
+    def __send_loop(self, name: str):
+        pending = self.__pending[name]
+        while self.__running.is_set():
+            color = pending.get(0.5)
+            if color is None:
+                continue
+            t0 = time.monotonic()
+            try:
+                self.send(name, color)
+            except Exception:
+                self.__failed('send')
+            else:
+                self.__colors_sent[name] = color
+            self.__timed('send', time.monotonic() - t0)
+
+    def start(self):
+        """Starts the engine threads."""
+
+        self.__running.set()
+        self.__pending = {name: DropQueue() for name in self.zones.keys()}
+        loops = [(self.__capture_loop, ()), (self.__color_loop, ()), (self.__filter_loop, ())]
+        loops += [(self.__send_loop, (name,)) for name in self.zones.keys()]
+        for loop, args in loops:
+            thread = threading.Thread(target=loop, args=args, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self):
+        """Stops the engine threads and waits for them to finish."""
+
+        self.__running.clear()
+        for thread in self.__threads:
+            thread.join()
+        self.__threads.clear()
+
+    def stats(self) -> dict:
+        """Returns frame counters, dropped frames, stage times in ms, commands saved and the last colors sent."""
+
+        with self.__lock:
+            stats = dict(self.__counters)
+            stats.update({stage + '_ms': seconds * 1000 for stage, seconds in self.__timings.items()})
+        stats['dropped'] = self.__frames.dropped + self.__colors.dropped
+        stats['coalesced'] = sum(pending.dropped for pending in self.__pending.values())
+        stats['skipped'] = self.color_filter.skipped if self.color_filter != None else 0
+        stats['saved'] = stats['coalesced'] + stats['skipped']
+        stats['step'] = self.step
+        stats['colors'] = dict(self.__colors_sent)
+        return stats
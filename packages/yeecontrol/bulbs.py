@@ -1,5 +1,13 @@
-import yeelight
-import yeelight.transitions as yeensitions
+import time
+
+from . import parallel
+from .dispatch import Dispatcher
+from .health import OPEN, HealthMonitor
+from .metrics import Metrics
+from .pool import BulbPool
+from .presets import compile_preset
+from .registry import Registry
+from .state import OFFLINE, ONLINE, PROPERTIES, STALE, StateCache, StateTracker
 
 class BulbExc(Exception): 
     """Generic exception for Bulb class."""
@@ -17,8 +25,16 @@ class Bulb():
         Returns name of the bulb
     find_by_name(name)
         Returns ip of the bulb
+    missing(name)
+        Returns why a bulb has no ip
     list()
         Returns a list of bulbs names.
+    state(name, max_age)
+        Returns a cached or freshly probed state of the bulb.
+    known_states(ips, max_age, deadline)
+        Returns the last known states of bulbs, probing the unknown ones at once.
+    status_all(deadline)
+        Returns a status snapshot of all bulbs.
     print_list()
         Prints a formatted list of bulbs.
     add()
@@ -27,9 +43,20 @@ class Bulb():
         Remove a bulb from the database.
     set(name, preset)
         Sets named bulb to a selected state 
+    apply(ip, preset)
+        Sets a bulb at a given ip to a selected state
+    send(ip, commands)
+        Sends compiled preset commands to a bulb at a given ip
+    record(ip, command, t0, exc)
+        Records the outcome of a command in the health monitor and the metrics
+    invalidate(ip)
+        Drops the cached state of a bulb
+    close_synchronizer()
+        Closes the connections used by synchronized scenes
     """
 
-    def __init__(self, conn, cursor):
+    def __init__(self, conn, cursor, pool: BulbPool = None, dispatcher: Dispatcher = None, tracker: StateTracker = None,
+                 health: HealthMonitor = None, metrics: Metrics = None, journal=None):
         """
         Parameters:
         ----------
@@ -37,21 +64,105 @@ class Bulb():
             Connection object for SQLite connection.
         cursor:
             Cursor object for SQLite connection.
+        pool:
+            BulbPool object used to talk to the bulbs. A new pool is created if not given.
+        dispatcher:
+            Dispatcher object queuing commands within the bulb quota.
+            A new dispatcher using the pool is created if not given.
+        tracker:
+            StateTracker object listening to state notifications of the saved bulbs.
+            States are polled if not given.
+        health:
+            HealthMonitor object skipping bulbs which failed repeatedly.
+            A new monitor is created if not given.
+        metrics:
+            Metrics object recording the latency and the outcome of every command.
+            New metrics are created if not given.
+        journal:
+            Journal object recording every command and response, see journal.py. Nothing is recorded if not given.
         """
 
         self.__cursor = cursor
         self.__conn = conn
-        # create db table if not exists
-        self.__cursor.execute('''CREATE TABLE IF NOT EXISTS bulbs (
-                    name TEXT PRIMARY KEY,
-                    ip TEXT NOT NULL
-                    );''')
-
-    # Setting up bulb indication pattern.
-    __flash = yeelight.Flow(
-        count = 100,
-        transitions = yeensitions.alarm()
-    )
+        self.__registry = Registry(conn, cursor)
+        self.__metrics = metrics if metrics != None else Metrics()
+        self.__journal = journal
+        self.__pool = pool if pool != None else BulbPool(metrics=self.__metrics)
+        self.__dispatcher = dispatcher if dispatcher != None else Dispatcher(self.__pool)
+        self.__states = StateCache()
+        self.__health = health if health != None else HealthMonitor()
+        self.__tracker = tracker
+        self.__tracked = False # True when the tracker follows the saved bulbs
+        self.__synchronizer = None # created on the first synchronized scene
+        if self.__tracker != None:
+            # registry changes may come from other threads, the tracker is synced on the next read
+            self.__registry.subscribe(self.__untrack)
+            self.__track()
+
+    @property
+    def pool(self) -> BulbPool:
+        """BulbPool object used to talk to the bulbs."""
+        return self.__pool
+
+    @property
+    def registry(self) -> Registry:
+        """Registry object holding the saved bulbs."""
+        return self.__registry
+
+    @property
+    def dispatcher(self) -> Dispatcher:
+        """Dispatcher object queuing commands sent to the bulbs."""
+        return self.__dispatcher
+
+    @property
+    def health(self) -> HealthMonitor:
+        """HealthMonitor object holding circuit breakers of the bulbs."""
+        return self.__health
+
+    @property
+    def metrics(self) -> Metrics:
+        """Metrics object recording the commands sent to the bulbs."""
+        return self.__metrics
+
+    @property
+    def journal(self):
+        """Journal object recording the commands or None."""
+        return self.__journal
+
+    @property
+    def synchronizer(self):
+        """aio.Synchronizer sending synchronized scenes, kept for the life of the object
+        so its connections are reused and its commands take the quota of the dispatcher.
+        """
+        if self.__synchronizer == None:
+            from .aio import Synchronizer # asyncio is imported only when needed
+
+            self.__synchronizer = Synchronizer(quota=self.__dispatcher.quota, dispatcher=self.__dispatcher,
+                                               health=self.__health, metrics=self.__metrics, journal=self.__journal)
+        return self.__synchronizer
+
+    def close_synchronizer(self):
+        """Closes the connections of the synchronizer if it was used."""
+
+        if self.__synchronizer != None:
+            self.__synchronizer.close()
+            self.__synchronizer = None
+
+    @property
+    def tracker(self) -> StateTracker:
+        """StateTracker object following the saved bulbs or None."""
+        if self.__tracker != None and not self.__tracked:
+            self.__track()
+        return self.__tracker
+
+    def __untrack(self, name: str):
+        self.__tracked = False
+
+    def __track(self):
+        """Makes the tracker follow the saved bulbs."""
+
+        self.__tracked = True
+        self.__tracker.sync(ip for name, ip in self.__registry.items())
 
     def find_by_ip(self, ip: str) -> str:
         """
@@ -59,15 +170,7 @@ class Bulb():
         Returns None if bulb is not found.
         """
 
-        found = False
-        
-        for bulb in self.__cursor.execute('SELECT name, ip FROM bulbs;'):
-            if bulb[1] == ip:
-                found = True
-                return bulb[0]
-
-        if not found:
-            return None
+        return self.__registry.name(ip)
 
     def find_by_name(self, name: str) -> str:
         """
@@ -75,61 +178,248 @@ class Bulb():
         Returns None if bulb is not found.
         """
 
-        found = False
-        
-        for bulb in self.__cursor.execute('SELECT name, ip FROM bulbs;'):
-            if bulb[0] == name:
-                found = True
-                return bulb[1]
+        return self.__registry.ip(name)
 
-        if not found:
-            return None
+    def missing(self, name: str) -> str:
+        """Returns the reason why a bulb without an ip cannot be reached."""
+
+        if name in self.__registry.parked():
+            return 'Bulb is not found on the network: ' + name
+        return 'No bulb with such name: ' + name
 
-    def __status(self, name: str) -> str:
+    def state(self, name: str, max_age: float = None) -> dict:
+        """Returns the state of the light bulb.
+        Uses the tracked state of a bulb if there is a tracker, a cached state
+        if it is not older than max_age, probes the bulb otherwise.
+
+        Parameters:
+        -----------
+        name:
+            Name of the bulb.
+        max_age:
+            Maximum age of a cached state in seconds, defaults to the cache TTL.
+            Use 0 to always probe the bulb, even if it is tracked.
+
+        Returns a snapshot dict as described in status_all().
         """
-        Returns the status of the light bulb.
-        Returns None if bulb is not in the DB.
 
-        Status options:
-        ---------------
-        - on - online, on
-        - off - online, off
-        - unavailable - offline
+        ip = self.__registry.ip(name)
+        if ip == None:
+            raise BulbExc(self.missing(name))
+
+        if max_age != 0:
+            state = self.__tracked_state(ip)
+            if state != None:
+                return state
+        state = self.__states.get(ip, max_age)
+        if state != None:
+            return state
+        if not self.__health.allow(ip):
+            state = {'ip': ip, 'power': None, 'brightness': None, 'ct': None, 'rgb': None, 'rtt': None, 'reachable': False}
+            state.update(self.__health.state(ip))
+            return state
+        try:
+            state = self.probe(ip)
+        except Exception:
+            state = {'power': None, 'brightness': None, 'ct': None, 'rgb': None, 'rtt': None, 'reachable': False}
+        else:
+            state['reachable'] = True
+        state['ip'] = ip
+        self.__states.put(ip, state)
+        return state
+
+    def __tracked_state(self, ip: str) -> dict:
+        """Returns the tracked state of a bulb in the snapshot format or None.
+        Bulbs which were never reached are not reported, so they are probed instead.
         """
 
-        found = False
-        
-        for bulb in self.__cursor.execute('SELECT name, ip FROM bulbs;'):
-            if bulb[0] == name:
-                found = True
-                b = yeelight.Bulb(bulb[1])
-                try:
-                    return b.get_properties().get('power')
-                except:
-                    return 'unavailable'
-
-        if not found:
+        tracker = self.tracker
+        if tracker == None:
             return None
+        state = tracker.get(ip)
+        if state == None or state['updated'] == None and state['status'] != OFFLINE:
+            return None
+        del state['updated']
+        return state
+
+    def known_states(self, ips: list, max_age: float = None, deadline: float = 1.0) -> dict:
+        """Returns the last known states of bulbs at given ips.
+        A tracked state is used while its bulb is online, a cached state if it is not older
+        than max_age, the remaining bulbs are probed in parallel.
+
+        Parameters:
+        -----------
+        ips:
+            IP addresses of the bulbs.
+        max_age:
+            Maximum age of a cached state in seconds, defaults to the cache TTL.
+        deadline:
+            Time limit in seconds for probing the bulbs.
+
+        Returns a dictionary of ip -> state in the format of probe(),
+        None for bulbs which did not respond.
+        """
+
+        states = {}
+        unknown = []
+        for ip in ips:
+            state = self.tracker.get(ip) if self.tracker != None else None
+            # a stale state may have changed while the connection was down
+            if state != None and state['status'] == ONLINE and state['updated'] != None:
+                states[ip] = state
+                continue
+            state = self.__states.get(ip, max_age)
+            if state != None and state.get('reachable'):
+                states[ip] = state
+            else:
+                unknown.append(ip)
+
+        report = parallel.run_all({ip: lambda ip=ip: self.probe(ip) for ip in unknown}, deadline)
+        for ip, result in report.items():
+            states[ip] = None
+            if result['status'] == parallel.OK:
+                states[ip] = result['value']
+                states[ip].update({'ip': ip, 'reachable': True})
+                self.__states.put(ip, states[ip])
+        return states
 
     def list(self) -> list:
         """Returns the list of bulbs names."""
 
-        bulbs = []
-        for bulb in self.__cursor.execute('SELECT name FROM bulbs;'):
-            bulbs.append(bulb[0])
-        return bulbs
+        return self.__registry.names()
+
+    def probe(self, ip: str) -> dict:
+        """Reads the state of a bulb at a given ip.
+
+        Returns a dictionary with power, brightness, ct, rgb, color_mode, hue, sat, flowing and rtt (seconds).
+        Raises an exception if the bulb does not respond,
+        BulbExc at once if the bulb is offline according to its circuit breaker.
+        """
+
+        if not self.__health.allow(ip):
+            self.__metrics.inc('yeelight_commands_total', ip=ip, command='probe', status='offline')
+            raise BulbExc('Bulb is offline: ' + ip)
+        def get(b):
+            return self.__journaled(ip, 'get_prop', PROPERTIES, lambda: b.get_properties(PROPERTIES),
+                                    lambda props: [props.get(prop) or '' for prop in PROPERTIES])
+
+        t0 = time.monotonic()
+        try:
+            props = self.__dispatcher.run(ip, get)
+        except Exception as e:
+            self.record(ip, 'probe', t0, e)
+            raise
+        rtt = self.record(ip, 'probe', t0)
+
+        rgb = props.get('rgb')
+        if rgb != None:
+            rgb = int(rgb)
+            rgb = (rgb >> 16 & 0xff, rgb >> 8 & 0xff, rgb & 0xff)
+
+        return {
+            'power': props.get('power'),
+            'brightness': None if props.get('bright') == None else int(props.get('bright')),
+            'ct': None if props.get('ct') == None else int(props.get('ct')),
+            'rgb': rgb,
+            'color_mode': None if props.get('color_mode') in (None, '') else int(props.get('color_mode')),
+            'hue': None if props.get('hue') in (None, '') else int(props.get('hue')),
+            'sat': None if props.get('sat') in (None, '') else int(props.get('sat')),
+            'flowing': None if props.get('flowing') in (None, '') else int(props.get('flowing')),
+            'rtt': rtt
+        }
+
+    def status_all(self, deadline: float = 3.0) -> dict:
+        """Returns the status of all saved bulbs.
+        Tracked bulbs are read from the tracker, the rest is probed in parallel.
 
-    def print_list(self):
-        """Prints a formatted list of all saved bulbs."""
+        Parameters:
+        -----------
+        deadline:
+            Time limit in seconds for probing all of the bulbs.
+
+        Returns a dictionary of bulb name -> snapshot, where snapshot is a dict
+        with ip, power, brightness, ct, rgb, reachable and rtt keys.
+        Values which could not be read are None.
+        Tracked bulbs also have a status key: online, stale or offline.
+        Every snapshot has the circuit breaker state, see HealthMonitor.state().
+        Bulbs which went away and were not found again have an ip of None and are not probed.
+        """
+
+        bulbs = self.__registry.items()
+        tracked = {name: self.__tracked_state(ip) for name, ip in bulbs}
+        report = parallel.run_all({name: lambda ip=ip: self.probe(ip) for name, ip in bulbs if tracked[name] == None},
+                                  deadline)
+
+        snapshot = {}
+        for name, ip in bulbs:
+            if tracked[name] != None:
+                snapshot[name] = tracked[name]
+                continue
+            result = report.get(name)
+            if result['status'] == parallel.OK:
+                state = result['value']
+                state.update({'ip': ip, 'reachable': True})
+            else:
+                state = {'ip': ip, 'power': None, 'brightness': None, 'ct': None, 'rgb': None,
+                         'reachable': False, 'rtt': None}
+            self.__states.put(ip, state)
+            snapshot[name] = state
+        for name, ip in bulbs:
+            snapshot[name].update(self.__health.state(ip))
+        for name in self.__registry.parked():
+            snapshot[name] = {'ip': None, 'power': None, 'brightness': None, 'ct': None, 'rgb': None,
+                              'reachable': False, 'rtt': None}
+        return snapshot
+
+    def print_list(self, snapshot: dict = None):
+        """Prints a formatted list of all saved bulbs.
+
+        Parameters:
+        -----------
+        snapshot:
+            Status snapshot produced by status_all(). Probes the bulbs if not given.
+        """
 
         if len(self.list()) == 0:
-            raise BulbExc('No bulbs saved.')  
-        for bulb in self.__cursor.execute('SELECT name, ip FROM bulbs;'):
-            print('{0:<15}{1:<10}{2:<11}'.format(bulb[1], bulb[0], self.__status(bulb[0])))      
+            raise BulbExc('No bulbs saved.')
+        if snapshot == None:
+            snapshot = self.status_all()
+        for name, state in snapshot.items():
+            if state.get('breaker') == OPEN:
+                # skipped until the background prober reaches the bulb
+                status = 'offline'
+                details = 'failures: {0:<4}retry in: {1:.0f} s'.format(state['failures'], state['retry'])
+            elif state.get('status') == STALE and state['power'] != None:
+                # connection lost, show the last known state
+                status = state['power'] + '?'
+                details = 'bright: {0:<4}ct: {1:<6}rgb: {2:<16}(stale)'.format(
+                    str(state['brightness']), str(state['ct']), str(state['rgb']))
+            elif state['ip'] == None:
+                status = 'absent'
+                details = 'not found on the network'
+            elif not state['reachable']:
+                status = 'unavailable'
+                details = ''
+            else:
+                status = state['power']
+                rtt = '-' if state['rtt'] == None else '{0:.0f} ms'.format(state['rtt'] * 1000)
+                details = 'bright: {0:<4}ct: {1:<6}rgb: {2:<16}rtt: {3}'.format(
+                    str(state['brightness']), str(state['ct']), str(state['rgb']), rtt)
+            print('{0:<15}{1:<10}{2:<13}{3}'.format(state['ip'] or '-', name, status, details))
 
     def add(self):
         """Performs a process of searching for available bulbs"""
 
+        # yeelight is imported only when needed, it is slow to import
+        import yeelight
+        import yeelight.transitions as yeensitions
+
+        # Setting up bulb indication pattern.
+        flash = yeelight.Flow(
+            count = 100,
+            transitions = yeensitions.alarm()
+        )
+
         print('Searching for bulbs . . .')
         # getting bulbs list
         res = yeelight.discover_bulbs()
@@ -141,17 +431,14 @@ class Bulb():
         for bulb in res:
 
             # skip if the bulb is already in the DB
-            if self.find_by_ip(bulb.get('ip')) != None:
+            bulb_id = bulb.get('capabilities', {}).get('id')
+            if self.find_by_ip(bulb.get('ip')) != None or (bulb_id != None and self.__registry.find_by_id(bulb_id) != None):
                 continue
 
             new_bulbs += 1 # counting bulbs available and not in database
 
-            # assign temporary bulb object
-            b = yeelight.Bulb(bulb.get('ip'))
-
             # physical bulb indication
-            b.turn_on()
-            b.start_flow(self.__flash)
+            self.__dispatcher.run(bulb.get('ip'), lambda b: (b.turn_on(), b.start_flow(flash)))
 
             print('Bulb found at IP:', bulb.get('ip'))
 
@@ -160,15 +447,13 @@ class Bulb():
                 name = input("Enter bulb name (press Enter to skip): ")
                 if name == "":
                     break
-                elif self.find_by_name(name) == None:
-                    self.__cursor.execute('INSERT INTO bulbs (name, ip) VALUES (?,?)', (name, bulb.get('ip')))
-                    self.__conn.commit()
+                elif self.__registry.add(name, bulb.get('ip'), bulb_id):
                     print("Bulb", name, "has been added.")
                     break
                 else:
                     print("Bulb with this name already exists!")
             
-            b.stop_flow()
+            self.__dispatcher.run(bulb.get('ip'), lambda b: b.stop_flow())
 
         if new_bulbs == 0:
             raise BulbExc('No bulbs to add!')
@@ -183,11 +468,11 @@ class Bulb():
             Name of the bulb to be removed.
         """
 
-        if self.__status(name) == None:
+        ip = self.__registry.ip(name)
+        if not self.__registry.remove(name):
             raise BulbExc("No bulb with such name: " + name)
-        else:
-            self.__cursor.execute('DELETE FROM bulbs WHERE name = ?;', (name,))
-            self.__conn.commit()
+        self.__states.invalidate(ip)
+        self.__health.forget(ip)
 
     def set(self, name: str, preset: dict): 
         """Sets a bulb to a defined state.
@@ -201,20 +486,92 @@ class Bulb():
             Accepts structures produced by a Preset class
         """
         
-        if self.__status(name) == None:
-            raise BulbExc('No bulb with such name: ' + name)
+        ip = self.__registry.ip(name)
+        if ip == None:
+            raise BulbExc(self.missing(name))
 
-        b = yeelight.Bulb(self.find_by_name(name))
-        brightness = preset.get('brightness')
-        mode = preset.get('mode')
-        value = preset.get('value')
+        self.apply(ip, preset)
 
-        b.effect = 'smooth'
+    def apply(self, ip: str, preset: dict):
+        """Sets a bulb at a given ip to a defined state.
+        Does not check the bulb against the database.
 
-        if brightness == 0:
-            b.turn_off()
+        Parameters:
+        -----------
+        ip:
+            IP address of the bulb.
+        preset:
+            Dictionary with bulb settings such as brightness etc...
+            Accepts structures produced by a Preset class,
+            their precompiled commands are sent as they are.
+        """
+
+        commands = preset.get('commands')
+        self.send(ip, commands if commands != None else compile_preset(preset))
+
+    def send(self, ip: str, commands: list):
+        """Sends commands setting the bulb state to a bulb at a given ip.
+        Does not check the bulb against the database.
+
+        Parameters:
+        -----------
+        ip:
+            IP address of the bulb.
+        commands:
+            List of (method, params) tuples, as returned by compile_preset().
+        """
+
+        def send(b):
+            for method, params in commands:
+                self.__journaled(ip, method, params, lambda: b.send_command(method, list(params)),
+                                 lambda response: response.get('result') if isinstance(response, dict) else None)
+
+        if not self.__health.allow(ip):
+            self.__metrics.inc('yeelight_commands_total', ip=ip, command='send', status='offline')
+            raise BulbExc('Bulb is offline: ' + ip)
+        t0 = time.monotonic()
+        try:
+            # only the newest state matters, queued older states are dropped
+            self.__dispatcher.run(ip, send, key='state')
+        except Exception as e:
+            self.record(ip, 'send', t0, e)
+            raise
         else:
-            if mode == 'CT': 
-                b.set_scene(yeelight.SceneClass.CT, value, brightness)
-            elif mode == 'RGB':
-                b.set_scene(yeelight.SceneClass.COLOR, value[0], value[1], value[2], brightness)
+            self.record(ip, 'send', t0)
+        finally:
+            # the bulb state is known to have changed
+            self.__states.invalidate(ip)
+
+    def __journaled(self, ip: str, method: str, params: list, call, result):
+        """Returns call(), recording the command and the result(response) or the error into the journal."""
+
+        if self.__journal == None:
+            return call()
+        sent = time.monotonic()
+        try:
+            response = call()
+        except Exception as e:
+            self.__journal.record(ip, method, params, sent, error=e)
+            raise
+        self.__journal.record(ip, method, params, sent, result(response))
+        return response
+
+    def record(self, ip: str, command: str, t0: float, exc: Exception = None) -> float:
+        """Records the outcome of a command started at t0 into the health monitor and the metrics.
+        Used for commands sent outside of send(), e.g. in music mode.
+        Returns the latency in seconds.
+        """
+
+        latency = time.monotonic() - t0
+        self.__health.record(ip, exc)
+        self.__metrics.observe('yeelight_command_seconds', latency, ip=ip, command=command)
+        self.__metrics.inc('yeelight_commands_total', ip=ip, command=command,
+                           status=parallel.OK if exc == None else parallel.classify(exc))
+        return latency
+
+    def invalidate(self, ip: str = None):
+        """Drops the cached state of a bulb at a given ip, or of all bulbs.
+        Used when the bulb is set without send(), e.g. by AsyncBulb.
+        """
+
+        self.__states.invalidate(ip)
@@ -0,0 +1,136 @@
+"""Thin client of the yeelight-control daemon.
+
+Usage:
+    python yeelight-client.py scene evening
+    python yeelight-client.py bulb desk warm
+    python yeelight-client.py status
+
+Imports nothing but the standard library, so it starts in milliseconds.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+def _default_socket() -> str:
+    """Returns the per-user path of the daemon socket, the same from any working directory."""
+
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'yeelight-control.sock')
+    if hasattr(os, 'getuid'):
+        return os.path.join(os.environ.get('TMPDIR', '/tmp'), 'yeelight-control-' + str(os.getuid()) + '.sock')
+    return os.path.abspath('yeelight-control.sock') # no Unix sockets, the loopback port is used
+
+DEFAULT_SOCKET = _default_socket()
+DEFAULT_PORT = 55480 # loopback port used where Unix sockets are not available
+
+class ClientExc(Exception):
+    """Generic exception for the daemon client."""
+    def __init__(self, message, head="ClientException", ):
+        super().__init__(message)
+        self.head = head
+        self.message = message
+
+def connect(path: str = DEFAULT_SOCKET, port: int = None, timeout: float = 10.0):
+    """Connects to the daemon.
+    Uses the Unix socket at path, or loopback TCP if port is given or Unix sockets are not available.
+    """
+
+    if port == None and hasattr(socket, 'AF_UNIX'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    return socket.create_connection(('127.0.0.1', port or DEFAULT_PORT), timeout)
+
+def request(command: str, path: str = DEFAULT_SOCKET, port: int = None, timeout: float = 10.0, **params) -> dict:
+    """Sends a single request to the daemon and returns its response.
+
+    Parameters:
+    -----------
+    command:
+        Name of the command, see Daemon.
+    params:
+        Parameters of the command.
+
+    Raises ClientExc if the daemon is not running or reports an error.
+    """
+
+    try:
+        with connect(path, port, timeout) as sock:
+            sock.sendall((json.dumps(dict(params, command=command)) + '\n').encode('utf8'))
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+    except OSError as e:
+        raise ClientExc('Daemon is not running: ' + str(e)) from e
+
+    try:
+        response = json.loads(data.decode('utf8'))
+    except ValueError as e:
+        raise ClientExc('Invalid response from the daemon') from e
+    if not response.get('ok'):
+        raise ClientExc(response.get('error', 'Unknown error'))
+    return response
+
+def main():
+    parser = argparse.ArgumentParser(description='Control bulbs through a running yeelight-control daemon.')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='path of the daemon socket')
+    parser.add_argument('--port', type=int, help='loopback port of the daemon instead of the socket')
+    commands = parser.add_subparsers(dest='command', required=True)
+    scene = commands.add_parser('scene', help='set a scene')
+    scene.add_argument('name')
+    scene.add_argument('--sync', action='store_true', help='switch all bulbs at the same instant')
+    scene.add_argument('--diff', action='store_true', help='send only to bulbs which are not in their preset already')
+    bulb = commands.add_parser('bulb', help='set a bulb to a preset')
+    bulb.add_argument('name')
+    bulb.add_argument('preset')
+    commands.add_parser('status', help='print the status of the bulbs')
+    commands.add_parser('scenes', help='list the scenes')
+    commands.add_parser('presets', help='list the presets')
+    commands.add_parser('stats', help='print the command metrics as JSON')
+    commands.add_parser('ping', help='check the daemon is running')
+    commands.add_parser('stop', help='stop the daemon')
+    args = parser.parse_args()
+
+    params = {key: value for key, value in vars(args).items() if key in ('name', 'preset')}
+    if args.command == 'scene' and args.sync:
+        params['synchronized'] = True
+    if args.command == 'scene' and args.diff:
+        params['diff'] = True
+    try:
+        response = request(args.command, args.socket, args.port, **params)
+    except ClientExc as e:
+        print(e.message, file=sys.stderr)
+        sys.exit(1)
+
+    if args.command == 'scene':
+        failed = 0
+        for name, result in response['report'].items():
+            if result['status'] != 'ok':
+                failed += 1
+                print(name, result['status'], result.get('error', ''), file=sys.stderr)
+        skipped = sum(result.get('skipped', 0) for result in response['report'].values())
+        if skipped:
+            print('Skipped', skipped, 'command(s), the bulbs were set already')
+        sys.exit(1 if failed else 0)
+    elif args.command == 'status':
+        for name, state in response['bulbs'].items():
+            print('{0:<15}{1:<10}{2}'.format(state['ip'] or '-', name, state['power'] if state['reachable'] else 'unavailable'))
+    elif args.command in ('scenes', 'presets'):
+        print('\n'.join(response['names']))
+    elif args.command == 'stats':
+        print(json.dumps(response['metrics'], indent=4))
+
+if __name__ == '__main__':
+    main()
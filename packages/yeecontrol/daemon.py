@@ -0,0 +1,315 @@
+"""Long-running yeelight-control daemon.
+
+Keeps the registry, compiled scenes, bulb connections and tracked bulb states
+resident, runs scheduled jobs and serves requests of the thin client (see client.py).
+
+Usage:
+    python -m packages.yeecontrol.daemon --db yeelight-control.db
+
+Protocol: a single JSON object per line in each direction, e.g.
+    {"command": "scene", "name": "evening"}
+    {"ok": true, "report": {"desk": {"status": "ok", "latency": 0.012}}}
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+
+from .bulbs import Bulb, BulbExc
+from .client import DEFAULT_PORT, DEFAULT_SOCKET, ClientExc, request
+from .discovery import DiscoveryService
+from .dispatch import Dispatcher
+from .health import HealthMonitor
+from .journal import Journal
+from .metrics import Metrics, MetricsServer
+from .pool import BulbPool, pool_budget
+from .presets import Preset, PresetExc
+from .scenes import Scene, SceneExc
+from .schedule import Scheduler
+from .state import StateTracker
+
+logger = logging.getLogger(__name__)
+
+# tables the resident bulbs, presets and scenes are loaded from
+WATCHED_TABLES = ['bulbs', 'presets', 'scenes', 'scene_members']
+
+class Daemon():
+    """A class to represent the daemon serving client requests.
+    All requests are handled one by one in the thread calling serve(),
+    which also owns the database connection.
+
+    Commands:
+    ---------
+    ping
+        Checks the daemon is running.
+    scene(name, synchronized, diff)
+        Sets a scene, returns a per-bulb report.
+    bulb(name, preset)
+        Sets a bulb to a preset.
+    status
+        Returns the status snapshot of all bulbs.
+    scenes
+        Returns the scene names.
+    presets
+        Returns the preset names.
+    stats
+        Returns the command metrics, see Metrics.snapshot().
+    stop
+        Stops the daemon.
+
+    Methods:
+    --------
+    serve()
+        Handles requests until stopped.
+    handle(message)
+        Handles a single request, returns the response.
+    close()
+        Closes the socket, bulb connections and the database.
+    """
+
+    def __init__(self, db_path: str, path: str = DEFAULT_SOCKET, port: int = None, pool_ttl: float = 600.0,
+                 quota: int = 60, discovery_interval: float = 300.0, track_state: bool = True,
+                 scheduler: bool = True, latitude: float = None, longitude: float = None, metrics_port: int = None,
+                 journal_path: str = None):
+        """
+        Parameters:
+        ----------
+        db_path:
+            Path of the database.
+        path:
+            Path of the Unix socket.
+        port:
+            Loopback TCP port to listen on instead of the Unix socket.
+            Used by default where Unix sockets are not available.
+        pool_ttl:
+            Time in seconds an unused bulb connection is kept open.
+        quota:
+            Commands accepted by a bulb per minute.
+        discovery_interval:
+            Time in seconds between background discovery sweeps, 0 - disabled.
+        track_state:
+            Keep a listening connection to every bulb instead of polling its state.
+        scheduler:
+            Run scheduled jobs, see schedule.py.
+        latitude:
+            Latitude of the location for sunrise and sunset rules.
+        longitude:
+            Longitude of the location for sunrise and sunset rules.
+        metrics_port:
+            Loopback port serving the metrics in the Prometheus text format, None - disabled.
+        journal_path:
+            File every bulb command and response is appended to, None - disabled.
+        """
+
+        self.path = path
+        self.port = port
+        self.__running = False
+
+        self.__conn = sqlite3.connect(db_path)
+        self.__cursor = self.__conn.cursor()
+        self.metrics = Metrics()
+        self.__journal = Journal(journal_path) if journal_path != None else None
+        self.__pool = BulbPool(ttl=pool_ttl, max_per_bulb=pool_budget(track_state), metrics=self.metrics)
+        self.__dispatcher = Dispatcher(self.__pool, quota=quota)
+        self.__tracker = StateTracker(quota=self.__dispatcher) if track_state else None
+        self.__health = HealthMonitor()
+        self.__discovery = None
+        self.__version = None # data_version of the database when it was last checked
+        self.__revision = None # revision of the watched tables when the bulbs, presets and scenes were loaded
+        self.__refresh()
+
+        if discovery_interval > 0:
+            self.__discovery = DiscoveryService(db_path, registry=self.bulbs.registry, interval=discovery_interval)
+            self.__discovery.start()
+
+        self.__scheduler = None
+        if scheduler:
+            self.__scheduler = Scheduler(db_path, latitude, longitude, self.__pool, self.bulbs.dispatcher, self.bulbs.health,
+                                         self.metrics, self.__journal)
+            self.__scheduler.start()
+
+        self.__metrics_server = None
+        if metrics_port != None:
+            self.__metrics_server = MetricsServer(self.metrics, metrics_port)
+            self.__metrics_server.start()
+
+        self.__server = self.__listen()
+
+    def __refresh(self):
+        """Loads the bulbs, presets and scenes again if another connection changed their tables,
+        e.g. the menu, so the name map and the compiled scenes are not stale.
+        """
+
+        version = self.__conn.execute('PRAGMA data_version;').fetchone()[0]
+        if version == self.__version:
+            return
+        self.__version = version
+        if self.__revision != None:
+            # e.g. the scheduler bookkeeping changes the database too, it needs no reload
+            revision = self.__cursor.execute('SELECT revision FROM revision;').fetchone()[0]
+            if revision == self.__revision:
+                return
+            logger.info('Daemon: database changed, reloading')
+            self.bulbs.close_synchronizer()
+            self.__revision = revision
+        self.bulbs = Bulb(self.__conn, self.__cursor, self.__pool, self.__dispatcher, self.__tracker, self.__health,
+                          metrics=self.metrics, journal=self.__journal)
+        self.presets = Preset(self.__conn, self.__cursor)
+        self.scenes = Scene(self.__conn, self.__cursor)
+        self.scenes.prepare(self.bulbs, self.presets)
+        if self.__revision == None:
+            self.__revision = self.__watch()
+        if self.__discovery != None:
+            self.__discovery.registry = self.bulbs.registry
+
+    def __watch(self) -> int:
+        """Creates triggers counting the changes of the watched tables, returns the current revision."""
+
+        self.__cursor.execute('CREATE TABLE IF NOT EXISTS revision (revision INTEGER NOT NULL);')
+        self.__cursor.execute('INSERT INTO revision (revision) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM revision);')
+        for table in WATCHED_TABLES:
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                self.__cursor.execute('''CREATE TRIGGER IF NOT EXISTS {0}_{1}_revision AFTER {1} ON {0}
+                        BEGIN UPDATE revision SET revision = revision + 1; END;'''.format(table, event.lower()))
+        self.__conn.commit()
+        return self.__cursor.execute('SELECT revision FROM revision;').fetchone()[0]
+
+    def __listen(self):
+        """Opens the listening socket."""
+
+        if self.port == None and hasattr(socket, 'AF_UNIX'):
+            if os.path.exists(self.path):
+                try:
+                    request('ping', self.path)
+                except ClientExc:
+                    os.unlink(self.path) # left behind by a daemon which was killed
+                else:
+                    raise OSError('Daemon is already running at ' + self.path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(self.path)
+            os.chmod(self.path, 0o600) # only the owner may control the bulbs
+        else:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.bind(('127.0.0.1', self.port or DEFAULT_PORT))
+        server.listen(16)
+        return server
+
+    def serve(self):
+        """Handles requests until the stop command is received."""
+
+        self.__running = True
+        logger.info('Daemon listening on %s', self.path if self.__server.family != socket.AF_INET else self.__server.getsockname())
+        while self.__running:
+            try:
+                conn, address = self.__server.accept()
+            except OSError:
+                break # closed
+            with conn:
+                conn.settimeout(5.0)
+                try:
+                    data = b''
+                    while not data.endswith(b'\n'):
+                        chunk = conn.recv(65536)
+                        if not chunk:
+                            break
+                        data += chunk
+                    response = self.handle(data.decode('utf8'))
+                    conn.sendall((json.dumps(response) + '\n').encode('utf8'))
+                except OSError:
+                    logger.warning('Daemon client connection failed', exc_info=True)
+
+    def handle(self, message: str) -> dict:
+        """Handles a single JSON request, returns the response dictionary."""
+
+        try:
+            message = json.loads(message)
+            command = message['command']
+        except (ValueError, KeyError, TypeError):
+            return {'ok': False, 'error': 'Invalid request'}
+
+        try:
+            self.__refresh()
+            if command == 'ping':
+                return {'ok': True}
+            elif command == 'scene':
+                report = self.scenes.set(message['name'], self.bulbs, self.presets,
+                                         synchronized=bool(message.get('synchronized')), diff=bool(message.get('diff')))
+                return {'ok': True, 'report': report}
+            elif command == 'bulb':
+                self.bulbs.set(message['name'], self.presets.get(message['preset']))
+                return {'ok': True}
+            elif command == 'status':
+                return {'ok': True, 'bulbs': self.bulbs.status_all()}
+            elif command == 'scenes':
+                return {'ok': True, 'names': self.scenes.list()}
+            elif command == 'presets':
+                return {'ok': True, 'names': self.presets.list()}
+            elif command == 'stats':
+                return {'ok': True, 'metrics': self.metrics.snapshot()}
+            elif command == 'stop':
+                self.__running = False
+                return {'ok': True}
+            else:
+                return {'ok': False, 'error': 'Unknown command: ' + str(command)}
+        except KeyError as e:
+            return {'ok': False, 'error': 'Missing parameter: ' + str(e)}
+        except (BulbExc, PresetExc, SceneExc) as e:
+            return {'ok': False, 'error': e.message}
+        except Exception as e:
+            logger.exception('Daemon command %s failed', command)
+            return {'ok': False, 'error': str(e)}
+
+    def close(self):
+        """Closes the socket, bulb connections and the database."""
+
+        self.__server.close()
+        if self.__server.family != socket.AF_INET and os.path.exists(self.path):
+            os.unlink(self.path)
+        if self.__metrics_server != None:
+            self.__metrics_server.stop()
+        if self.__scheduler != None:
+            self.__scheduler.stop()
+        if self.__discovery != None:
+            self.__discovery.stop()
+        if self.__tracker != None:
+            self.__tracker.stop()
+        self.bulbs.health.stop()
+        self.bulbs.close_synchronizer()
+        self.__pool.close_all()
+        self.__conn.close()
+        if self.__journal != None:
+            self.__journal.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve yeelight-control requests from a resident process.')
+    parser.add_argument('--db', default='yeelight-control.db', help='database path')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='path of the Unix socket')
+    parser.add_argument('--port', type=int, help='listen on this loopback port instead of the Unix socket')
+    parser.add_argument('--discovery-interval', type=float, default=300, help='seconds between discovery sweeps, 0 - disabled')
+    parser.add_argument('--no-tracking', action='store_true', help='poll bulb states instead of listening to them')
+    parser.add_argument('--no-scheduler', action='store_true', help='do not run scheduled jobs')
+    parser.add_argument('--latitude', type=float, help='latitude of the location for sun rules')
+    parser.add_argument('--longitude', type=float, help='longitude of the location for sun rules')
+    parser.add_argument('--journal', help='append every bulb command and response to this file')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this loopback port')
+    parser.add_argument('--log', default='yeelight-control.log', help='log file path')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, filename=args.log, filemode='a',
+                        format='%(name)s:%(levelname)s:%(asctime)s:%(message)s')
+    daemon = Daemon(args.db, args.socket, args.port, discovery_interval=args.discovery_interval,
+                    track_state=not args.no_tracking, scheduler=not args.no_scheduler,
+                    latitude=args.latitude, longitude=args.longitude, metrics_port=args.metrics_port,
+                    journal_path=args.journal)
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+if __name__ == '__main__':
+    main()
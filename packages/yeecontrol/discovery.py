@@ -0,0 +1,210 @@
+"""Headless bulb discovery.
+
+Usage:
+    python -m packages.yeecontrol.discovery --db yeelight-control.db --interval 60 --auto-add
+"""
+
+import argparse
+import logging
+import sqlite3
+import threading
+
+from .registry import Registry
+
+logger = logging.getLogger(__name__)
+
+# discovery events
+ADDED = 'added' # a bulb which is not saved answered
+SAVED = 'saved' # a new bulb was saved under a generated name
+MOVED = 'moved' # a saved bulb answered from a new ip, its ip was updated
+VANISHED = 'vanished' # a saved bulb stopped answering
+RETURNED = 'returned' # a vanished bulb answered again
+CONFLICT = 'conflict' # a saved bulb moved to an ip held by another saved bulb which was found as well
+
+class DiscoveryService():
+    """A class to represent repeated discovery of bulbs in the background.
+    Every sweep is compared with the registry by device id, so bulbs keep their
+    names and scenes when the router assigns them new addresses.
+
+    Methods:
+    --------
+    sweep()
+        Runs a single discovery, returns a list of events.
+    start()
+        Starts sweeping in a background thread.
+    stop()
+        Stops the background thread.
+    """
+
+    def __init__(self, db_path: str, on_event=None, registry: Registry = None, interval: float = 60.0,
+                 timeout: float = 2.0, misses: int = 3, auto_add: bool = False, discover=None):
+        """
+        Parameters:
+        ----------
+        db_path:
+            Path of the database. The service uses its own connection, so it can run in its own thread.
+        on_event:
+            Callable taking an event name, a bulb name (None for unsaved bulbs) and a discovery result dict.
+        registry:
+            Registry of the application to be notified about bulbs changed by the service.
+        interval:
+            Time in seconds between sweeps.
+        timeout:
+            Time in seconds a sweep waits for replies.
+        misses:
+            Number of sweeps a saved bulb may miss before it is reported vanished.
+        auto_add:
+            Save newly found bulbs under their own name or bulb-<id> instead of only reporting them.
+        discover:
+            Callable returning discovery results, defaults to yeelight.discover_bulbs.
+        """
+
+        self.db_path = db_path
+        self.on_event = on_event
+        self.registry = registry
+        self.interval = interval
+        self.timeout = timeout
+        self.misses = misses
+        self.auto_add = auto_add
+        self.discover = discover
+
+        self.__own = None # Registry on the service connection, created in the sweeping thread
+        self.__missed = {} # device id -> number of sweeps missed
+        self.__vanished = set() # device ids reported vanished
+        self.__unsaved = set() # device ids of bulbs reported as added
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __emit(self, events: list, event: str, name: str, bulb: dict):
+        events.append((event, name, bulb))
+        logger.info('Discovery: %s %s %s', event, name, bulb.get('ip'))
+        if self.on_event != None:
+            self.on_event(event, name, bulb)
+
+    def __changed(self, name: str):
+        if self.registry != None:
+            self.registry.notify(name)
+
+    def sweep(self) -> list:
+        """Runs a single discovery and updates the registry.
+
+        Returns a list of (event, bulb name, discovery result) tuples.
+        """
+
+        if self.__own == None:
+            conn = sqlite3.connect(self.db_path)
+            self.__own = Registry(conn, conn.cursor())
+        registry = self.__own
+        registry.invalidate() # the application may have changed the table
+
+        if self.discover == None:
+            import yeelight
+            self.discover = yeelight.discover_bulbs
+
+        events = []
+        found = {}
+        for bulb in self.discover(timeout=self.timeout):
+            bulb_id = bulb.get('capabilities', {}).get('id')
+            if bulb_id != None:
+                found[bulb_id] = bulb
+
+        # saved bulbs without an id (added before ids were stored) are matched by ip once
+        for bulb_id, bulb in found.items():
+            name = registry.name(bulb.get('ip'))
+            if registry.find_by_id(bulb_id) == None and name != None and name not in registry.ids().values():
+                registry.set_id(name, bulb_id)
+
+        moves = {}
+        for bulb_id, bulb in found.items():
+            name = registry.find_by_id(bulb_id)
+            if name == None:
+                if self.auto_add:
+                    name = bulb['capabilities'].get('name') or 'bulb-' + bulb_id[-6:]
+                    if registry.add(name, bulb.get('ip'), bulb_id):
+                        self.__changed(name)
+                        self.__emit(events, SAVED, name, bulb)
+                        continue
+                if bulb_id not in self.__unsaved:
+                    self.__unsaved.add(bulb_id)
+                    self.__emit(events, ADDED, None, bulb)
+                continue
+
+            self.__missed.pop(bulb_id, None)
+            if bulb_id in self.__vanished:
+                self.__vanished.discard(bulb_id)
+                self.__emit(events, RETURNED, name, bulb)
+            if registry.ip(name) != bulb.get('ip'):
+                moves[name] = bulb
+
+        seen = {registry.find_by_id(bulb_id) for bulb_id in found}
+        before = dict(registry.items())
+        conflicts = registry.move({name: bulb.get('ip') for name, bulb in moves.items()},
+                                  absent=[name for name in before if name not in seen])
+        for name, ip in before.items():
+            if name not in moves and registry.ip(name) != ip:
+                self.__changed(name) # parked, its ip was given to a bulb which moved
+        for name, bulb in moves.items():
+            if name in conflicts:
+                self.__emit(events, CONFLICT, name, bulb)
+            else:
+                self.__changed(name)
+                self.__emit(events, MOVED, name, bulb)
+
+        for bulb_id, name in registry.ids().items():
+            if bulb_id in found or bulb_id in self.__vanished:
+                continue
+            self.__missed[bulb_id] = self.__missed.get(bulb_id, 0) + 1
+            if self.__missed[bulb_id] >= self.misses:
+                self.__vanished.add(bulb_id)
+                self.__emit(events, VANISHED, name, {'ip': registry.ip(name), 'capabilities': {'id': bulb_id}})
+
+        return events
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Discovery sweep failed')
+            self.__stop.wait(self.interval)
+
+    def start(self):
+        """Starts sweeping in a background thread."""
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stops the background thread."""
+
+        self.__stop.set()
+        if self.__thread != None:
+            self.__thread.join()
+            self.__thread = None
+
+def main():
+    parser = argparse.ArgumentParser(description='Discover Yeelight bulbs and keep their addresses up to date.')
+    parser.add_argument('--db', default='yeelight-control.db', help='database path')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between sweeps')
+    parser.add_argument('--timeout', type=float, default=2, help='seconds a sweep waits for replies')
+    parser.add_argument('--auto-add', action='store_true', help='save new bulbs under their own name or bulb-<id>')
+    parser.add_argument('--once', action='store_true', help='run a single sweep and exit')
+    args = parser.parse_args()
+
+    def on_event(event, name, bulb):
+        print(event, name if name != None else '-', bulb.get('ip'), bulb.get('capabilities', {}).get('id'))
+
+    service = DiscoveryService(args.db, on_event, interval=args.interval, timeout=args.timeout, auto_add=args.auto_add)
+    if args.once:
+        service.sweep()
+        return
+    service.start()
+    try:
+        while True:
+            threading.Event().wait(3600)
+    except KeyboardInterrupt:
+        service.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import collections
+import threading
+import time
+from concurrent.futures import Future
+
+class TokenBucket():
+    """A token bucket limiting the rate of commands sent to a single bulb."""
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        Parameters:
+        ----------
+        rate:
+            Tokens added per second.
+        capacity:
+            Maximum number of tokens, the size of a burst.
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.__updated = time.monotonic()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def take(self) -> float:
+        """Takes a token if available, returns 0.
+        Otherwise returns the number of seconds until a token is available.
+        """
+
+        self.__refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self):
+        """Empties the bucket, used when the bulb reports its quota is exceeded."""
+
+        self.__refill()
+        self.tokens = 0.0
+
+class Dispatcher():
+    """A class to represent a per-bulb command scheduler.
+    Commands for each bulb are queued and sent by a worker thread of that bulb,
+    at most as fast as the bulb quota allows. A queued command with the same key
+    as a newer one is superseded: only the newest is sent, and callers of both
+    get its outcome.
+
+    Methods:
+    --------
+    submit(ip, fn, key)
+        Queues a command, returns a Future.
+    run(ip, fn, key, timeout)
+        Queues a command and waits for its result.
+    take(ip)
+        Takes a token of the bulb quota for a command sent by other means.
+    stats()
+        Returns queue depth and counters per bulb.
+    """
+
+    def __init__(self, pool, quota: int = 60, period: float = 60.0, burst: int = 20, idle: float = 30.0):
+        """
+        Parameters:
+        ----------
+        pool:
+            BulbPool object used to send the commands.
+        quota:
+            Number of commands a bulb accepts per period.
+        period:
+            Length of the quota period in seconds.
+        burst:
+            Number of commands which may be sent at once before rate limiting applies.
+        idle:
+            Time in seconds after which the worker of an idle bulb exits.
+        """
+
+        self.pool = pool
+        self.quota = quota
+        self.period = period
+        self.burst = burst
+        self.idle = idle
+
+        self.__lock = threading.Condition()
+        self.__queues = {} # ip -> OrderedDict of key -> [fn, futures, retried]
+        self.__buckets = {} # ip -> TokenBucket
+        self.__workers = {} # ip -> Thread
+        self.__counters = collections.defaultdict(collections.Counter) # ip -> counters
+
+    def submit(self, ip: str, fn, key: str = None) -> Future:
+        """Queues a command for a bulb.
+
+        Parameters:
+        -----------
+        ip:
+            IP address of the bulb.
+        fn:
+            Callable taking a yeelight.Bulb object, run through the pool.
+        key:
+            Commands with the same key supersede each other, e.g. 'state' for
+            commands which set the whole bulb state. None never supersedes.
+
+        Returns a Future resolved with the result of fn.
+        """
+
+        future = Future()
+        with self.__lock:
+            queue = self.__queues.setdefault(ip, collections.OrderedDict())
+            if key == None:
+                key = object() # unique, never superseded
+            if key in queue:
+                futures = queue.pop(key)[1]
+                self.__counters[ip]['dropped'] += 1
+            else:
+                futures = []
+            futures.append(future)
+            queue[key] = [fn, futures, False]
+            self.__counters[ip]['queued'] += 1
+
+            if ip not in self.__workers:
+                if ip not in self.__buckets:
+                    self.__buckets[ip] = TokenBucket(self.quota / self.period, self.burst)
+                worker = threading.Thread(target=self.__work, args=(ip,), daemon=True)
+                self.__workers[ip] = worker
+                worker.start()
+            self.__lock.notify_all()
+        return future
+
+    def run(self, ip: str, fn, key: str = None, timeout: float = None):
+        """Queues a command for a bulb and returns its result. See submit()."""
+
+        return self.submit(ip, fn, key).result(timeout)
+
+    def take(self, ip: str) -> float:
+        """Takes a token of the bulb quota for a command sent outside the dispatcher,
+        e.g. by the asyncio client, so both count against the same quota.
+        Returns 0, or the number of seconds until a token is available.
+        """
+
+        with self.__lock:
+            bucket = self.__buckets.get(ip)
+            if bucket == None:
+                bucket = self.__buckets[ip] = TokenBucket(self.quota / self.period, self.burst)
+            return bucket.take()
+
+    def __work(self, ip: str):
+        """Sends queued commands of a bulb, exits when the bulb is idle."""
+
+        from yeelight import BulbException
+
+        queue = self.__queues[ip]
+        bucket = self.__buckets[ip]
+        while True:
+            with self.__lock:
+                if not queue:
+                    self.__lock.wait_for(lambda: len(queue) > 0, self.idle)
+                    if not queue:
+                        del self.__workers[ip]
+                        return
+                wait = bucket.take()
+                if wait > 0:
+                    self.__counters[ip]['throttled'] += 1
+                else:
+                    key, (fn, futures, retried) = queue.popitem(last=False)
+            if wait > 0:
+                # commands queued meanwhile may supersede the waiting ones
+                time.sleep(wait)
+                continue
+
+            try:
+                result = self.pool.run(ip, fn)
+            except BulbException as e:
+                if 'quota' in str(e) and not retried:
+                    # the bulb counted more commands than we did, retry once with the next token
+                    with self.__lock:
+                        bucket.drain()
+                        self.__counters[ip]['requeued'] += 1
+                        if key not in queue:
+                            queue[key] = [fn, futures, True]
+                            queue.move_to_end(key, last=False)
+                        else: # superseded while sending
+                            queue[key][1].extend(futures)
+                    continue
+                self.__finish(ip, futures, exception=e)
+            except BaseException as e:
+                self.__finish(ip, futures, exception=e)
+            else:
+                self.__finish(ip, futures, result=result)
+
+    def __finish(self, ip: str, futures: list, result=None, exception=None):
+        """Resolves futures of a sent command."""
+
+        with self.__lock:
+            self.__counters[ip]['sent'] += 1
+            if exception != None:
+                self.__counters[ip]['errors'] += 1
+        for future in futures:
+            if exception != None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        """Returns a dictionary of ip -> counters:
+        - depth - commands waiting in the queue
+        - queued - commands submitted
+        - sent - commands sent to the bulb
+        - dropped - commands superseded by a newer one before being sent
+        - throttled - times the worker waited for the quota
+        - requeued - commands retried after the bulb reported its quota exceeded
+        - errors - commands which failed
+        """
+
+        with self.__lock:
+            stats = {}
+            for ip, counters in self.__counters.items():
+                stats[ip] = {'depth': len(self.__queues.get(ip, ())), 'queued': 0, 'sent': 0, 'dropped': 0,
+                             'throttled': 0, 'requeued': 0, 'errors': 0}
+                stats[ip].update(counters)
+            return stats
@@ -0,0 +1,487 @@
+"""Local stand-in for a fleet of Yeelight bulbs.
+
+Emulates the LAN protocol of yeelink.light.color bulbs on loopback so Bulb,
+Scene and the ambient light can be exercised without hardware:
+- SSDP discovery replies on port 1982,
+- the JSON-RPC control port (get_prop, set_power, set_bright, set_ct_abx,
+  set_rgb, set_hsv, set_scene, start_cf, stop_cf, set_music, toggle, set_name),
+- music mode, where the bulb connects back to the host,
+- the per-bulb command quota and the connection limit.
+
+Latency, packet loss, connection limits and quota errors can be configured
+to load-test the application.
+
+Usage:
+    python -m packages.yeecontrol.emulator --count 100 --latency 0.02 --loss 0.01
+"""
+
+import argparse
+import collections
+import json
+import random
+import socket
+import sqlite3
+import threading
+import time
+
+SSDP_GROUP = '239.255.255.250'
+SSDP_PORT = 1982
+
+SUPPORT = ('get_prop set_default set_power toggle set_bright start_cf stop_cf set_scene '
+           'cron_add cron_get cron_del set_ct_abx set_rgb set_hsv set_adjust adjust_bright '
+           'adjust_ct adjust_color set_music set_name')
+
+def _shutdown(sock):
+    """Closes a socket, waking up a thread blocked on it."""
+
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+class FakeBulb():
+    """A class to represent a single emulated bulb.
+
+    Attributes:
+    -----------
+    state: dict
+        Current properties of the bulb, as returned by get_prop.
+    stats: collections.Counter
+        Counters of commands, lost requests, quota errors, refused connections etc.
+
+    Methods:
+    --------
+    start()
+        Starts listening on the control port.
+    stop()
+        Closes all sockets.
+    capabilities()
+        Returns the SSDP discovery reply of the bulb.
+    """
+
+    def __init__(self, ip: str = '127.0.0.1', port: int = 55443, bulb_id: int = 1, model: str = 'color',
+                 latency: float = 0.0, jitter: float = 0.0, loss: float = 0.0,
+                 max_connections: int = 4, quota: int = 60, quota_window: float = 60.0):
+        """
+        Parameters:
+        ----------
+        ip, port:
+            Address of the control port.
+        bulb_id:
+            Device id reported in discovery replies.
+        model:
+            Model reported in discovery replies.
+        latency, jitter:
+            Delay in seconds before every response is sent, jitter is added at random.
+        loss:
+            Probability (0-1) that a request is silently dropped.
+        max_connections:
+            Number of control connections accepted at a time, real bulbs accept 4.
+        quota:
+            Number of commands accepted per quota_window outside music mode, None for no limit.
+        """
+
+        self.ip = ip
+        self.port = port
+        self.id = '0x%016x' % bulb_id
+        self.model = model
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.max_connections = max_connections
+        self.quota = quota
+        self.quota_window = quota_window
+
+        self.state = {'power': 'off', 'bright': '100', 'ct': '4000', 'rgb': '16777215', 'hue': '0',
+                      'sat': '0', 'color_mode': '2', 'flowing': '0', 'delayoff': '0', 'flow_params': '',
+                      'music_on': '0', 'name': '', 'nl_br': '0', 'active_mode': '0'}
+        self.stats = collections.Counter()
+
+        self.__lock = threading.Lock()
+        self.__server = None
+        self.__connections = set()
+        self.__music = set() # connections back to music mode hosts, neither pushed to nor counted
+        self.__commands = collections.deque() # times of commands within the quota window
+
+    def start(self):
+        """Starts listening on the control port."""
+
+        self.__server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__server.bind((self.ip, self.port))
+        self.__server.listen(64)
+        if self.port == 0:
+            self.port = self.__server.getsockname()[1]
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    def stop(self):
+        """Closes the control port and all connections."""
+
+        if self.__server != None:
+            _shutdown(self.__server)
+            self.__server = None
+        with self.__lock:
+            connections = list(self.__connections) + list(self.__music)
+            self.__connections.clear()
+            self.__music.clear()
+        for conn in connections:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def capabilities(self) -> str:
+        """Returns the SSDP discovery reply of the bulb."""
+
+        lines = ['HTTP/1.1 200 OK', 'Cache-Control: max-age=3600', 'Date: ', 'Ext: ',
+                 'Location: yeelight://%s:%d' % (self.ip, self.port), 'Server: POSIX UPnP/1.0 YGLC/1',
+                 'id: ' + self.id, 'model: ' + self.model, 'fw_ver: 26', 'support: ' + SUPPORT]
+        for prop in ('power', 'bright', 'color_mode', 'ct', 'rgb', 'hue', 'sat', 'name'):
+            lines.append(prop + ': ' + self.state[prop])
+        return '\r\n'.join(lines) + '\r\n'
+
+    def __accept(self):
+        """Accepts control connections until the bulb is stopped."""
+
+        server = self.__server
+        while True:
+            try:
+                conn, addr = server.accept()
+            except OSError:
+                return
+            with self.__lock:
+                full = self.max_connections != None and len(self.__connections) >= self.max_connections
+                if not full:
+                    self.__connections.add(conn)
+            if full:
+                self.stats['refused'] += 1
+                conn.close()
+                continue
+            threading.Thread(target=self.__serve, args=(conn, False), daemon=True).start()
+
+    def __serve(self, conn, music: bool):
+        """Reads JSON-RPC lines from a connection and responds to them."""
+
+        buffer = b''
+        try:
+            while True:
+                data = conn.recv(16 * 1024)
+                if not data:
+                    break
+                buffer += data
+                while b'\r\n' in buffer:
+                    line, buffer = buffer.split(b'\r\n', 1)
+                    line = line.strip()
+                    if line:
+                        self.__request(conn, line, music)
+        except OSError:
+            pass
+        finally:
+            with self.__lock:
+                self.__connections.discard(conn)
+                self.__music.discard(conn)
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def __request(self, conn, line: bytes, music: bool):
+        """Handles a single request line."""
+
+        try:
+            request = json.loads(line.decode('utf8'))
+            cmd_id = request['id']
+            method = request['method']
+            params = request.get('params') or []
+        except (ValueError, KeyError, TypeError):
+            self.stats['invalid'] += 1
+            self.__send(conn, {'id': -1, 'error': {'code': -1, 'message': 'invalid command'}})
+            return
+
+        if random.random() < self.loss:
+            self.stats['lost'] += 1
+            return
+
+        self.stats['commands'] += 1
+        if not music and not self.__within_quota():
+            self.stats['rate_limited'] += 1
+            response = {'id': cmd_id, 'error': {'code': -1, 'message': 'client quota exceeded'}}
+        else:
+            try:
+                result = self.__execute(method, params, conn)
+                response = {'id': cmd_id, 'result': result}
+            except ValueError as e:
+                self.stats['errors'] += 1
+                response = {'id': cmd_id, 'error': {'code': -1, 'message': str(e)}}
+
+        if music:
+            return # the bulb never responds in music mode
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.random() * self.jitter)
+        self.__send(conn, response)
+
+    def __within_quota(self) -> bool:
+        """Counts a command against the quota, returns False if the quota is exceeded."""
+
+        if self.quota == None:
+            return True
+        now = time.monotonic()
+        with self.__lock:
+            while self.__commands and now - self.__commands[0] > self.quota_window:
+                self.__commands.popleft()
+            if len(self.__commands) >= self.quota:
+                return False
+            self.__commands.append(now)
+            return True
+
+    def __execute(self, method: str, params: list, conn) -> list:
+        """Applies a command to the bulb state, returns the result list."""
+
+        changes = {}
+        if method == 'get_prop':
+            return [self.state.get(prop, '') for prop in params]
+        elif method == 'set_power':
+            changes['power'] = params[0]
+        elif method == 'toggle':
+            changes['power'] = 'off' if self.state['power'] == 'on' else 'on'
+        elif method == 'set_bright':
+            changes['bright'] = str(int(params[0]))
+        elif method == 'set_ct_abx':
+            changes.update({'ct': str(int(params[0])), 'color_mode': '2'})
+        elif method == 'set_rgb':
+            changes.update({'rgb': str(int(params[0])), 'color_mode': '1'})
+        elif method == 'set_hsv':
+            changes.update({'hue': str(int(params[0])), 'sat': str(int(params[1])), 'color_mode': '3'})
+        elif method == 'set_scene':
+            changes['power'] = 'on'
+            kind = params[0]
+            if kind == 'color':
+                changes.update({'rgb': str(int(params[1])), 'bright': str(int(params[2])), 'color_mode': '1'})
+            elif kind == 'ct':
+                changes.update({'ct': str(int(params[1])), 'bright': str(int(params[2])), 'color_mode': '2'})
+            elif kind == 'hsv':
+                changes.update({'hue': str(int(params[1])), 'sat': str(int(params[2])),
+                                'bright': str(int(params[3])), 'color_mode': '3'})
+            elif kind == 'cf':
+                changes.update({'flowing': '1', 'flow_params': ','.join(str(p) for p in params[1:])})
+            elif kind == 'auto_delay_off':
+                changes.update({'bright': str(int(params[1])), 'delayoff': str(int(params[2]))})
+            else:
+                raise ValueError('invalid scene class')
+        elif method == 'start_cf':
+            changes.update({'power': 'on', 'flowing': '1', 'flow_params': ','.join(str(p) for p in params)})
+        elif method == 'stop_cf':
+            changes['flowing'] = '0'
+        elif method == 'set_name':
+            changes['name'] = str(params[0])
+        elif method == 'set_music':
+            if params[0] == 1:
+                self.__start_music(params[1], int(params[2]))
+                changes['music_on'] = '1'
+            else:
+                changes['music_on'] = '0'
+        elif method in ('set_default', 'cron_add', 'cron_del', 'set_adjust', 'adjust_bright', 'adjust_ct', 'adjust_color'):
+            pass
+        elif method == 'cron_get':
+            return [{'type': 0, 'delay': int(self.state['delayoff']), 'mix': 0}]
+        else:
+            raise ValueError('method not supported')
+
+        if changes:
+            self.__notify(changes)
+        return ['ok']
+
+    def __start_music(self, host: str, port: int):
+        """Connects back to the host, commands sent over that connection are never answered."""
+
+        conn = socket.create_connection((host, port), timeout=5)
+        conn.settimeout(None)
+        with self.__lock:
+            self.__music.add(conn)
+        threading.Thread(target=self.__serve, args=(conn, True), daemon=True).start()
+
+    def __notify(self, changes: dict):
+        """Updates the state and pushes a props notification to every control connection."""
+
+        with self.__lock:
+            self.state.update(changes)
+            connections = list(self.__connections)
+        message = {'method': 'props', 'params': changes}
+        for conn in connections:
+            self.__send(conn, message)
+
+    def __send(self, conn, message: dict):
+        """Sends a single JSON line, ignores broken connections."""
+
+        try:
+            conn.sendall((json.dumps(message, separators=(',', ':')) + '\r\n').encode('utf8'))
+        except OSError:
+            pass
+
+class Fleet():
+    """A class to represent a group of emulated bulbs with a shared discovery responder.
+
+    Bulbs get consecutive loopback addresses (127.1.0.1, 127.1.0.2, ...) on the
+    default control port, so the application reaches them by ip only.
+    Loopback ranges other than 127.0.0.1 are available on Linux; elsewhere use
+    spread=False, which puts all bulbs on one host with consecutive ports.
+
+    Methods:
+    --------
+    start()
+        Starts all bulbs and the discovery responder.
+    stop()
+        Stops everything.
+    register(registry, prefix)
+        Saves the emulated bulbs in a Registry.
+    """
+
+    def __init__(self, count: int, spread: bool = True, host: str = '127.0.0.1', port: int = 55443,
+                 ssdp_port: int = SSDP_PORT, **options):
+        """
+        Parameters:
+        ----------
+        count:
+            Number of bulbs.
+        spread:
+            Give every bulb its own loopback address instead of its own port.
+        host, port:
+            Address of the first bulb when spread is False.
+        ssdp_port:
+            Port of the discovery responder.
+        options:
+            Passed to every FakeBulb (latency, loss, max_connections, quota...).
+        """
+
+        self.bulbs = []
+        for i in range(count):
+            if spread:
+                ip = '127.%d.%d.%d' % (1 + (i + 1) // 65536, (i + 1) // 256 % 256, (i + 1) % 256)
+                self.bulbs.append(FakeBulb(ip, port, bulb_id=i + 1, **options))
+            else:
+                self.bulbs.append(FakeBulb(host, port + i if port else 0, bulb_id=i + 1, **options))
+        self.ssdp_port = ssdp_port
+        self.__sockets = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """Starts all bulbs and the discovery responder."""
+
+        for bulb in self.bulbs:
+            bulb.start()
+
+        # multicast discovery, reaches every bulb
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind((SSDP_GROUP, self.ssdp_port))
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                         socket.inet_aton(SSDP_GROUP) + socket.inet_aton('0.0.0.0'))
+        except OSError:
+            s.close() # no multicast support, unicast discovery still works
+        else:
+            self.__serve_ssdp(s, self.bulbs)
+
+        # unicast discovery (Bulb.get_capabilities), reaches the bulbs at the address
+        hosts = collections.defaultdict(list)
+        for bulb in self.bulbs:
+            hosts[bulb.ip].append(bulb)
+        for ip, bulbs in hosts.items():
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((ip, self.ssdp_port))
+            self.__serve_ssdp(s, bulbs)
+
+    def __serve_ssdp(self, s, bulbs: list):
+        """Answers M-SEARCH requests received on a socket with replies of the bulbs."""
+
+        self.__sockets.append(s)
+
+        def serve():
+            while True:
+                try:
+                    data, addr = s.recvfrom(65507)
+                except OSError:
+                    return
+                if not data.startswith(b'M-SEARCH'):
+                    continue
+                for bulb in bulbs:
+                    try:
+                        s.sendto(bulb.capabilities().encode(), addr)
+                    except OSError:
+                        pass
+
+        threading.Thread(target=serve, daemon=True).start()
+
+    def stop(self):
+        """Stops all bulbs and the discovery responder."""
+
+        for s in self.__sockets:
+            _shutdown(s)
+        self.__sockets.clear()
+        for bulb in self.bulbs:
+            bulb.stop()
+
+    def register(self, registry, prefix: str = 'emu-') -> list:
+        """Saves the emulated bulbs in a Registry as prefix1, prefix2 ...
+        Returns the names which could not be saved, e.g. because the name or the ip is taken.
+        The application talks to port 55443 of every bulb, so bulbs sharing an ip cannot be saved.
+        """
+
+        failed = []
+        for i, bulb in enumerate(self.bulbs):
+            if not registry.add(prefix + str(i + 1), bulb.ip):
+                failed.append(prefix + str(i + 1))
+        return failed
+
+    def stats(self) -> collections.Counter:
+        """Returns counters summed over all bulbs."""
+
+        total = collections.Counter()
+        for bulb in self.bulbs:
+            total.update(bulb.stats)
+        return total
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate a fleet of Yeelight bulbs on loopback.')
+    parser.add_argument('--count', type=int, default=4, help='number of bulbs')
+    parser.add_argument('--latency', type=float, default=0.0, help='response delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra delay in seconds')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability of dropping a request')
+    parser.add_argument('--max-connections', type=int, default=4, help='connections accepted per bulb')
+    parser.add_argument('--quota', type=int, default=60, help='commands per minute per bulb, 0 for no limit')
+    parser.add_argument('--no-spread', action='store_true', help='put all bulbs on 127.0.0.1 with consecutive ports')
+    parser.add_argument('--db', help='save the bulbs into this database as emu-1, emu-2 ...')
+    args = parser.parse_args()
+    if args.db and args.no_spread:
+        parser.error('--db needs a separate ip for every bulb, it cannot be used with --no-spread')
+
+    fleet = Fleet(args.count, spread=not args.no_spread, latency=args.latency, jitter=args.jitter,
+                  loss=args.loss, max_connections=args.max_connections, quota=args.quota or None)
+    fleet.start()
+    if args.db:
+        from .registry import Registry
+        conn = sqlite3.connect(args.db)
+        failed = fleet.register(Registry(conn, conn.cursor()))
+        conn.close()
+        if failed:
+            print('Not saved, the name or the ip is taken:', ', '.join(failed))
+
+    print('Emulating', args.count, 'bulbs:', fleet.bulbs[0].ip, '...', fleet.bulbs[-1].ip)
+    print('Press CTRL+C to stop')
+    try:
+        while True:
+            time.sleep(5)
+            print(dict(fleet.stats()))
+    except KeyboardInterrupt:
+        fleet.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import socket
+import threading
+import time
+
+# breaker states
+CLOSED = 'closed' # the bulb is used normally
+OPEN = 'open' # the bulb failed repeatedly, it is skipped until a probe reaches it
+
+def unreachable(exc: BaseException) -> bool:
+    """Returns True if the exception means the bulb could not be reached,
+    False for errors reported by the bulb itself (e.g. quota exceeded).
+    """
+
+    if exc.args and isinstance(exc.args[0], dict):
+        return False # yeelight.BulbException carrying the error sent by the bulb
+    if getattr(exc, 'error', None) != None:
+        return False # aio.AioExc carrying the error sent by the bulb
+    if type(exc).__module__.split('.')[0] == 'yeelight':
+        # any other yeelight.BulbException comes from the socket, a recv timeout
+        # is reported as 'Bulb closed the connection.' without a cause
+        return True
+    while exc is not None:
+        if isinstance(exc, OSError):
+            return True
+        exc = exc.__cause__
+    return False
+
+def tcp_probe(ip: str, port: int = 55443, timeout: float = 2.0) -> bool:
+    """Returns True if the control port of the bulb accepts a connection."""
+
+    try:
+        socket.create_connection((ip, port), timeout).close()
+    except OSError:
+        return False
+    return True
+
+class HealthMonitor():
+    """A class to represent per-bulb circuit breakers keyed by bulb ip.
+    After a number of consecutive failures the breaker of a bulb opens and
+    the bulb is skipped at once instead of waiting for its timeout again.
+    A background prober checks open bulbs with exponential backoff and closes
+    the breaker when the bulb answers.
+
+    Methods:
+    --------
+    allow(ip)
+        Returns False if the bulb should be skipped.
+    success(ip)
+        Records a successful command.
+    failure(ip)
+        Records a failed command.
+    record(ip, exc)
+        Records the outcome of a command.
+    state(ip)
+        Returns the breaker state of a bulb.
+    forget(ip)
+        Drops the health state of a bulb.
+    stop()
+        Stops the background prober.
+    """
+
+    def __init__(self, threshold: int = 3, backoff: float = 5.0, max_backoff: float = 300.0, probe=tcp_probe):
+        """
+        Parameters:
+        ----------
+        threshold:
+            Number of consecutive failures opening the breaker.
+        backoff:
+            Time in seconds before the first probe of an open bulb, doubled after every failed probe.
+        max_backoff:
+            Maximum time in seconds between probes.
+        probe:
+            Callable taking an ip and returning True if the bulb answers.
+        """
+
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.probe = probe
+
+        self.__lock = threading.Condition()
+        self.__failures = {} # ip -> consecutive failures
+        self.__open = {} # ip -> [time of the next probe, current backoff]
+        self.__thread = None
+        self.__stopped = False
+
+    def allow(self, ip: str) -> bool:
+        """Returns False if the breaker of the bulb is open."""
+
+        with self.__lock:
+            return ip not in self.__open
+
+    def success(self, ip: str):
+        """Records a successful command, closes the breaker."""
+
+        with self.__lock:
+            self.__failures.pop(ip, None)
+            self.__open.pop(ip, None)
+
+    def failure(self, ip: str):
+        """Records a failed command, opens the breaker after threshold failures in a row."""
+
+        with self.__lock:
+            self.__failures[ip] = self.__failures.get(ip, 0) + 1
+            if self.__failures[ip] >= self.threshold and ip not in self.__open:
+                self.__open[ip] = [time.monotonic() + self.backoff, self.backoff]
+                self.__start()
+                self.__lock.notify()
+
+    def record(self, ip: str, exc: BaseException = None):
+        """Records the outcome of a command: success if exc is None, failure
+        if exc means the bulb is unreachable. Errors reported by the bulb do not count.
+        """
+
+        if exc == None:
+            self.success(ip)
+        elif unreachable(exc):
+            self.failure(ip)
+
+    def state(self, ip: str) -> dict:
+        """Returns a dictionary with the breaker state (closed or open), the number
+        of consecutive failures and the seconds until the next probe (open only).
+        """
+
+        with self.__lock:
+            state = {'breaker': CLOSED, 'failures': self.__failures.get(ip, 0)}
+            if ip in self.__open:
+                state.update({'breaker': OPEN, 'retry': max(0.0, self.__open[ip][0] - time.monotonic())})
+            return state
+
+    def forget(self, ip: str):
+        """Drops the health state of a bulb, e.g. when it is removed."""
+
+        self.success(ip)
+
+    def __start(self):
+        """Starts the prober thread if it is not running. Needs the lock to be held."""
+
+        if self.__thread == None and not self.__stopped:
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+
+    def __run(self):
+        """Probes open bulbs when their backoff elapses."""
+
+        while True:
+            with self.__lock:
+                while not self.__stopped:
+                    now = time.monotonic()
+                    due = [ip for ip, (next_probe, backoff) in self.__open.items() if next_probe <= now]
+                    if due:
+                        break
+                    wait = min([next_probe for next_probe, backoff in self.__open.values()], default=now + 60) - now
+                    self.__lock.wait(wait)
+                if self.__stopped:
+                    self.__thread = None
+                    return
+
+            for ip in due:
+                answered = self.probe(ip)
+                with self.__lock:
+                    if ip not in self.__open:
+                        continue # closed by a successful command meanwhile
+                    if answered:
+                        self.__failures.pop(ip, None)
+                        del self.__open[ip]
+                    else:
+                        backoff = min(self.__open[ip][1] * 2, self.max_backoff)
+                        self.__open[ip] = [time.monotonic() + backoff, backoff]
+
+    def stop(self):
+        """Stops the background prober."""
+
+        with self.__lock:
+            self.__stopped = True
+            self.__lock.notify()
+            thread = self.__thread
+        if thread != None:
+            thread.join()
@@ -0,0 +1,288 @@
+"""Journal of the commands sent to the bulbs, and its replay.
+
+Every command and its response is appended to an NDJSON file by a background
+writer, so recording costs the caller a single queue put. Each session starts
+with a header line, entries hold the time the command was sent in seconds from
+the start of the session:
+    {"journal": 1, "started": 1760000000.0}
+    {"t": 0.012, "ip": "192.168.1.5", "method": "set_scene", "params": ["ct", 2700, 100], "result": ["ok"], "latency": 0.031}
+
+Usage:
+    python -m packages.yeecontrol.journal yeelight-control.journal --speed 10 --endpoint 127.1.0.1 --endpoint 127.1.0.2
+"""
+
+import argparse
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class JournalExc(Exception):
+    """Generic exception for the command journal."""
+    def __init__(self, message, head="JournalException", ):
+        super().__init__(message)
+        self.head = head
+        self.message = message
+
+class Journal():
+    """A class to represent an append-only journal of bulb commands.
+    record() only queues the entry, a background thread serializes and writes it.
+
+    Methods:
+    --------
+    record(ip, method, params, sent, result, error, received)
+        Queues a command and its response.
+    close()
+        Writes the queued entries and closes the file.
+    """
+
+    def __init__(self, path: str, batch: int = 256):
+        """
+        Parameters:
+        ----------
+        path:
+            Path of the journal file, entries are appended.
+        batch:
+            Maximum number of entries written between flushes.
+        """
+
+        self.path = path
+        self.batch = batch
+        self.__started = time.monotonic()
+        self.__queue = queue.SimpleQueue()
+        self.__file = open(path, 'a', encoding='utf8')
+        self.__file.write(json.dumps({'journal': 1, 'started': time.time()}) + '\n')
+        self.__thread = threading.Thread(target=self.__write, daemon=True)
+        self.__thread.start()
+
+    def record(self, ip: str, method: str, params: list, sent: float, result=None, error: BaseException = None,
+               received: float = None):
+        """Queues a command and its response.
+
+        Parameters:
+        -----------
+        ip:
+            IP address of the bulb.
+        method:
+            Method of the command.
+        params:
+            Parameters of the command.
+        sent:
+            time.monotonic() when the command was sent.
+        result:
+            Result list of the response, None if there was none.
+        error:
+            Exception raised instead of a response.
+        received:
+            time.monotonic() when the response came, now if not given.
+        """
+
+        self.__queue.put((sent, received or time.monotonic(), ip, method, params, result, error))
+
+    def __entry(self, sent: float, received: float, ip: str, method: str, params: list, result, error) -> str:
+        entry = {'t': round(sent - self.__started, 6), 'ip': ip, 'method': method, 'params': list(params)}
+        if error != None:
+            entry['error'] = str(error)
+        else:
+            entry['result'] = result
+        entry['latency'] = round(received - sent, 6)
+        return json.dumps(entry, separators=(',', ':'))
+
+    def __write(self):
+        while True:
+            entries = [self.__queue.get()]
+            while len(entries) < self.batch:
+                try:
+                    entries.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            stop = False
+            for entry in entries:
+                if entry == None:
+                    stop = True
+                    continue
+                try:
+                    lines.append(self.__entry(*entry))
+                except (TypeError, ValueError):
+                    logger.warning('Journal: entry of %s %s not serializable', entry[2], entry[3])
+            if lines:
+                self.__file.write('\n'.join(lines) + '\n')
+                self.__file.flush()
+            if stop:
+                return
+
+    def close(self):
+        """Writes the queued entries and closes the file."""
+
+        if self.__thread != None:
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+            self.__file.close()
+
+def read(path: str) -> list:
+    """Returns the entries of a journal as a list of dicts ordered by the time they were sent.
+    Sessions follow each other, the time of an entry is counted from the start of the first session
+    with the gaps between the sessions left out.
+    """
+
+    entries = []
+    offset = 0.0
+    session = []
+    with open(path, encoding='utf8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                raise JournalExc('Invalid journal line ' + str(number) + ': ' + line.strip()[:80])
+            if 'journal' in entry: # a new session starts
+                if session:
+                    offset = max(entry['t'] for entry in session) # entries of several threads may be out of order
+                    entries += session
+                    session = []
+                continue
+            entry['t'] += offset
+            session.append(entry)
+    entries += session
+    entries.sort(key=lambda entry: entry['t'])
+    return entries
+
+async def replay(entries: list, endpoints: dict = None, speed: float = 1.0, timeout: float = 5.0) -> dict:
+    """Sends recorded commands again and compares the responses with the recorded ones.
+
+    Parameters:
+    -----------
+    entries:
+        Entries as returned by read().
+    endpoints:
+        Dictionary of recorded ip -> (host, port) to send to, the recorded ip and port 55443 if missing.
+    speed:
+        Time scale of the replay, 1 - as recorded, 10 - ten times faster, 0 - as fast as possible.
+    timeout:
+        Time in seconds to wait for a connection or a response.
+
+    Returns a dictionary with:
+    - sent, ok, errors, timeouts - numbers of commands
+    - mismatches - commands whose outcome differs from the recorded one
+    - duration - time in seconds of the replay
+    - rate - commands per second
+    - latency - dict of p50, p90, p99 and max latency in seconds
+    """
+
+    import asyncio # only the replay needs asyncio, not the application recording the journal
+    from .aio import AioExc, Connection
+
+    endpoints = endpoints or {}
+    connections = {}
+    unreachable = set()
+    latencies = []
+    counters = {'sent': 0, 'ok': 0, 'errors': 0, 'timeouts': 0, 'mismatches': 0}
+
+    async def connection(endpoint):
+        conn = connections.get(endpoint)
+        if conn == None or conn.closed:
+            conn = connections[endpoint] = Connection(*endpoint)
+            await conn.open(timeout)
+        return conn
+
+    async def send(entry, conn):
+        t0 = time.monotonic()
+        try:
+            result = await asyncio.wait_for(conn.request(entry['method'], entry['params']), timeout)
+        except asyncio.TimeoutError:
+            counters['timeouts'] += 1
+            counters['mismatches'] += 'error' not in entry
+            return
+        except AioExc:
+            counters['errors'] += 1
+            counters['mismatches'] += 'error' not in entry
+            return
+        latencies.append(time.monotonic() - t0)
+        counters['ok'] += 1
+        # commands sent in music mode were recorded without a response
+        counters['mismatches'] += entry.get('result') != None and entry['result'] != result
+
+    started = time.monotonic()
+    tasks = []
+    for entry in entries:
+        if speed > 0:
+            wait = entry['t'] / speed - (time.monotonic() - started)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        endpoint = endpoints.get(entry['ip'], (entry['ip'], 55443))
+        counters['sent'] += 1
+        try:
+            if endpoint in unreachable:
+                raise AioExc('Cannot connect to bulb ' + endpoint[0])
+            conn = await connection(endpoint)
+        except AioExc:
+            unreachable.add(endpoint) # do not wait for the connection timeout again
+            counters['errors'] += 1
+            counters['mismatches'] += 'error' not in entry
+            continue
+        tasks.append(asyncio.ensure_future(send(entry, conn)))
+        if speed <= 0:
+            await asyncio.sleep(0) # let the readers keep up
+    if tasks:
+        await asyncio.wait(tasks)
+    duration = time.monotonic() - started
+    for conn in connections.values():
+        conn.close()
+
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else None
+
+    counters.update({'duration': duration, 'rate': counters['sent'] / duration if duration > 0 else None,
+                     'latency': {'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99),
+                                 'max': latencies[-1] if latencies else None}})
+    return counters
+
+def map_endpoints(ips: list, endpoints: list) -> dict:
+    """Assigns recorded bulb ips to endpoints given as host or host:port, round robin."""
+
+    mapped = {}
+    for i, ip in enumerate(sorted(set(ips))):
+        host, _, port = endpoints[i % len(endpoints)].partition(':')
+        mapped[ip] = (host, int(port) if port else 55443)
+    return mapped
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a journal of bulb commands against real or emulated bulbs.')
+    parser.add_argument('journal', help='journal file')
+    parser.add_argument('--speed', type=float, default=1.0, help='time scale, 1 - as recorded, 10 - ten times faster, 0 - as fast as possible')
+    parser.add_argument('--endpoint', action='append', default=[], help='host[:port] to send to, repeat for more; '
+                        'recorded bulbs are assigned to them round robin, the recorded bulbs are used if not given')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds to wait for a connection or a response')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    try:
+        entries = read(args.journal)
+    except (OSError, JournalExc) as e:
+        print(getattr(e, 'message', str(e)), file=sys.stderr)
+        sys.exit(1)
+    endpoints = map_endpoints([entry['ip'] for entry in entries], args.endpoint) if args.endpoint else None
+    import asyncio
+    report = asyncio.run(replay(entries, endpoints, args.speed, args.timeout))
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print('Sent {0} command(s) in {1:.2f} s, {2:.0f}/s'.format(report['sent'], report['duration'], report['rate'] or 0))
+        print('ok: {0}, errors: {1}, timeouts: {2}, different from the journal: {3}'.format(
+            report['ok'], report['errors'], report['timeouts'], report['mismatches']))
+        if report['latency']['max'] != None:
+            print('latency p50: {0:.1f} ms, p90: {1:.1f} ms, p99: {2:.1f} ms, max: {3:.1f} ms'.format(
+                *[report['latency'][key] * 1000 for key in ('p50', 'p90', 'p99', 'max')]))
+    sys.exit(1 if report['errors'] or report['timeouts'] else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import json
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+def iter_object(infile, chunk_size: int = 65536):
+    """Yields (key, value) pairs of the top level JSON object in a file,
+    reading the file in chunks instead of loading it whole.
+
+    Raises json.JSONDecodeError if the file is not a valid JSON object.
+
+    Parameters:
+    -----------
+    infile:
+        File object opened in text mode.
+    chunk_size:
+        Number of characters read at a time.
+    """
+
+    buffer = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        # drop consumed data and read the next chunk, returns False at the end of the file
+        nonlocal buffer, pos, eof
+        chunk = infile.read(chunk_size)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        eof = chunk == ''
+        return not eof
+
+    def skip():
+        # skips whitespace, returns the next character or '' at the end of the file
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buffer) or not fill():
+                return buffer[pos:pos + 1]
+
+    def value():
+        # decodes the next value, reading more data while it is incomplete
+        nonlocal pos
+        while True:
+            try:
+                result, end = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if fill():
+                    continue
+                raise
+            if end == len(buffer) and not eof and fill():
+                continue # a number may continue in the next chunk
+            pos = end
+            return result
+
+    def expect(char):
+        # consumes the next non-whitespace character, which must be char
+        nonlocal pos
+        if skip() != char:
+            raise json.JSONDecodeError('Expecting ' + repr(char), buffer, pos)
+        pos += 1
+
+    expect('{')
+    if skip() == '}':
+        pos += 1
+    else:
+        while True:
+            if skip() != '"':
+                raise json.JSONDecodeError('Expecting property name enclosed in double quotes', buffer, pos)
+            key = value()
+            expect(':')
+            skip()
+            yield key, value()
+            char = skip()
+            pos += 1
+            if char == '}':
+                break
+            if char != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos - 1)
+    if skip() != '':
+        raise json.JSONDecodeError('Extra data', buffer, pos)
+
+class ObjectWriter():
+    """Writes a JSON object to a file one member at a time.
+    The output matches json.dump(obj, outfile, indent=4) if members are written in order.
+    """
+
+    def __init__(self, outfile, indent: int = 4):
+        self.__outfile = outfile
+        self.__indent = indent
+        self.__first = True
+        self.__outfile.write('{')
+
+    def write(self, key: str, value):
+        """Writes a single member of the object."""
+
+        member = json.dumps(value, sort_keys=True, indent=self.__indent).replace('\n', '\n' + ' ' * self.__indent)
+        self.__outfile.write(('\n' if self.__first else ',\n') + ' ' * self.__indent + json.dumps(key) + ': ' + member)
+        self.__first = False
+
+    def close(self):
+        """Closes the object."""
+
+        self.__outfile.write('}' if self.__first else '\n}')
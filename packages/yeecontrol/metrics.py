@@ -0,0 +1,196 @@
+"""Command latency and reliability metrics.
+
+Counters and latency histograms are kept in memory by a Metrics object shared
+by the pool, the bulbs, the scenes and the ambient light, and exposed as a
+JSON snapshot or in the Prometheus text format (see MetricsServer).
+"""
+
+import bisect
+import threading
+
+# upper bounds of the latency buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help) of the metrics recorded by the application
+DESCRIPTIONS = {
+    'yeelight_commands_total': ('counter', 'Commands sent to the bulbs by outcome (ok, timeout, error, offline).'),
+    'yeelight_command_seconds': ('histogram', 'Time to send commands to a bulb and receive its response, queueing included.'),
+    'yeelight_connections_total': ('counter', 'Control connections opened to the bulbs.'),
+    'yeelight_reconnects_total': ('counter', 'Commands sent again because a reused connection was closed by the bulb.'),
+    'yeelight_commands_skipped_total': ('counter', 'Scene commands not sent because the bulb was already in the target state.'),
+    'yeelight_scene_seconds': ('histogram', 'Time to set all bulbs of a scene.'),
+    'yeelight_scene_skew_seconds': ('histogram', 'Spread between the first and the last bulb of a scene to respond.'),
+    'yeelight_ambilight_stage_seconds': ('histogram', 'Time spent by the ambient light stages (capture, color, send) per frame.'),
+    'yeelight_ambilight_errors_total': ('counter', 'Failed ambient light stages.')
+    }
+
+def _labels(labels: tuple, extra: str = '') -> str:
+    """Returns labels in the Prometheus format, e.g. {ip="1.2.3.4",status="ok"}."""
+
+    parts = ['{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+class Metrics():
+    """A class to represent in-memory counters and latency histograms.
+    Every series is identified by a metric name and keyword labels, e.g.
+    inc('yeelight_commands_total', ip='1.2.3.4', status='ok'). Thread safe.
+
+    Methods:
+    --------
+    inc(name, value, **labels)
+        Increments a counter.
+    observe(name, seconds, **labels)
+        Records a latency into a histogram.
+    snapshot()
+        Returns all series as a JSON serializable dict.
+    prometheus()
+        Returns all series in the Prometheus text format.
+    """
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        """
+        Parameters:
+        ----------
+        buckets:
+            Upper bounds of the histogram buckets in seconds.
+        """
+
+        self.buckets = tuple(buckets)
+        self.__lock = threading.Lock()
+        self.__counters = {} # name -> {labels -> value}
+        self.__histograms = {} # name -> {labels -> [count per bucket..., count over the last bucket, sum, max]}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Adds value to a counter."""
+
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            series = self.__counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """Records a time in seconds into a histogram."""
+
+        key = tuple(sorted(labels.items()))
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self.__lock:
+            series = self.__histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts == None:
+                counts = series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0.0]
+            counts[bucket] += 1
+            counts[-2] += seconds
+            counts[-1] = max(counts[-1], seconds)
+
+    def snapshot(self) -> dict:
+        """Returns a dictionary of metric name -> list of series, where series is a dict with:
+        - labels - dict of label name -> value
+        - value - counters only
+        - count, sum, mean, max - histograms only, in seconds
+        - buckets - histograms only, dict of upper bound -> cumulative count
+        """
+
+        with self.__lock:
+            counters = {name: dict(series) for name, series in self.__counters.items()}
+            histograms = {name: {key: list(counts) for key, counts in series.items()} for name, series in self.__histograms.items()}
+
+        snapshot = {}
+        for name, series in sorted(counters.items()):
+            snapshot[name] = [{'labels': dict(key), 'value': value} for key, value in sorted(series.items())]
+        for name, series in sorted(histograms.items()):
+            snapshot[name] = []
+            for key, counts in sorted(series.items()):
+                count = sum(counts[:-2])
+                cumulative = 0
+                buckets = {}
+                for bound, bucket in zip(self.buckets + ('+Inf',), counts[:-2]):
+                    cumulative += bucket
+                    buckets[str(bound)] = cumulative
+                snapshot[name].append({'labels': dict(key), 'count': count, 'sum': counts[-2],
+                                       'mean': counts[-2] / count if count else None, 'max': counts[-1], 'buckets': buckets})
+        return snapshot
+
+    def prometheus(self) -> str:
+        """Returns all series in the Prometheus text exposition format."""
+
+        lines = []
+        for name, series in self.snapshot().items():
+            kind, text = DESCRIPTIONS.get(name, ('histogram' if 'buckets' in series[0] else 'counter', name))
+            lines += ['# HELP ' + name + ' ' + text, '# TYPE ' + name + ' ' + kind]
+            for entry in series:
+                labels = tuple(entry['labels'].items())
+                if 'value' in entry:
+                    lines.append(name + _labels(labels) + ' ' + repr(entry['value']))
+                    continue
+                for bound, count in entry['buckets'].items():
+                    lines.append(name + '_bucket' + _labels(labels, 'le="' + bound + '"') + ' ' + str(count))
+                lines.append(name + '_sum' + _labels(labels) + ' ' + repr(entry['sum']))
+                lines.append(name + '_count' + _labels(labels) + ' ' + str(entry['count']))
+        return '\n'.join(lines) + '\n'
+
+class MetricsServer():
+    """A class to represent an HTTP endpoint serving metrics in the Prometheus text format.
+
+    Methods:
+    --------
+    start()
+        Starts serving in a background thread.
+    stop()
+        Stops serving.
+    """
+
+    def __init__(self, metrics: Metrics, port: int = 9555, host: str = '127.0.0.1'):
+        """
+        Parameters:
+        ----------
+        metrics:
+            Metrics object to expose.
+        port:
+            Port to listen on, GET /metrics returns the metrics.
+        host:
+            Address to listen on, loopback by default.
+        """
+
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self.__server = None
+        self.__thread = None
+
+    def start(self):
+        """Starts serving in a background thread."""
+
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # only needed when serving
+
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # scrapes are not worth a log line
+
+        self.__server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stops serving."""
+
+        if self.__server != None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__thread.join()
+            self.__server = None
+            self.__thread = None
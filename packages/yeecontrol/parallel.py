@@ -0,0 +1,87 @@
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# result statuses reported per task
+OK = 'ok'
+TIMEOUT = 'timeout'
+ERROR = 'error'
+
+def classify(exc: BaseException) -> str:
+    """Returns TIMEOUT if the exception was caused by a socket timeout, ERROR otherwise."""
+
+    while exc is not None:
+        if isinstance(exc, (socket.timeout, TimeoutError)):
+            return TIMEOUT
+        exc = exc.__cause__
+    return ERROR
+
+def skew(report: dict) -> float:
+    """Returns the difference between the slowest and the fastest successful task
+    of a report, or None if less than two tasks succeeded. Skipped tasks are left out.
+    """
+
+    # bulbs skipped by a diff apply were not sent anything
+    latencies = [result['latency'] for result in report.values() if result['status'] == OK and not result.get('skipped')]
+    if len(latencies) < 2:
+        return None
+    return max(latencies) - min(latencies)
+
+def skipped(report: dict) -> int:
+    """Returns the number of commands left out of a report because they would not change anything."""
+
+    return sum(result.get('skipped', 0) for result in report.values())
+
+def run_all(tasks: dict, deadline: float = 5.0, workers: int = 16) -> dict:
+    """Runs all tasks at once and waits for them under a single deadline.
+
+    Parameters:
+    -----------
+    tasks: dict
+        Dictionary of task name -> callable taking no arguments.
+    deadline: float
+        Overall time limit in seconds for all of the tasks.
+    workers: int
+        Maximum number of threads running at the same time.
+
+    Returns a dictionary of task name -> result, where result is a dict with:
+    - status - ok, timeout or error
+    - latency - time in seconds it took the task to finish (or the deadline)
+    - value - value returned by the task (ok only)
+    - error - error message (timeout or error only)
+    """
+
+    report = {}
+    if len(tasks) == 0:
+        return report
+
+    started = {}
+    finished = {}
+
+    def timed(name, task):
+        started[name] = time.monotonic()
+        try:
+            return task()
+        finally:
+            finished[name] = time.monotonic()
+
+    t0 = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(tasks)))
+    futures = {executor.submit(timed, name, task): name for name, task in tasks.items()}
+    wait(futures.keys(), timeout=deadline)
+    # do not block on tasks still stuck in a socket call
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    for future, name in futures.items():
+        if not future.done() or future.cancelled():
+            report[name] = {'status': TIMEOUT, 'latency': time.monotonic() - started.get(name, t0),
+                            'error': 'Deadline exceeded'}
+            continue
+        latency = finished[name] - started[name]
+        exc = future.exception()
+        if exc is None:
+            report[name] = {'status': OK, 'latency': latency, 'value': future.result()}
+        else:
+            report[name] = {'status': classify(exc), 'latency': latency, 'error': str(exc)}
+
+    return report
@@ -0,0 +1,96 @@
+import threading
+
+class PlanCache():
+    """A class to represent compiled scene plans.
+    A plan is a list of (bulb name, ip, commands) entries ready to be sent.
+    Plans are dropped only when a scene, bulb or preset they use changes.
+
+    Attributes:
+    -----------
+    hits: int
+        Number of plans found in the cache.
+    misses: int
+        Number of plans which had to be compiled.
+
+    Methods:
+    --------
+    get(scene)
+        Returns a cached plan or None.
+    put(scene, plan, presets)
+        Caches a plan.
+    invalidate_scene(name)
+        Drops the plan of a scene.
+    invalidate_bulb(name)
+        Drops plans using a bulb.
+    invalidate_preset(name)
+        Drops plans using a preset.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__plans = {} # scene -> plan
+        self.__bulbs = {} # bulb -> set of scenes using it
+        self.__presets = {} # preset -> set of scenes using it
+
+    def get(self, scene: str) -> list:
+        """Returns the plan of a scene or None if it is not compiled."""
+
+        with self.__lock:
+            plan = self.__plans.get(scene)
+            if plan == None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return plan
+
+    def put(self, scene: str, plan: list, presets: dict):
+        """Caches the plan of a scene.
+
+        Parameters:
+        -----------
+        scene:
+            Name of the scene.
+        plan:
+            List of (bulb name, ip, commands) entries.
+        presets:
+            Dictionary of bulb name -> preset name the plan was compiled from.
+        """
+
+        with self.__lock:
+            self.__plans[scene] = plan
+            for bulb, preset in presets.items():
+                self.__bulbs.setdefault(bulb, set()).add(scene)
+                self.__presets.setdefault(preset, set()).add(scene)
+
+    def invalidate_scene(self, name: str = None):
+        """Drops the plan of a scene, or all plans if name is not given."""
+
+        with self.__lock:
+            if name == None:
+                self.__plans.clear()
+                self.__bulbs.clear()
+                self.__presets.clear()
+            else:
+                self.__plans.pop(name, None)
+
+    def invalidate_bulb(self, name: str):
+        """Drops plans of the scenes using a bulb."""
+
+        with self.__lock:
+            for scene in self.__bulbs.pop(name, ()):
+                self.__plans.pop(scene, None)
+
+    def invalidate_preset(self, name: str):
+        """Drops plans of the scenes using a preset."""
+
+        with self.__lock:
+            for scene in self.__presets.pop(name, ()):
+                self.__plans.pop(scene, None)
+
+    def stats(self) -> dict:
+        """Returns a dictionary with the number of plans, hits and misses."""
+
+        with self.__lock:
+            return {'plans': len(self.__plans), 'hits': self.hits, 'misses': self.misses}
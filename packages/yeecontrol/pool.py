@@ -0,0 +1,188 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# connections a bulb accepts at a time, shared by the pool, the state tracker and the synchronizer
+BULB_CONNECTIONS = 4
+
+def pool_budget(tracked: bool) -> int:
+    """Returns the connections per bulb left to the pool next to the connection of the
+    synchronizer (aio.Synchronizer) and, if the bulbs are tracked, of the state tracker.
+    """
+
+    return BULB_CONNECTIONS - 1 - (1 if tracked else 0)
+
+class PoolExc(Exception):
+    """Generic exception for BulbPool class."""
+    def __init__(self, message, head="PoolException", ):
+        super().__init__(message)
+        self.head = head
+        self.message = message
+
+def _close(bulb):
+    """Closes the control socket of a yeelight.Bulb object."""
+
+    # yeelight does not expose a way to close the command socket
+    sock = getattr(bulb, '_Bulb__socket', None)
+    if sock != None:
+        try:
+            sock.close()
+        except OSError:
+            pass
+        bulb._Bulb__socket = None
+
+class BulbPool():
+    """A class to represent a pool of open bulb connections keyed by bulb ip.
+
+    Methods:
+    --------
+    connection(ip)
+        Context manager lending a connected yeelight.Bulb object.
+    run(ip, fn)
+        Calls fn with a pooled bulb, reconnects once on failure.
+    evict_idle()
+        Closes connections unused for longer than the TTL.
+    close_all()
+        Closes all idle connections.
+    stats()
+        Returns the number of open and idle connections per ip.
+    """
+
+    def __init__(self, ttl: float = 60.0, max_per_bulb: int = 2, wait: float = 5.0, metrics=None):
+        """
+        Parameters:
+        ----------
+        ttl:
+            Time in seconds after which an unused connection is closed.
+        max_per_bulb:
+            Maximum number of connections open to a single bulb.
+            Yeelight bulbs accept only BULB_CONNECTIONS connections at a time, see pool_budget().
+        wait:
+            Time in seconds to wait for a free connection when the limit is reached.
+        metrics:
+            Metrics object counting connections and reconnects, none are counted if not given.
+        """
+
+        self.ttl = ttl
+        self.max_per_bulb = max_per_bulb
+        self.wait = wait
+        self.metrics = metrics
+
+        self.__lock = threading.Condition()
+        self.__idle = {} # ip -> list of (bulb, last used time)
+        self.__open = {} # ip -> number of connections, both idle and lent
+
+    def __acquire(self, ip: str):
+        """Returns an idle bulb object or a new one. Returns (bulb, reused)."""
+
+        import yeelight
+
+        deadline = time.monotonic() + self.wait
+        with self.__lock:
+            self.__evict(time.monotonic())
+            while True:
+                idle = self.__idle.get(ip)
+                if idle:
+                    return idle.pop()[0], True
+                if self.__open.get(ip, 0) < self.max_per_bulb:
+                    self.__open[ip] = self.__open.get(ip, 0) + 1
+                    if self.metrics != None:
+                        self.metrics.inc('yeelight_connections_total', ip=ip)
+                    return yeelight.Bulb(ip), False
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    # no OSError cause, contention is not a failure of the bulb for the health monitor
+                    raise PoolExc('No free connection to bulb ' + ip)
+                self.__lock.wait(left)
+
+    def __release(self, ip: str, bulb, broken: bool):
+        """Returns a bulb object to the pool or drops it if the connection is broken."""
+
+        with self.__lock:
+            if broken:
+                _close(bulb)
+                self.__open[ip] -= 1
+            else:
+                self.__idle.setdefault(ip, []).append((bulb, time.monotonic()))
+            self.__lock.notify()
+
+    def __evict(self, now: float):
+        """Closes connections idle for longer than the TTL. Needs the lock to be held."""
+
+        for ip, idle in self.__idle.items():
+            alive = []
+            for bulb, used in idle:
+                if now - used > self.ttl:
+                    _close(bulb)
+                    self.__open[ip] -= 1
+                else:
+                    alive.append((bulb, used))
+            idle[:] = alive
+
+    @contextmanager
+    def connection(self, ip: str):
+        """Lends a yeelight.Bulb object for the given ip.
+        The connection is dropped if the block raises an exception.
+        """
+
+        bulb, reused = self.__acquire(ip)
+        try:
+            yield bulb
+        except BaseException:
+            self.__release(ip, bulb, True)
+            raise
+        self.__release(ip, bulb, False)
+
+    def run(self, ip: str, fn):
+        """Calls fn(bulb) with a pooled yeelight.Bulb object and returns its result.
+        A reused connection may have been closed by the bulb in the meantime,
+        in such case fn is retried once on a fresh connection.
+        Errors reported by the bulb itself are not retried.
+        """
+
+        from yeelight import BulbException
+
+        bulb, reused = self.__acquire(ip)
+        try:
+            result = fn(bulb)
+        except BulbException as e:
+            # errors reported by the bulb come as a dict, they are not connection failures
+            reported = bool(e.args) and isinstance(e.args[0], dict)
+            self.__release(ip, bulb, not reported)
+            if not reused or reported:
+                raise
+            if self.metrics != None:
+                self.metrics.inc('yeelight_reconnects_total', ip=ip)
+            bulb, reused = self.__acquire(ip)
+            try:
+                result = fn(bulb)
+            except BaseException:
+                self.__release(ip, bulb, True)
+                raise
+        except BaseException:
+            self.__release(ip, bulb, True)
+            raise
+        self.__release(ip, bulb, False)
+        return result
+
+    def evict_idle(self):
+        """Closes connections unused for longer than the TTL."""
+
+        with self.__lock:
+            self.__evict(time.monotonic())
+
+    def close_all(self):
+        """Closes all idle connections."""
+
+        with self.__lock:
+            for ip, idle in self.__idle.items():
+                for bulb, used in idle:
+                    _close(bulb)
+                    self.__open[ip] -= 1
+                idle.clear()
+
+    def stats(self) -> dict:
+        """Returns a dictionary of ip -> {'open': int, 'idle': int}."""
+
+        with self.__lock:
+            return {ip: {'open': count, 'idle': len(self.__idle.get(ip, []))} for ip, count in self.__open.items()}
@@ -1,3 +1,6 @@
+import colorsys
+import json
+
 class PresetExc(Exception):
     """Generic exception for Preset class."""
     def __init__(self, message, head="PresetException", ):
@@ -5,23 +8,268 @@ class PresetExc(Exception):
         self.head = head
         self.message = message
 
-class Preset():
-    """A class to represent a list of presets.
-    
-    Attributes:
+# flow modes of the bulb protocol
+_FLOW_MODES = {'rgb': 1, 'ct': 2, 'sleep': 7}
+# what the bulb does after a finite flow
+FLOW_ACTIONS = {'recover': 0, 'stay': 1, 'off': 2}
+# longest single transition of a fade in milliseconds, longer fades are split
+_FADE_STEP = 3600000
+
+def _number(value, low: int, high: int, what: str) -> int:
+    """Returns value as an int, raises PresetExc if it is not a number within [low, high]."""
+
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise PresetExc('Invalid ' + what + ': ' + str(value))
+    if number != value and not isinstance(value, str) or not low <= number <= high:
+        raise PresetExc('Invalid ' + what + ': ' + str(value) + ', expected ' + str(low) + '-' + str(high))
+    return number
+
+def _rgb(value) -> int:
+    """Returns an [r, g, b] list as a single integer."""
+
+    if not isinstance(value, (list, tuple)) or len(value) != 3:
+        raise PresetExc('Invalid RGB color: ' + str(value))
+    r, g, b = [_number(channel, 0, 255, 'RGB channel') for channel in value]
+    return r * 65536 + g * 256 + b
+
+def _flow(value: dict) -> list:
+    """Returns the count, action and flow expression of a flow preset value."""
+
+    if not isinstance(value, dict) or not value.get('transitions'):
+        raise PresetExc('Flow needs a list of transitions')
+    count = _number(value.get('count', 0), 0, 1000, 'flow count')
+    action = value.get('action', 'recover')
+    if action not in FLOW_ACTIONS:
+        raise PresetExc('Invalid flow action: ' + str(action) + ', expected ' + ', '.join(FLOW_ACTIONS))
+
+    expression = []
+    for transition in value['transitions']:
+        if not isinstance(transition, (list, tuple)) or len(transition) < 2 or transition[1] not in _FLOW_MODES:
+            raise PresetExc('Invalid flow transition: ' + str(transition))
+        duration = _number(transition[0], 50, 3600000, 'transition duration')
+        mode = transition[1]
+        if mode == 'sleep':
+            expression += [duration, _FLOW_MODES[mode], 0, 0]
+            continue
+        if len(transition) != 4:
+            raise PresetExc('Invalid flow transition: ' + str(transition))
+        if mode == 'ct':
+            color = _number(transition[2], 1700, 6500, 'color temperature')
+        else:
+            color = _rgb(transition[2])
+        expression += [duration, _FLOW_MODES[mode], color, _number(transition[3], 1, 100, 'brightness')]
+    # the bulb counts state changes, not repetitions of the whole flow
+    return [count * (len(expression) // 4), FLOW_ACTIONS[action], ','.join(str(part) for part in expression)]
+
+def compile_preset(preset: dict, effect: str = 'smooth', duration: int = 300) -> list:
+    """Returns the JSON-RPC commands setting a bulb to a preset,
+    as a list of (method, params) tuples ready to be sent.
+    Raises PresetExc if the preset is not valid.
+
+    Parameters:
     -----------
-    __list: dict
-        Stores presets data as a dict of dict's
+    preset: dict
+        Preset data as returned by Preset.get().
+        - {'brightness': 0} turns the bulb off
+        - CT: value is a color temperature, 1700-6500
+        - RGB: value is [r, g, b]
+        - HSV: value is [hue 0-359, saturation 0-100]
+        - FLOW: value is {'count': 0 (forever), 'action': recover/stay/off, 'transitions': [...]},
+          transitions are [duration ms, 'ct', temperature, brightness], [duration ms, 'rgb', [r, g, b], brightness]
+          or [duration ms, 'sleep']
+    effect: str
+        Transition effect, 'smooth' or 'sudden'.
+    duration: int
+        Transition duration in milliseconds.
+    """
+
+    if not isinstance(preset, dict):
+        raise PresetExc('Invalid preset: ' + str(preset))
+    mode = preset.get('mode')
+    value = preset.get('value')
+
+    if preset.get('brightness') == 0:
+        return [('set_power', ['off', effect, duration])]
+    if mode == 'FLOW':
+        return [('set_scene', ['cf'] + _flow(value))]
+
+    brightness = _number(preset.get('brightness'), 1, 100, 'brightness')
+    if mode == 'CT':
+        return [('set_scene', ['ct', _number(value, 1700, 6500, 'color temperature'), brightness])]
+    elif mode == 'RGB':
+        return [('set_scene', ['color', _rgb(value), brightness])]
+    elif mode == 'HSV':
+        if not isinstance(value, (list, tuple)) or len(value) != 2:
+            raise PresetExc('Invalid HSV color: ' + str(value))
+        return [('set_scene', ['hsv', _number(value[0], 0, 359, 'hue'), _number(value[1], 0, 100, 'saturation'), brightness])]
+    else:
+        raise PresetExc('Unknown preset mode: ' + str(mode))
+
+def compile_fade(preset: dict, duration: int, start: int = 1) -> list:
+    """Returns the JSON-RPC commands fading a bulb into a preset, e.g. a wake-up light.
+    The whole fade runs on the bulb as a single color flow, so nothing is sent while it runs.
+    Raises PresetExc if the preset cannot be faded into.
+
+    Parameters:
+    -----------
+    preset: dict
+        Preset data as returned by Preset.get(). CT, RGB and HSV presets are faded in
+        from the start brightness, an off preset fades the bulb out.
+    duration: int
+        Fade duration in seconds.
+    start: int
+        Brightness the fade starts from.
+    """
+
+    if not isinstance(preset, dict):
+        raise PresetExc('Invalid preset: ' + str(preset))
+    duration = _number(duration, 1, 86400, 'fade duration') * 1000
+    mode = preset.get('mode')
+    value = preset.get('value')
+
+    if preset.get('brightness') == 0:
+        return [('set_power', ['off', 'smooth', duration])]
+
+    brightness = _number(preset.get('brightness'), 1, 100, 'brightness')
+    start = _number(start, 1, brightness, 'start brightness')
+    if mode == 'CT':
+        flow_mode, color = _FLOW_MODES['ct'], _number(value, 1700, 6500, 'color temperature')
+    elif mode == 'RGB':
+        flow_mode, color = _FLOW_MODES['rgb'], _rgb(value)
+    elif mode == 'HSV':
+        if not isinstance(value, (list, tuple)) or len(value) != 2:
+            raise PresetExc('Invalid HSV color: ' + str(value))
+        rgb = colorsys.hsv_to_rgb(_number(value[0], 0, 359, 'hue') / 360, _number(value[1], 0, 100, 'saturation') / 100, 1)
+        flow_mode, color = _FLOW_MODES['rgb'], _rgb([round(channel * 255) for channel in rgb])
+    else:
+        raise PresetExc('Cannot fade into a ' + str(mode) + ' preset')
+
+    # jump to the start brightness, then ramp up in steps of at most _FADE_STEP
+    steps = -(-duration // _FADE_STEP)
+    expression = [50, flow_mode, color, start]
+    for step in range(1, steps + 1):
+        expression += [duration * step // steps - duration * (step - 1) // steps, flow_mode, color,
+                       start + (brightness - start) * step // steps]
+    return [('set_scene', ['cf', steps + 1, FLOW_ACTIONS['stay'], ','.join(str(part) for part in expression)])]
+
+def is_applied(commands: list, state: dict) -> bool:
+    """Returns True if a bulb in the given state would not be changed by the commands.
+    Only an off preset and steady CT, RGB and HSV presets can be already applied,
+    color flows and states which were not read are always sent.
+
+    Parameters:
+    -----------
+    commands: list
+        Commands as returned by compile_preset().
+    state: dict
+        State of the bulb as returned by Bulb.probe() or the state tracker.
+    """
+
+    if state == None or len(commands) != 1 or state.get('reachable') == False:
+        return False
+    method, params = commands[0]
+    if method == 'set_power':
+        return params[0] == 'off' and state.get('power') == 'off'
+    if method != 'set_scene' or state.get('power') != 'on' or state.get('flowing') != 0:
+        return False
+
+    kind = params[0]
+    if kind == 'ct':
+        return state.get('color_mode') == 2 and [state.get('ct'), state.get('brightness')] == params[1:]
+    elif kind == 'color':
+        rgb = state.get('rgb')
+        return (state.get('color_mode') == 1 and rgb != None and state.get('brightness') == params[2]
+                and (rgb[0] << 16 | rgb[1] << 8 | rgb[2]) == params[1])
+    elif kind == 'hsv':
+        return state.get('color_mode') == 3 and [state.get('hue'), state.get('sat'), state.get('brightness')] == params[1:]
+    return False
+
+def _integers(text: str, what: str) -> list:
+    """Returns comma separated integers typed by the user."""
+
+    try:
+        return [int(part) for part in text.split(',')]
+    except ValueError:
+        raise PresetExc('Invalid ' + what + ': ' + text)
+
+def parse_transitions(text: str) -> list:
+    """Parses flow transitions typed by the user, e.g.
+    '1000 ct 2700 100; 1000 rgb 255,0,0 50; 500 sleep'.
+    Returns a list of transitions for a FLOW preset value.
+    """
+
+    transitions = []
+    for part in text.split(';'):
+        fields = part.split()
+        if len(fields) == 0:
+            continue
+        if len(fields) not in (2, 4):
+            raise PresetExc('Invalid flow transition: ' + part.strip())
+        transition = [_integers(fields[0], 'transition duration')[0], fields[1]]
+        if len(fields) == 4:
+            color = _integers(fields[2], 'transition color')
+            transition += [color if fields[1] == 'rgb' else color[0], _integers(fields[3], 'brightness')[0]]
+        transitions.append(transition)
+    if len(transitions) == 0:
+        raise PresetExc('No transitions given')
+    return transitions
+
+def parse_preset(mode: str, value: str = '', brightness: str = '100', count: str = '0', action: str = 'recover') -> dict:
+    """Builds preset data from text typed by the user. Does not validate the ranges, see compile_preset().
+
+    Parameters:
+    -----------
+    mode: str
+        OFF, CT, RGB, HSV or FLOW.
+    value: str
+        Color temperature, 'r,g,b', 'hue,saturation' or flow transitions, see parse_transitions().
+    brightness: str
+        Brightness 1-100, not used by OFF and FLOW.
+    count: str
+        Number of flow repetitions, 0 - forever.
+    action: str
+        What the bulb does after a finite flow: recover, stay or off.
+    """
+
+    mode = mode.upper()
+    if mode == 'OFF':
+        return {'brightness': 0}
+    if mode == 'FLOW':
+        return {'mode': 'FLOW', 'value': {'count': _integers(count, 'flow count')[0], 'action': action,
+                                          'transitions': parse_transitions(value)}}
+    brightness = _integers(brightness, 'brightness')[0]
+    if mode == 'CT':
+        return {'brightness': brightness, 'mode': 'CT', 'value': _integers(value, 'color temperature')[0]}
+    elif mode in ('RGB', 'HSV'):
+        return {'brightness': brightness, 'mode': mode, 'value': _integers(value, mode + ' color')}
+    raise PresetExc('Unknown preset mode: ' + mode)
+
+class Preset():
+    """A class to represent a list of presets saved in the database.
+    Every preset is validated and compiled into bulb commands when it is saved.
 
     Methods:
     --------
     get(name)
         Return preset data by name.
+    commands(name)
+        Return compiled commands of a preset.
     list()
         Return a list of all presets names.
+    print_list()
+        Prints a formatted list of presets.
+    add(name, preset)
+        Saves a new preset.
+    remove(name)
+        Removes a preset.
+    subscribe(callback)
+        Calls back with a preset name whenever the preset changes.
     """
 
-    __list = {
+    # saved into an empty database
+    defaults = {
         'off': {'brightness': 0},
         'dim': {'brightness': 1, 'mode': 'CT', 'value': 1700},
         'warm': {'brightness': 100, 'mode': 'CT', 'value': 2700},
@@ -33,24 +281,140 @@ class Preset():
         'red_dim': {'brightness': 1, 'mode': 'RGB', 'value': [255, 0, 0]}
         }
 
+    def __init__(self, conn, cursor):
+        """
+        Parameters:
+        ----------
+        conn:
+            Connection object for SQLite connection.
+        cursor:
+            Cursor object for SQLite connection.
+        """
+
+        self.__cursor = cursor
+        self.__conn = conn
+        self.__presets = None # name -> (data, commands), loaded on first use
+        self.__names = None
+        self.__listeners = []
+
+        # create db table if not exists
+        self.__cursor.execute('''CREATE TABLE IF NOT EXISTS presets (
+                    name TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    commands TEXT NOT NULL
+                    );''')
+        if self.__cursor.execute('SELECT COUNT(*) FROM presets;').fetchone()[0] == 0:
+            self.__cursor.executemany('INSERT INTO presets (name, data, commands) VALUES (?,?,?);',
+                                      [(name, json.dumps(preset), json.dumps(compile_preset(preset)))
+                                       for name, preset in self.defaults.items()])
+        self.__conn.commit()
+
+    def __load(self):
+        """Loads the presets if they are not loaded, returns them."""
+
+        presets = self.__presets
+        if presets == None:
+            presets = {}
+            for name, data, commands in self.__cursor.execute('SELECT name, data, commands FROM presets ORDER BY rowid;'):
+                presets[name] = (json.loads(data), [(method, params) for method, params in json.loads(commands)])
+            self.__names = list(presets.keys())
+            self.__presets = presets
+        return presets
+
+    def __changed(self, name: str):
+        """Reloads the presets and notifies listeners about a changed preset."""
+
+        self.__presets = None
+        for callback in self.__listeners:
+            callback(name)
+
+    def subscribe(self, callback):
+        """Registers a callable taking a preset name, called after the preset changes."""
+
+        self.__listeners.append(callback)
+
     def get(self, name: str) -> dict:
         """Returns a dictionary with preset data.
-        
+        The compiled commands of the preset are included under the commands key.
+
         Parameters:
         -----------
         name: str
             Name of a preset
         """
-        
-        if name not in self.__list.keys():
-            raise PresetExc('No preset with such name: ' + name)
-        else:
-            return self.__list.get(name)
+
+        preset = self.__load().get(name)
+        if preset == None:
+            raise PresetExc('No preset with such name: ' + str(name))
+        return dict(preset[0], commands=preset[1])
+
+    def commands(self, name: str) -> list:
+        """Returns the compiled commands of a preset, see compile_preset().
+
+        Parameters:
+        -----------
+        name: str
+            Name of a preset
+        """
+
+        preset = self.__load().get(name)
+        if preset == None:
+            raise PresetExc('No preset with such name: ' + str(name))
+        return preset[1]
 
     def list(self) -> list:
-        """Returns preset list."""
+        """Returns preset list. The list is shared, do not modify it."""
 
-        presets = []
-        for preset in self.__list.keys():
-            presets.append(preset)
-        return presets
+        self.__load()
+        return self.__names
+
+    def print_list(self):
+        """Prints a formatted list of presets."""
+
+        for name, (data, commands) in self.__load().items():
+            if data.get('brightness') == 0:
+                details = 'off'
+            elif data.get('mode') == 'FLOW':
+                details = 'FLOW  {0} transition(s), count: {1}, then {2}'.format(
+                    len(data['value']['transitions']), data['value'].get('count', 0) or 'forever', data['value'].get('action', 'recover'))
+            else:
+                details = '{0:<6}{1:<18}bright: {2}'.format(data.get('mode'), str(data.get('value')), data.get('brightness'))
+            print('{0:<15}{1}'.format(name, details))
+
+    def add(self, name: str, preset: dict):
+        """Validates, compiles and saves a new preset.
+
+        Parameters:
+        -----------
+        name: str
+            Name of the new preset.
+        preset: dict
+            Preset data, see compile_preset().
+        """
+
+        if name == '':
+            raise PresetExc('Preset name cannot be empty')
+        if name in self.__load():
+            raise PresetExc('Preset with this name already exists: ' + name)
+        preset = {key: value for key, value in preset.items() if key != 'commands'}
+        commands = compile_preset(preset)
+        self.__cursor.execute('INSERT INTO presets (name, data, commands) VALUES (?,?,?);',
+                              (name, json.dumps(preset), json.dumps(commands)))
+        self.__conn.commit()
+        self.__changed(name)
+
+    def remove(self, name: str):
+        """Removes a preset.
+
+        Parameters:
+        -----------
+        name: str
+            Name of the preset to remove.
+        """
+
+        self.__cursor.execute('DELETE FROM presets WHERE name = ?;', (name,))
+        removed = self.__cursor.rowcount > 0
+        self.__conn.commit()
+        if not removed:
+            raise PresetExc('No preset with such name: ' + name)
+        self.__changed(name)
@@ -0,0 +1,246 @@
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+class Registry():
+    """A class to represent the table of saved bulbs.
+    Keeps an in-memory name <-> ip map which is reloaded after every write.
+
+    Methods:
+    --------
+    ip(name)
+        Returns ip of the bulb.
+    name(ip)
+        Returns name of the bulb.
+    names()
+        Returns a list of bulbs names.
+    items()
+        Returns a list of (name, ip) pairs of bulbs with a known ip.
+    parked()
+        Returns a list of names of bulbs without a known ip.
+    find_by_id(bulb_id)
+        Returns name of the bulb with a device id.
+    ids()
+        Returns a dict of device id -> bulb name.
+    add(name, ip, bulb_id)
+        Saves a new bulb.
+    set_id(name, bulb_id)
+        Saves the device id of a bulb.
+    move(ips, absent)
+        Changes ip addresses of bulbs.
+    remove(name)
+        Removes a bulb.
+    invalidate()
+        Drops the in-memory map.
+    subscribe(callback)
+        Calls back with a bulb name whenever the bulb is added or removed.
+    """
+
+    def __init__(self, conn, cursor):
+        """
+        Parameters:
+        ----------
+        conn:
+            Connection object for SQLite connection.
+        cursor:
+            Cursor object for SQLite connection.
+        """
+
+        self.__cursor = cursor
+        self.__conn = conn
+        self.__maps = None # (name -> ip, ip -> name, id -> name), replaced as a whole
+        self.__listeners = []
+
+        # create db table if not exists, ip is NULL while a bulb which went away is not found again
+        self.__cursor.execute('''CREATE TABLE IF NOT EXISTS bulbs (
+                    name TEXT PRIMARY KEY,
+                    ip TEXT
+                    );''')
+        columns = {column[1]: column for column in self.__cursor.execute('PRAGMA table_info(bulbs);')}
+        if columns['ip'][3]: # NOT NULL in older databases
+            self.__migrate('id' in columns)
+        try:
+            self.__cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS bulbs_ip ON bulbs (ip);')
+        except sqlite3.IntegrityError:
+            # older databases may hold one ip under several names, the user decides which to remove,
+            # add() still refuses taken ips and the index is created on the next start
+            for ip, names in self.__cursor.execute('''SELECT ip, group_concat(name, ', ') FROM bulbs
+                        GROUP BY ip HAVING count(*) > 1 ORDER BY ip;'''):
+                logger.warning('Bulbs %s share the ip %s, remove all but one of them', names, ip)
+        # device id reported by discovery, stays the same when the router changes the ip
+        if 'id' not in [column[1] for column in self.__cursor.execute('PRAGMA table_info(bulbs);')]:
+            self.__cursor.execute('ALTER TABLE bulbs ADD COLUMN id TEXT;')
+        self.__cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS bulbs_id ON bulbs (id);')
+        self.__conn.commit()
+
+    def __migrate(self, with_id: bool):
+        """Rebuilds the bulbs table of an older database with a nullable ip column."""
+
+        # the table is replaced, so triggers on it are saved and created again
+        triggers = [sql for sql, in self.__cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'bulbs';")]
+        self.__cursor.execute('BEGIN;')
+        try:
+            self.__cursor.execute('''CREATE TABLE bulbs_new (
+                        name TEXT PRIMARY KEY,
+                        ip TEXT,
+                        id TEXT
+                        );''')
+            self.__cursor.execute('INSERT INTO bulbs_new (name, ip, id) SELECT name, ip, {0} FROM bulbs ORDER BY rowid;'
+                                  .format('id' if with_id else 'NULL'))
+            self.__cursor.execute('DROP TABLE bulbs;')
+            self.__cursor.execute('ALTER TABLE bulbs_new RENAME TO bulbs;')
+            for sql in triggers:
+                self.__cursor.execute(sql)
+        except Exception:
+            self.__conn.rollback()
+            raise
+        self.__conn.commit()
+
+    def __load(self):
+        """Loads the name <-> ip map if it is not loaded, returns the maps."""
+
+        maps = self.__maps
+        if maps == None:
+            bulbs = self.__cursor.execute('SELECT name, ip, id FROM bulbs ORDER BY rowid;').fetchall()
+            maps = ({name: ip for name, ip, bulb_id in bulbs},
+                    {ip: name for name, ip, bulb_id in bulbs if ip != None},
+                    {bulb_id: name for name, ip, bulb_id in bulbs if bulb_id != None})
+            self.__maps = maps
+        return maps
+
+    def invalidate(self):
+        """Drops the in-memory map, next lookup reloads it from the database."""
+
+        self.__maps = None
+
+    def subscribe(self, callback):
+        """Registers a callable taking a bulb name, called after the bulb changes."""
+
+        self.__listeners.append(callback)
+
+    def notify(self, name: str):
+        """Reloads the map and notifies listeners about a changed bulb.
+        Used when the bulbs table is changed through another connection.
+        """
+
+        self.__changed(name)
+
+    def __changed(self, name: str):
+        """Reloads the map and notifies listeners about a changed bulb."""
+
+        self.invalidate()
+        for callback in self.__listeners:
+            callback(name)
+
+    def ip(self, name: str) -> str:
+        """Returns ip of the bulb or None if bulb is not found or parked."""
+
+        return self.__load()[0].get(name)
+
+    def name(self, ip: str) -> str:
+        """Returns name of the bulb or None if bulb is not found."""
+
+        return self.__load()[1].get(ip)
+
+    def names(self) -> list:
+        """Returns a list of bulbs names."""
+
+        return list(self.__load()[0].keys())
+
+    def items(self) -> list:
+        """Returns a list of (name, ip) pairs of bulbs with a known ip."""
+
+        return [(name, ip) for name, ip in self.__load()[0].items() if ip != None]
+
+    def parked(self) -> list:
+        """Returns a list of names of bulbs which went away and have no known ip."""
+
+        return [name for name, ip in self.__load()[0].items() if ip == None]
+
+    def find_by_id(self, bulb_id: str) -> str:
+        """Returns name of the bulb with a device id or None if bulb is not found."""
+
+        return self.__load()[2].get(bulb_id)
+
+    def ids(self) -> dict:
+        """Returns a dictionary of device id -> bulb name of bulbs with a known id."""
+
+        return dict(self.__load()[2])
+
+    def add(self, name: str, ip: str, bulb_id: str = None) -> bool:
+        """Saves a new bulb.
+        Returns False if the name, the ip or the device id is already taken.
+        """
+
+        if ip in self.__load()[1]:
+            return False
+        try:
+            self.__cursor.execute('INSERT INTO bulbs (name, ip, id) VALUES (?,?,?);', (name, ip, bulb_id))
+        except sqlite3.IntegrityError:
+            return False
+        self.__conn.commit()
+        self.__changed(name)
+        return True
+
+    def remove(self, name: str) -> bool:
+        """Removes a bulb.
+        Returns False if there is no bulb with such name.
+        """
+
+        self.__cursor.execute('DELETE FROM bulbs WHERE name = ?;', (name,))
+        removed = self.__cursor.rowcount > 0
+        self.__conn.commit()
+        self.__changed(name)
+        return removed
+
+    def set_id(self, name: str, bulb_id: str) -> bool:
+        """Saves the device id of a bulb.
+        Returns False if there is no such bulb or the id belongs to another bulb.
+        """
+
+        try:
+            self.__cursor.execute('UPDATE bulbs SET id = ? WHERE name = ?;', (bulb_id, name))
+        except sqlite3.IntegrityError:
+            return False
+        updated = self.__cursor.rowcount > 0
+        self.__conn.commit()
+        self.invalidate()
+        return updated
+
+    def move(self, ips: dict, absent: list = ()) -> list:
+        """Changes ip addresses of bulbs in a single transaction.
+        Bulbs may swap addresses with each other.
+
+        Parameters:
+        -----------
+        ips:
+            Dictionary of bulb name -> new ip.
+        absent:
+            Names of bulbs known not to be at their ip any more, e.g. not found by discovery.
+            A bulb moving onto the ip of an absent bulb takes it over, the absent bulb
+            is parked without an ip until it is found again.
+
+        Returns a list of names which were not moved because their new ip
+        belongs to a bulb which is not moved.
+        """
+
+        by_name, by_ip = self.__load()[:2]
+        moving = {name: ip for name, ip in ips.items() if name in by_name and by_name[name] != ip}
+        # the router gave the ip of a bulb which went away to a moving one
+        parked = {by_ip[ip]: None for ip in moving.values()
+                  if ip in by_ip and by_ip[ip] in absent and by_ip[ip] not in moving}
+        moving.update(parked)
+        taken = {ip for name, ip in by_name.items() if name not in moving and ip != None}
+        conflicts = [name for name, ip in moving.items() if ip in taken]
+        for name in conflicts:
+            del moving[name]
+
+        # two steps, so bulbs which swapped addresses do not collide
+        self.__cursor.executemany('UPDATE bulbs SET ip = ? WHERE name = ?;', [('moving:' + name, name) for name in moving])
+        self.__cursor.executemany('UPDATE bulbs SET ip = ? WHERE name = ?;', [(ip, name) for name, ip in moving.items()])
+        self.__conn.commit()
+        for name in moving:
+            self.__changed(name)
+        return conflicts
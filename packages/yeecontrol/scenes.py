@@ -1,5 +1,11 @@
 import json
-import yeelight
+import time
+
+from . import parallel
+from .jsonstream import ObjectWriter, iter_object
+from .plans import PlanCache
+from .presets import PresetExc, compile_fade, is_applied
+from .state import OFFLINE
 
 class SceneExc(Exception):
     """Generic exception for the Scene class."""
@@ -16,20 +22,37 @@ class Scene():
 
     list()
         Returns a list of scene names.
+    settings(name)
+        Returns bulb -> preset settings of a scene.
+    find_by_bulb(bulb)
+        Returns a list of scenes using a bulb.
+    find_by_preset(preset)
+        Returns a list of scenes using a preset.
     print_list()
         Prints a formatted list of scenes.
     add(name, bulbs, presets)
         Adds a new preset.
     remove(name)
         Removes a named preset
-    set(name, bulbs, presets)
-        Sets bulbs to a named preset.
-    export()
+    set(name, bulbs, presets, deadline, synchronized, diff)
+        Sets bulbs to a named preset, returns a per-bulb report.
+    fade(name, bulbs, presets, duration, deadline)
+        Fades bulbs into a scene, returns a per-bulb report.
+    targets(name, bulbs, presets)
+        Returns the bulbs of a scene to be sent commands.
+    prepare(bulbs, presets)
+        Compiles all scenes ahead of their first use.
+    plan_stats()
+        Returns compiled scene plan counters.
+    export(filename)
         Exports scenes to a JSON file.
-    load(filename)
+    load(filename, policy)
         Imports scenes from a JSON file.
     """
 
+    # what to do with imported scenes which are already saved
+    policies = ('skip', 'overwrite', 'rename')
+
     def __init__(self, conn, cursor):
         """
         Parameters:
@@ -42,33 +65,144 @@ class Scene():
 
         self.__cursor = cursor
         self.__conn = conn
-        # create db table if not exitsts
+        self.__plans = PlanCache()
+        self.__watched = set() # ids of Bulb and Preset objects which invalidate plans
+        # cascading removal of scene members needs foreign keys enabled
+        self.__cursor.execute('PRAGMA foreign_keys = ON;')
+        self.__migrate()
+        self.__create_tables()
+        # scenes may use bulbs which are not saved (e.g. imported ones), so members
+        # reference bulbs by name only and are removed together with the bulb
+        if self.__cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bulbs';").fetchone():
+            self.__cursor.execute('''CREATE TRIGGER IF NOT EXISTS bulbs_remove_scene_members AFTER DELETE ON bulbs
+                    BEGIN DELETE FROM scene_members WHERE bulb = OLD.name; END;''')
+        self.__conn.commit()
+
+    def __create_tables(self):
+        """Creates db tables if not exist."""
+
         self.__cursor.execute('''CREATE TABLE IF NOT EXISTS scenes (
-                    name TEXT PRIMARY KEY,
-                    settings TEXT NOT NULL
+                    name TEXT PRIMARY KEY
                     );''')
+        self.__cursor.execute('''CREATE TABLE IF NOT EXISTS scene_members (
+                    scene TEXT NOT NULL REFERENCES scenes (name) ON DELETE CASCADE ON UPDATE CASCADE,
+                    bulb TEXT NOT NULL,
+                    preset TEXT NOT NULL,
+                    PRIMARY KEY (scene, bulb)
+                    );''')
+        self.__cursor.execute('CREATE INDEX IF NOT EXISTS scene_members_bulb ON scene_members (bulb);')
+        self.__cursor.execute('CREATE INDEX IF NOT EXISTS scene_members_preset ON scene_members (preset);')
+
+    def __migrate(self):
+        """Moves scene settings stored as JSON in the scenes table into scene_members."""
+
+        columns = [column[1] for column in self.__cursor.execute('PRAGMA table_info(scenes);')]
+        if 'settings' not in columns:
+            return
+
+        # parse everything before the schema is touched, a bad row leaves the old table as it is
+        scenes = []
+        for name, settings in self.__cursor.execute('SELECT name, settings FROM scenes ORDER BY rowid;').fetchall():
+            try:
+                settings = json.loads(settings)
+                if not isinstance(settings, dict):
+                    raise ValueError(settings)
+            except (TypeError, ValueError):
+                raise SceneExc('Cannot migrate scene ' + str(name) + ', its settings are not valid JSON: ' + str(settings)[:80])
+            scenes.append((name, settings))
+
+        # DDL is not wrapped into a transaction by sqlite3 on its own
+        if self.__conn.in_transaction:
+            self.__conn.commit()
+        self.__cursor.execute('BEGIN;')
+        try:
+            self.__cursor.execute('DROP TABLE scenes;')
+            self.__create_tables()
+            self.__cursor.executemany('INSERT INTO scenes (name) VALUES (?)', [(name,) for name, settings in scenes])
+            self.__cursor.executemany('INSERT INTO scene_members (scene, bulb, preset) VALUES (?,?,?)',
+                [(name, bulb, preset) for name, settings in scenes for bulb, preset in settings.items()])
+        except BaseException:
+            self.__conn.rollback()
+            raise
+        self.__conn.commit()
+
+    def __exists(self, name: str) -> bool:
+        """Returns True if a scene with such name is saved."""
+
+        return self.__cursor.execute('SELECT 1 FROM scenes WHERE name = ?;', (name,)).fetchone() != None
 
     def list(self) -> list:
         """Returns a list of all scene names."""
 
         scenes = []
-        for scene in self.__cursor.execute('SELECT name FROM scenes;'):
+        for scene in self.__cursor.execute('SELECT name FROM scenes ORDER BY rowid;'):
             scenes.append(scene[0])
         return scenes
 
+    def settings(self, name: str) -> dict:
+        """Returns a dictionary of bulb name -> preset name of a scene.
+
+        Parameters:
+        -----------
+        name
+            Name of the scene.
+        """
+
+        if not self.__exists(name):
+            raise SceneExc('No scene with such name: ' + name)
+        return dict(self.__cursor.execute('SELECT bulb, preset FROM scene_members WHERE scene = ? ORDER BY rowid;', (name,)))
+
+    def find_by_bulb(self, bulb: str) -> list:
+        """Returns a list of names of the scenes which use a bulb.
+
+        Parameters:
+        -----------
+        bulb
+            Name of the bulb.
+        """
+
+        return [scene[0] for scene in self.__cursor.execute('SELECT scene FROM scene_members WHERE bulb = ? ORDER BY scene;', (bulb,))]
+
+    def find_by_preset(self, preset: str) -> list:
+        """Returns a list of names of the scenes which use a preset.
+
+        Parameters:
+        -----------
+        preset
+            Name of the preset.
+        """
+
+        return [scene[0] for scene in self.__cursor.execute('SELECT DISTINCT scene FROM scene_members WHERE preset = ? ORDER BY scene;', (preset,))]
+
+    def __members(self):
+        """Yields (scene name, settings) of all scenes from a single query, ordered by name."""
+
+        name = None
+        settings = {}
+        for scene, bulb, preset in self.__conn.execute('''SELECT scenes.name, bulb, preset FROM scenes
+                    LEFT JOIN scene_members ON scene_members.scene = scenes.name
+                    ORDER BY scenes.name, scene_members.rowid;'''):
+            if scene != name:
+                if name != None:
+                    yield name, settings
+                name = scene
+                settings = {}
+            if bulb != None: # a scene left without bulbs
+                settings[bulb] = preset
+        if name != None:
+            yield name, settings
+
     def print_list(self):
         """Prints a formatted list of all scenes."""
 
         if len(self.list()) == 0:
             raise SceneExc('No scenes saved.')
-        for scene in self.__cursor.execute('SELECT name, settings FROM scenes;'):
-            print('{0:<15}'.format(scene[0] + ':'), end='')
-            settings = json.loads(scene[1])
+        for scene, settings in self.__members():
+            print('{0:<15}'.format(scene + ':'), end='')
             for bulb in settings.keys():
                 print('  ', bulb, ':', settings.get(bulb), end='')
             print()
 
-    #TODO change settings sctructure saved into the DB : affects print_list() and set()
     def add(self, name: str, bulbs: object, presets: object):
         """Adds a new scene.
 
@@ -85,7 +219,7 @@ class Scene():
         settings = {}
         if len(bulbs.list()) == 0:
             raise SceneExc('No bulbs to add to a scene')
-        if name in self.list():
+        if self.__exists(name):
             raise SceneExc('Scene with this name already exists: ' + name)
        
         for bulb in bulbs.list():
@@ -107,7 +241,9 @@ class Scene():
         if len(settings.keys()) == 0:
             raise SceneExc('Cannot save an empty scene!')
 
-        self.__cursor.execute('INSERT INTO scenes (name, settings) VALUES (?,?)', (name, json.dumps(settings)))
+        self.__cursor.execute('INSERT INTO scenes (name) VALUES (?)', (name,))
+        self.__cursor.executemany('INSERT INTO scene_members (scene, bulb, preset) VALUES (?,?,?)',
+            [(name, bulb, preset) for bulb, preset in settings.items()])
         self.__conn.commit()
 
     def remove(self, name: str):
@@ -119,14 +255,18 @@ class Scene():
             Name of the scene.
         """
 
-        if name not in self.list():
+        if not self.__exists(name):
             raise SceneExc('No scene with such name: ' + name)
         else:
+            # members are removed by the foreign key cascade
             self.__cursor.execute('DELETE FROM scenes WHERE name = ?;', (name,))
             self.__conn.commit()
+            self.__plans.invalidate_scene(name)
 
-    def set(self, name: str, bulbs: object, presets: object):
+    def set(self, name: str, bulbs: object, presets: object, deadline: float = 5.0, synchronized: bool = False,
+            diff: bool = False) -> dict:
         """Sets bulbs to a named preset.
+        All bulbs of the scene are set at once.
 
         Parameters:
         -----------
@@ -136,79 +276,276 @@ class Scene():
             Bulb class object.
         presets
             Preset class object.
+        deadline
+            Time limit in seconds for setting all of the bulbs.
+        synchronized
+            Stage connections and payloads of all bulbs first and release them at once,
+            so the bulbs change together. Latencies are then measured from the release,
+            parallel.skew() of the report tells how far apart the bulbs changed.
+        diff
+            Send commands only to bulbs which are not in their preset already,
+            judged by their last known states, see Bulb.known_states().
+
+        Returns a report as a dictionary of bulb name -> result.
+        See parallel.run_all() for the result structure. Bulbs left out by a diff
+        are reported ok with the number of skipped commands under the skipped key,
+        parallel.skipped() of the report sums them up.
+
+        The scene is compiled into a plan of ready-to-send commands on first use,
+        later calls only send the cached plan.
+        Bulbs which the state tracker or the circuit breaker know to be offline
+        are reported without being sent to.
         """
 
-        if len(self.list()) == 0:
-            raise SceneExc('No scenes saved!')
-        if name not in self.list():
-            raise SceneExc('No scene with such name: ' + name)
-        
-        unavailable = False
+        t0 = time.monotonic()
+        targets, report = self.targets(name, bulbs, presets)
+        if diff:
+            # reading the unknown states takes at most half of the deadline
+            targets = self.__changed(targets, bulbs, report, deadline / 2)
+            deadline -= time.monotonic() - t0
+            skipped = parallel.skipped(report)
+            if skipped:
+                bulbs.metrics.inc('yeelight_commands_skipped_total', skipped, scene=name)
+        if synchronized:
+            try:
+                report.update(bulbs.synchronizer.send_synchronized({bulb: (ip, commands) for bulb, ip, commands in targets},
+                                                                   deadline))
+            finally:
+                for bulb, ip, commands in targets:
+                    bulbs.invalidate(ip)
+        else:
+            tasks = {bulb: lambda ip=ip, commands=commands: bulbs.send(ip, commands) for bulb, ip, commands in targets}
+            report.update(parallel.run_all(tasks, deadline))
+        self.__record(name, bulbs, report, t0)
+        return report
+
+    def __changed(self, targets: list, bulbs: object, report: dict, deadline: float) -> list:
+        """Returns the targets whose bulbs are not in their preset, the rest is reported as skipped."""
+
+        states = bulbs.known_states([ip for bulb, ip, commands in targets], deadline=deadline)
+        changed = []
+        for bulb, ip, commands in targets:
+            if is_applied(commands, states.get(ip)):
+                report[bulb] = {'status': parallel.OK, 'latency': 0.0, 'skipped': len(commands)}
+            else:
+                changed.append((bulb, ip, commands))
+        return changed
+
+    def __record(self, name: str, bulbs: object, report: dict, t0: float):
+        """Records the time and the skew of setting a scene into the metrics of bulbs."""
+
+        bulbs.metrics.observe('yeelight_scene_seconds', time.monotonic() - t0, scene=name)
+        skew = parallel.skew(report)
+        if skew != None:
+            bulbs.metrics.observe('yeelight_scene_skew_seconds', skew, scene=name)
+
+    def fade(self, name: str, bulbs: object, presets: object, duration: int, deadline: float = 5.0) -> dict:
+        """Fades bulbs into their presets of a scene, e.g. a wake-up light.
+        Every bulb runs its fade as a color flow, see compile_fade().
 
-        for scene in self.__cursor.execute('SELECT name, settings FROM scenes;'):
-            if scene[0] == name:
-                settings = json.loads(scene[1])
-                for bulb in settings.keys():
-                    try:
-                        bulbs.set(bulb, presets.get(settings.get(bulb)))
-                    except yeelight.main.BulbException:
-                        unavailable = True
+        Parameters:
+        -----------
+        name
+            Name of the scene to fade into.
+        bulbs
+            Bulb class object.
+        presets
+            Preset class object.
+        duration
+            Fade duration in seconds.
+        deadline
+            Time limit in seconds for starting the fade on all of the bulbs.
 
-        if unavailable:
-            raise SceneExc('Some bulbs were unavailable.')
+        Returns a report in the format of set().
+        """
 
-    def export(self):
-        """Exports all saved scenes to a scenes-export.json file."""
+        t0 = time.monotonic()
+        targets, report = self.targets(name, bulbs, presets)
+        settings = self.settings(name)
+        tasks = {}
+        for bulb, ip, commands in targets:
+            try:
+                commands = compile_fade(presets.get(settings[bulb]), duration)
+            except PresetExc as e:
+                report[bulb] = {'status': parallel.ERROR, 'latency': 0.0, 'error': e.message}
+                continue
+            tasks[bulb] = lambda ip=ip, commands=commands: bulbs.send(ip, commands)
+        report.update(parallel.run_all(tasks, deadline))
+        self.__record(name, bulbs, report, t0)
+        return report
+
+    def targets(self, name: str, bulbs: object, presets: object) -> tuple:
+        """Returns the bulbs of a scene which should be sent commands.
+
+        Returns a tuple of a list of (bulb name, ip, commands) entries and a report
+        of bulbs which cannot be set, in the format of set().
+        """
+
+        plan = self.__plans.get(name)
+        if plan == None:
+            plan = self.__compile(name, bulbs, presets)
+
+        tracker = bulbs.tracker
+        targets = []
+        report = {}
+        for bulb, ip, commands in plan:
+            if ip == None: # commands hold the reason the bulb cannot be set
+                report[bulb] = {'status': parallel.ERROR, 'latency': 0.0, 'error': commands}
+            elif tracker != None and tracker.status(ip) == OFFLINE or not bulbs.health.allow(ip):
+                report[bulb] = {'status': parallel.ERROR, 'latency': 0.0, 'error': 'Bulb is offline'}
+            else:
+                targets.append((bulb, ip, commands))
+        return targets, report
+
+    def prepare(self, bulbs: object, presets: object) -> int:
+        """Compiles all scenes which are not compiled yet, so their first set() only sends commands.
+        Returns the number of compiled scenes.
+        """
+
+        compiled = 0
+        for name in self.list():
+            if self.__plans.get(name) == None:
+                self.__compile(name, bulbs, presets)
+                compiled += 1
+        return compiled
+
+    def __compile(self, name: str, bulbs: object, presets: object) -> list:
+        """Compiles a scene into a plan of (bulb name, ip, commands) entries and caches it.
+        Bulbs which cannot be set get an entry with ip None and an error message instead of commands.
+        """
+
+        if id(bulbs) not in self.__watched:
+            # plans hold bulb ips, drop them when bulbs change
+            bulbs.registry.subscribe(self.__plans.invalidate_bulb)
+            self.__watched.add(id(bulbs))
+        if id(presets) not in self.__watched:
+            # plans hold preset commands, drop them when presets change
+            presets.subscribe(self.__plans.invalidate_preset)
+            self.__watched.add(id(presets))
+
+        settings = self.settings(name)
+        plan = []
+        for bulb, preset in settings.items():
+            ip = bulbs.find_by_name(bulb)
+            if ip == None:
+                plan.append((bulb, None, bulbs.missing(bulb)))
+                continue
+            try:
+                plan.append((bulb, ip, presets.commands(preset)))
+            except PresetExc as e:
+                plan.append((bulb, None, e.message))
+
+        self.__plans.put(name, plan, settings)
+        return plan
+
+    def plan_stats(self) -> dict:
+        """Returns the number of compiled scene plans, cache hits and misses."""
+
+        return self.__plans.stats()
+
+    def export(self, filename: str = 'scenes-export.json'):
+        """Exports all saved scenes to a JSON file, writing one scene at a time.
+
+        Parameters:
+        -----------
+        filename
+            Name of a file to export scenes to.
+        """
 
         if len(self.list()) == 0: # checking if there are any scenes
             raise SceneExc('No scenes to export!')
-        scenes = {}
-        for scene in self.__cursor.execute('SELECT name, settings FROM scenes;'):
-            settings = json.loads(scene[1])
-            scenes.update({scene[0]: settings})
 
-        with open('scenes-export.json', 'w') as outfile: # saving scenes to JSON
-            json.dump(scenes, outfile, sort_keys=True, indent=4)
+        with open(filename, 'w') as outfile: # saving scenes to JSON
+            writer = ObjectWriter(outfile)
+            for scene, settings in self.__members():
+                writer.write(scene, settings)
+            writer.close()
 
-    def load(self, filename):
-        """Imports scenes from a JSON file.
+    def load(self, filename: str, policy: str = 'skip', batch: int = 1000) -> int:
+        """Imports scenes from a JSON file in a single transaction.
+        The file is read incrementally and scenes are inserted in batches.
 
         Parameters:
         -----------
         filename
             Name of a file to import scenes from.
+        policy
+            What to do with scenes which are already saved:
+            - skip - keep the saved scene
+            - overwrite - replace the saved scene
+            - rename - import the scene under a new name, e.g. 'warm (2)'
+        batch
+            Number of scenes inserted at a time.
+
+        Returns the number of scenes imported.
         """
 
-        with open(filename, 'r') as infile: 
-            try: # checking if a file is a valid json
-                scenes = json.load(infile)
-            except json.JSONDecodeError:
-                raise SceneExc('Corrupted data in file: ' + filename)
+        if policy not in self.policies:
+            raise SceneExc('No import policy with such name: ' + policy)
 
-        found_empty = False
-        found_duplicate = False
+        names = set(self.list()) # one read for all duplicate checks
+        imported = set()
+        pending = {} # scene -> settings, a scene repeated in the file is imported from its last entry
+        found_empty = 0
+        found_duplicate = 0
         scenes_added = 0
 
-        for scene in scenes.keys():
-            if len (scenes.get(scene).keys()) == 0:
-                found_empty = False
-                continue # skip if settings are empty
-            if scene in self.list():
-                found_duplicate = True
-                continue # skip if preset is already on the list
-
-            self.__cursor.execute('INSERT INTO scenes (name, settings) VALUES (?,?)', (scene, json.dumps(scenes.get(scene))))
-            self.__conn.commit()
-            scenes_added += 1
+        def flush():
+            if policy == 'overwrite':
+                for scene in pending:
+                    self.__plans.invalidate_scene(scene)
+                self.__cursor.executemany('DELETE FROM scene_members WHERE scene = ?;', [(scene,) for scene in pending])
+                self.__cursor.executemany('INSERT OR IGNORE INTO scenes (name) VALUES (?)', [(scene,) for scene in pending])
+            else:
+                self.__cursor.executemany('INSERT INTO scenes (name) VALUES (?)', [(scene,) for scene in pending])
+            self.__cursor.executemany('INSERT INTO scene_members (scene, bulb, preset) VALUES (?,?,?)',
+                [(scene, bulb, preset) for scene, settings in pending.items() for bulb, preset in settings.items()])
+            pending.clear()
+
+        try:
+            with open(filename, 'r') as infile: 
+                for scene, settings in iter_object(infile):
+                    if not isinstance(settings, dict) or not all(isinstance(v, str) for v in settings.values()):
+                        raise SceneExc('Corrupted data in file: ' + filename)
+                    if len(settings.keys()) == 0:
+                        found_empty += 1
+                        continue # skip if settings are empty
+                    if scene in names:
+                        found_duplicate += 1
+                        if policy == 'skip':
+                            continue # skip if scene is already on the list
+                        elif policy == 'rename':
+                            n = 2
+                            while scene + ' (' + str(n) + ')' in names:
+                                n += 1
+                            scene = scene + ' (' + str(n) + ')'
+
+                    names.add(scene)
+                    pending[scene] = settings
+                    if scene not in imported:
+                        imported.add(scene)
+                        scenes_added += 1
+                    if len(pending) >= batch:
+                        flush()
+            flush()
+        except json.JSONDecodeError:
+            self.__conn.rollback()
+            raise SceneExc('Corrupted data in file: ' + filename)
+        except BaseException:
+            self.__conn.rollback()
+            raise
+        self.__conn.commit()
 
-        if found_empty or found_duplicate or scenes_added == 0:
-            message = ''
+        if found_empty or (found_duplicate and policy == 'skip') or scenes_added == 0:
+            message = str(scenes_added) + ' scene(s) imported. '
             
             if scenes_added == 0:
-                message += 'No new scenes added. '
+                message = 'No new scenes added. '
             if found_empty:
-                message += 'Skipped empty scene(s). '
-            if found_duplicate:
-                message += 'Skipped duplicate(s). '
+                message += 'Skipped ' + str(found_empty) + ' empty scene(s). '
+            if found_duplicate and policy == 'skip':
+                message += 'Skipped ' + str(found_duplicate) + ' duplicate(s). '
 
             raise SceneExc(message)
+
+        return scenes_added
@@ -0,0 +1,630 @@
+"""Timed scenes and fades.
+
+Rules are cron expressions (minute hour day month weekday), e.g. '30 6 * * 1-5',
+or times relative to the sun, e.g. 'sunrise', 'sunset-30', 'sunrise+15'.
+Jobs set a scene or a bulb, optionally fading into it over a number of seconds.
+
+Usage:
+    python -m packages.yeecontrol.schedule --db yeelight-control.db --latitude 50.06 --longitude 19.94
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from .bulbs import Bulb, BulbExc
+from .dispatch import Dispatcher
+from .health import HealthMonitor
+from .pool import BulbPool
+from .presets import Preset, PresetExc, compile_fade
+from .scenes import Scene, SceneExc
+
+logger = logging.getLogger(__name__)
+
+class ScheduleExc(Exception):
+    """Generic exception for the Schedule class."""
+    def __init__(self, message, head="ScheduleException", ):
+        super().__init__(message)
+        self.head = head
+        self.message = message
+
+# cron fields: (low, high, names)
+_CRON_FIELDS = (
+    (0, 59, None),
+    (0, 23, None),
+    (1, 31, None),
+    (1, 12, ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec')),
+    (0, 7, ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'))
+    )
+
+def _cron_value(text: str, low: int, names: tuple) -> int:
+    """Returns a single value of a cron field, a number or a name."""
+
+    if names != None and text.lower() in names:
+        return names.index(text.lower()) + low
+    try:
+        return int(text)
+    except ValueError:
+        raise ScheduleExc('Invalid cron value: ' + text)
+
+def _cron_field(text: str, low: int, high: int, names: tuple) -> set:
+    """Returns the set of values matched by a cron field, e.g. '*/15', '1-5', 'mon,wed,fri'."""
+
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = _cron_value(step, 0, None)
+            if step < 1:
+                raise ScheduleExc('Invalid cron step: ' + text)
+        if part == '*':
+            first, last = low, high
+        elif '-' in part:
+            first, last = [_cron_value(value, low, names) for value in part.split('-', 1)]
+        else:
+            first = _cron_value(part, low, names)
+            last = high if step > 1 else first
+        if not low <= first <= last <= high:
+            raise ScheduleExc('Invalid cron field: ' + text + ', expected ' + str(low) + '-' + str(high))
+        values.update(range(first, last + 1, step))
+    return values
+
+class CronRule():
+    """A class to represent a cron expression: minute hour day month weekday.
+    Weekdays are 0-7 (0 and 7 are Sunday). If both the day and the weekday
+    are restricted, either of them matches, as in cron.
+
+    Methods:
+    --------
+    next(after)
+        Returns the first matching minute after a local time.
+    """
+
+    def __init__(self, expression: str):
+        """
+        Parameters:
+        ----------
+        expression:
+            Cron expression of five fields.
+        """
+
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ScheduleExc('Cron expression needs 5 fields: ' + expression)
+        self.expression = expression
+        minutes, hours, days, months, weekdays = [_cron_field(field, *spec) for field, spec in zip(fields, _CRON_FIELDS)]
+        self.__minutes = sorted(minutes)
+        self.__hours = sorted(hours)
+        self.__days = days
+        self.__months = months
+        self.__weekdays = {weekday % 7 for weekday in weekdays}
+        self.__any_day = fields[2] == '*'
+        self.__any_weekday = fields[4] == '*'
+
+    def __match_day(self, day: date) -> bool:
+        if day.month not in self.__months:
+            return False
+        in_days = day.day in self.__days
+        in_weekdays = (day.weekday() + 1) % 7 in self.__weekdays
+        if self.__any_day or self.__any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next(self, after: datetime) -> datetime:
+        """Returns the first matching minute after a naive local time, None if it never matches."""
+
+        after = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = after.date()
+        for i in range(366 * 8): # long enough for Feb 29 on a given weekday
+            if self.__match_day(day):
+                for hour in self.__hours:
+                    if day == after.date() and hour < after.hour:
+                        continue
+                    for minute in self.__minutes:
+                        if day == after.date() and hour == after.hour and minute < after.minute:
+                            continue
+                        return datetime(day.year, day.month, day.day, hour, minute)
+            day += timedelta(days=1)
+        return None
+
+    def __str__(self):
+        return self.expression
+
+def sun_times(day: date, latitude: float, longitude: float) -> tuple:
+    """Returns the sunrise and sunset of a day at a location as UTC datetimes.
+    Either is None when the sun does not rise or set that day (polar day or night).
+    Accurate to a minute or two, which is plenty for lights.
+    """
+
+    zenith = math.radians(90.833) # the upper limb of the sun touching the horizon, refraction included
+    lng_hour = longitude / 15
+    n = day.timetuple().tm_yday
+    times = []
+    for rising in (True, False):
+        t = n + ((6 if rising else 18) - lng_hour) / 24
+        m = 0.9856 * t - 3.289
+        l = (m + 1.916 * math.sin(math.radians(m)) + 0.020 * math.sin(math.radians(2 * m)) + 282.634) % 360
+        ra = math.degrees(math.atan(0.91764 * math.tan(math.radians(l)))) % 360
+        ra = (ra + math.floor(l / 90) * 90 - math.floor(ra / 90) * 90) / 15 # same quadrant as l
+        sin_dec = 0.39782 * math.sin(math.radians(l))
+        cos_dec = math.cos(math.asin(sin_dec))
+        cos_h = (math.cos(zenith) - sin_dec * math.sin(math.radians(latitude))) / (cos_dec * math.cos(math.radians(latitude)))
+        if not -1 <= cos_h <= 1:
+            times.append(None)
+            continue
+        h = math.degrees(math.acos(cos_h))
+        h = (360 - h if rising else h) / 15
+        ut = (h + ra - 0.06571 * t - 6.622 - lng_hour) % 24
+        # keep the event on the given day of the local solar time
+        solar = ut + lng_hour
+        shift = -24 if solar >= 24 else 24 if solar < 0 else 0
+        times.append(datetime(day.year, day.month, day.day, tzinfo=timezone.utc) + timedelta(hours=ut + shift))
+    return tuple(times)
+
+class SunRule():
+    """A class to represent a time relative to the sunrise or the sunset, e.g. 'sunset-30'.
+
+    Methods:
+    --------
+    next(after)
+        Returns the first event after a local time.
+    """
+
+    events = ('sunrise', 'sunset')
+
+    def __init__(self, expression: str, latitude: float, longitude: float):
+        """
+        Parameters:
+        ----------
+        expression:
+            sunrise or sunset, optionally followed by an offset in minutes, e.g. sunrise+15.
+        latitude:
+            Latitude of the location in degrees, north positive.
+        longitude:
+            Longitude of the location in degrees, east positive.
+        """
+
+        self.expression = expression
+        text = expression.replace(' ', '').lower()
+        event = [event for event in self.events if text.startswith(event)]
+        if len(event) == 0:
+            raise ScheduleExc('Invalid sun rule: ' + expression)
+        event = event[0]
+        if latitude == None or longitude == None:
+            raise ScheduleExc('Sun rules need the latitude and longitude of the location')
+        offset = text[len(event):]
+        try:
+            self.offset = timedelta(minutes=int(offset) if offset else 0)
+        except ValueError:
+            raise ScheduleExc('Invalid sun rule offset: ' + expression)
+        self.__index = self.events.index(event)
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def next(self, after: datetime) -> datetime:
+        """Returns the first event after a naive local time, None if the sun does not rise or set for a year."""
+
+        day = after.date() - timedelta(days=1) # the offset may move the event across midnight
+        for i in range(368):
+            event = sun_times(day, self.latitude, self.longitude)[self.__index]
+            if event != None:
+                event = (event + self.offset).astimezone().replace(tzinfo=None, second=0, microsecond=0)
+                if event > after:
+                    return event
+            day += timedelta(days=1)
+        return None
+
+    def __str__(self):
+        return self.expression
+
+def parse_rule(text: str, latitude: float = None, longitude: float = None) -> object:
+    """Returns a CronRule or a SunRule parsed from text typed by the user."""
+
+    if text.strip().lower().startswith(SunRule.events):
+        return SunRule(text.strip(), latitude, longitude)
+    return CronRule(text)
+
+class Schedule():
+    """A class to represent scheduled jobs saved in the database.
+    A job sets a scene or a bulb to a preset, optionally fading into it.
+
+    Methods:
+    --------
+    list()
+        Returns a list of job names.
+    jobs()
+        Returns a dict of job name -> job.
+    print_list()
+        Prints a formatted list of jobs with their next run.
+    add(name, rule, job)
+        Saves a new job.
+    remove(name)
+        Removes a job.
+    claim(name, when)
+        Marks a run as taken, returns False if another process took it.
+    ran(name, when, error)
+        Saves the outcome of a job run.
+    """
+
+    def __init__(self, conn, cursor, latitude: float = None, longitude: float = None):
+        """
+        Parameters:
+        ----------
+        conn:
+            Connection object for SQLite connection.
+        cursor:
+            Cursor object for SQLite connection.
+        latitude:
+            Latitude of the location in degrees, needed by sun rules.
+        longitude:
+            Longitude of the location in degrees, needed by sun rules.
+        """
+
+        self.__cursor = cursor
+        self.__conn = conn
+        self.latitude = latitude
+        self.longitude = longitude
+        # create db table if not exists
+        self.__cursor.execute('''CREATE TABLE IF NOT EXISTS schedules (
+                    name TEXT PRIMARY KEY,
+                    rule TEXT NOT NULL,
+                    job TEXT NOT NULL,
+                    last_run REAL,
+                    last_error TEXT
+                    );''')
+        self.__conn.commit()
+
+    def list(self) -> list:
+        """Returns a list of all job names."""
+
+        return [job[0] for job in self.__cursor.execute('SELECT name FROM schedules ORDER BY name;')]
+
+    def jobs(self) -> dict:
+        """Returns a dictionary of job name -> job, where job is a dict with:
+        - rule - rule text, see parse_rule()
+        - scene or bulb and preset - what to set
+        - fade - fade duration in seconds, 0 - set at once
+        - last_run - timestamp of the last run, None if it never ran
+        - last_error - error of the last run, None if it succeeded
+        """
+
+        return {name: dict(json.loads(job), rule=rule, last_run=last_run, last_error=last_error)
+                for name, rule, job, last_run, last_error in
+                self.__cursor.execute('SELECT name, rule, job, last_run, last_error FROM schedules ORDER BY name;')}
+
+    def print_list(self):
+        """Prints a formatted list of all jobs with their next run."""
+
+        jobs = self.jobs()
+        if len(jobs) == 0:
+            raise ScheduleExc('No jobs scheduled.')
+        now = datetime.now()
+        for name, job in jobs.items():
+            try:
+                next_run = parse_rule(job['rule'], self.latitude, self.longitude).next(now)
+            except ScheduleExc:
+                next_run = None
+            target = 'scene ' + job['scene'] if 'scene' in job else job['bulb'] + ' -> ' + job['preset']
+            if job.get('fade'):
+                target += ', fade ' + str(job['fade'] // 60) + ' min'
+            print('{0:<15}{1:<20}{2:<18}{3}'.format(name, job['rule'], next_run.strftime('%Y-%m-%d %H:%M') if next_run else 'never', target))
+
+    def add(self, name: str, rule: str, job: dict):
+        """Validates and saves a new job.
+
+        Parameters:
+        -----------
+        name: str
+            Name of the new job.
+        rule: str
+            Cron expression or sun rule, see parse_rule().
+        job: dict
+            {'scene': name} or {'bulb': name, 'preset': name}, with an optional 'fade' in seconds.
+        """
+
+        if name == '':
+            raise ScheduleExc('Job name cannot be empty')
+        if ('scene' in job) == ('bulb' in job) or 'bulb' in job and 'preset' not in job:
+            raise ScheduleExc('Job needs either a scene or a bulb and a preset')
+        if parse_rule(rule, self.latitude, self.longitude).next(datetime.now()) == None:
+            raise ScheduleExc('Rule never matches: ' + rule)
+        job = {key: job[key] for key in ('scene', 'bulb', 'preset', 'fade') if job.get(key)}
+        try:
+            self.__cursor.execute('INSERT INTO schedules (name, rule, job) VALUES (?,?,?);', (name, rule, json.dumps(job)))
+        except sqlite3.IntegrityError:
+            raise ScheduleExc('Job with this name already exists: ' + name)
+        self.__conn.commit()
+
+    def remove(self, name: str):
+        """Removes a job.
+
+        Parameters:
+        -----------
+        name: str
+            Name of the job to remove.
+        """
+
+        self.__cursor.execute('DELETE FROM schedules WHERE name = ?;', (name,))
+        removed = self.__cursor.rowcount > 0
+        self.__conn.commit()
+        if not removed:
+            raise ScheduleExc('No job with such name: ' + name)
+
+    def claim(self, name: str, when: float) -> bool:
+        """Marks the run of a job scheduled at a given timestamp as taken.
+        Returns False if the run was taken already, e.g. by the daemon and the menu
+        both running the scheduler, so every run is done by a single process.
+        """
+
+        self.__cursor.execute('UPDATE schedules SET last_run = ? WHERE name = ? AND (last_run IS NULL OR last_run < ?);',
+                              (when, name, when))
+        claimed = self.__cursor.rowcount > 0
+        self.__conn.commit()
+        return claimed
+
+    def ran(self, name: str, when: float, error: str = None):
+        """Saves the time and the error (None - success) of a job run."""
+
+        self.__cursor.execute('UPDATE schedules SET last_run = ?, last_error = ? WHERE name = ?;', (when, error, name))
+        self.__conn.commit()
+
+def _definition(job: dict) -> dict:
+    """Returns a job without the outcome of its last run."""
+
+    return {key: value for key, value in job.items() if key not in ('last_run', 'last_error')}
+
+class Scheduler():
+    """A class to represent running scheduled jobs in the background.
+    Pending runs are kept in a heap, so the thread only wakes up when the
+    earliest job is due, or every refresh seconds to pick up jobs changed
+    in the database by another connection or process.
+
+    Methods:
+    --------
+    start()
+        Starts running jobs in a background thread.
+    reload()
+        Picks up changed jobs at once.
+    pending()
+        Returns the upcoming runs.
+    stop()
+        Stops the background thread.
+    """
+
+    def __init__(self, db_path: str, latitude: float = None, longitude: float = None, pool=None, dispatcher=None,
+                 health=None, metrics=None, journal=None, refresh: float = 60.0, grace: float = 300.0):
+        """
+        Parameters:
+        ----------
+        db_path:
+            Path of the database. The scheduler uses its own connection, so it can run in its own thread.
+        latitude:
+            Latitude of the location in degrees, needed by sun rules.
+        longitude:
+            Longitude of the location in degrees, needed by sun rules.
+        pool:
+            BulbPool shared with the application.
+        dispatcher:
+            Dispatcher shared with the application, so scheduled commands count against the bulb quotas.
+        health:
+            HealthMonitor shared with the application.
+        metrics:
+            Metrics shared with the application.
+        journal:
+            Journal shared with the application.
+        refresh:
+            Time in seconds between checks for jobs changed in the database.
+        grace:
+            Time in seconds a run may be late (e.g. after a suspend) and still run.
+        """
+
+        self.db_path = db_path
+        self.latitude = latitude
+        self.longitude = longitude
+        self.refresh = refresh
+        self.grace = grace
+        self.__shared = (pool, dispatcher, health, metrics, journal)
+
+        self.__lock = threading.Condition()
+        self.__heap = [] # (timestamp, job name)
+        self.__jobs = {} # job name -> (rule, job, timestamp of the next run)
+        self.__version = None # data_version of the database when the jobs were loaded
+        self.__reload = True
+        self.__stopped = False
+        self.__thread = None
+
+    def __load(self, schedule: Schedule, conn):
+        """Reloads the jobs and rebuilds the heap."""
+
+        self.__version = conn.execute('PRAGMA data_version;').fetchone()[0]
+        now = datetime.now()
+        with self.__lock:
+            previous = self.__jobs
+        jobs = {}
+        for name, job in schedule.jobs().items():
+            kept = previous.get(name)
+            if kept != None and _definition(kept[1]) == _definition(job):
+                # keep the pending run, it may be due already and a next run from now would skip it
+                jobs[name] = (kept[0], job, kept[2])
+                continue
+            try:
+                rule = parse_rule(job['rule'], self.latitude, self.longitude)
+            except ScheduleExc as e:
+                logger.warning('Schedule: job %s skipped: %s', name, e.message)
+                continue
+            next_run = rule.next(now)
+            if next_run != None:
+                jobs[name] = (rule, job, next_run.timestamp())
+        heap = [(when, name) for name, (rule, job, when) in jobs.items()]
+        heapq.heapify(heap)
+        with self.__lock:
+            self.__jobs = jobs
+            self.__heap = heap
+        logger.info('Schedule: %d job(s) loaded', len(jobs))
+
+    def __run_job(self, name: str, job: dict, bulbs: Bulb, presets: Preset, scenes: Scene):
+        """Runs a single job, returns an error message or None."""
+
+        try:
+            if 'scene' in job:
+                if job.get('fade'):
+                    report = scenes.fade(job['scene'], bulbs, presets, job['fade'])
+                else:
+                    report = scenes.set(job['scene'], bulbs, presets)
+                failed = {bulb: result.get('error', result['status']) for bulb, result in report.items() if result['status'] != 'ok'}
+                if failed:
+                    return 'Failed bulbs: ' + ', '.join(bulb + ' (' + error + ')' for bulb, error in failed.items())
+            elif job.get('fade'):
+                bulbs.set(job['bulb'], {'commands': compile_fade(presets.get(job['preset']), job['fade'])})
+            else:
+                bulbs.set(job['bulb'], presets.get(job['preset']))
+        except (BulbExc, PresetExc, SceneExc) as e:
+            return e.message
+        except Exception as e:
+            logger.exception('Schedule: job %s failed', name)
+            return str(e)
+        return None
+
+    def __due(self) -> list:
+        """Pops the runs which are due and schedules their next runs.
+        Returns a list of (job name, job, timestamp of the run).
+        """
+
+        due = []
+        with self.__lock:
+            now = time.time()
+            while self.__heap and self.__heap[0][0] <= now:
+                when, name = heapq.heappop(self.__heap)
+                entry = self.__jobs.get(name)
+                if entry == None or entry[2] != when:
+                    continue # removed or rescheduled
+                rule, job, when = entry
+                next_run = rule.next(max(datetime.fromtimestamp(when), datetime.now()))
+                if next_run == None:
+                    del self.__jobs[name]
+                else:
+                    self.__jobs[name] = (rule, job, next_run.timestamp())
+                    heapq.heappush(self.__heap, (next_run.timestamp(), name))
+                due.append((name, job, when))
+        return due
+
+    def __run(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        pool, dispatcher, health, metrics, journal = self.__shared
+        own_pool = pool == None
+        pool = pool if pool != None else BulbPool(metrics=metrics)
+        dispatcher = dispatcher if dispatcher != None else Dispatcher(pool)
+        own_health = health == None
+        health = health if health != None else HealthMonitor()
+        schedule = Schedule(conn, cursor, self.latitude, self.longitude)
+
+        try:
+            while True:
+                with self.__lock:
+                    if self.__stopped:
+                        return
+                    reload = self.__reload
+                    self.__reload = False
+                if reload or conn.execute('PRAGMA data_version;').fetchone()[0] != self.__version:
+                    # the application may have changed any table, start with fresh caches
+                    bulbs = Bulb(conn, cursor, pool, dispatcher, health=health, metrics=metrics, journal=journal)
+                    presets = Preset(conn, cursor)
+                    scenes = Scene(conn, cursor)
+                    self.__load(schedule, conn)
+
+                for name, job, when in self.__due():
+                    if time.time() - when > self.grace:
+                        logger.warning('Schedule: job %s missed its run at %s', name, datetime.fromtimestamp(when))
+                        continue
+                    if not schedule.claim(name, when):
+                        logger.info('Schedule: job %s run at %s taken by another process', name, datetime.fromtimestamp(when))
+                        continue
+                    error = self.__run_job(name, job, bulbs, presets, scenes)
+                    if error == None:
+                        logger.info('Schedule: job %s done', name)
+                    else:
+                        logger.warning('Schedule: job %s failed: %s', name, error)
+                    schedule.ran(name, time.time(), error)
+
+                with self.__lock:
+                    if not self.__stopped and not self.__reload:
+                        wait = self.refresh
+                        if self.__heap:
+                            wait = min(wait, self.__heap[0][0] - time.time())
+                        if wait > 0:
+                            self.__lock.wait(wait)
+        finally:
+            if own_health:
+                health.stop()
+            if own_pool:
+                pool.close_all()
+            conn.close()
+
+    def start(self):
+        """Starts running jobs in a background thread."""
+
+        with self.__lock:
+            self.__stopped = False
+            self.__reload = True
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def reload(self):
+        """Reloads the jobs at once instead of at the next refresh."""
+
+        with self.__lock:
+            self.__reload = True
+            self.__lock.notify()
+
+    def pending(self) -> list:
+        """Returns a list of (datetime, job name) of the upcoming runs, the earliest first."""
+
+        with self.__lock:
+            return sorted((datetime.fromtimestamp(when), name) for name, (rule, job, when) in self.__jobs.items())
+
+    def stop(self):
+        """Stops the background thread."""
+
+        with self.__lock:
+            self.__stopped = True
+            self.__lock.notify()
+        if self.__thread != None:
+            self.__thread.join()
+            self.__thread = None
+
+def main():
+    parser = argparse.ArgumentParser(description='Run scheduled Yeelight scenes and fades.')
+    parser.add_argument('--db', default='yeelight-control.db', help='database path')
+    parser.add_argument('--latitude', type=float, help='latitude of the location for sun rules')
+    parser.add_argument('--longitude', type=float, help='longitude of the location for sun rules')
+    parser.add_argument('--list', action='store_true', help='print the jobs with their next run and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(name)s:%(levelname)s:%(asctime)s:%(message)s')
+    if args.list:
+        conn = sqlite3.connect(args.db)
+        try:
+            Schedule(conn, conn.cursor(), args.latitude, args.longitude).print_list()
+        except ScheduleExc as e:
+            print(e.message)
+        conn.close()
+        return
+
+    scheduler = Scheduler(args.db, args.latitude, args.longitude)
+    scheduler.start()
+    try:
+        while True:
+            threading.Event().wait(3600)
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+import json
+import socket
+import threading
+import time
+
+def _shutdown(sock):
+    """Closes a socket, interrupting a thread blocked on it."""
+
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+class StateCache():
+    """A class to represent recently read bulb states keyed by bulb ip.
+    Entries older than the TTL are treated as missing.
+
+    Methods:
+    --------
+    get(ip, max_age)
+        Returns a cached state or None.
+    put(ip, state)
+        Saves a state.
+    invalidate(ip)
+        Drops a state.
+    """
+
+    def __init__(self, ttl: float = 5.0):
+        """
+        Parameters:
+        ----------
+        ttl:
+            Time in seconds a state is considered valid.
+        """
+
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__states = {} # ip -> (state, time saved)
+
+    def get(self, ip: str, max_age: float = None) -> dict:
+        """Returns a copy of the cached state or None if it is missing or too old.
+
+        Parameters:
+        -----------
+        ip:
+            IP address of the bulb.
+        max_age:
+            Maximum age of the state in seconds, defaults to the TTL.
+        """
+
+        if max_age == None:
+            max_age = self.ttl
+        with self.__lock:
+            entry = self.__states.get(ip)
+        if entry == None or time.monotonic() - entry[1] > max_age:
+            return None
+        return dict(entry[0])
+
+    def put(self, ip: str, state: dict):
+        """Saves a state of the bulb."""
+
+        with self.__lock:
+            self.__states[ip] = (dict(state), time.monotonic())
+
+    def invalidate(self, ip: str = None):
+        """Drops a state of the bulb, or all states if ip is not given."""
+
+        with self.__lock:
+            if ip == None:
+                self.__states.clear()
+            else:
+                self.__states.pop(ip, None)
+
+# tracked bulb statuses
+ONLINE = 'online' # the listening connection is open, the state is current
+STALE = 'stale' # the connection was lost, the state is the last one known
+OFFLINE = 'offline' # the bulb cannot be connected
+
+# properties read from the bulbs, color_mode, hue, sat and flowing tell whether a preset is already set
+PROPERTIES = ['power', 'bright', 'ct', 'rgb', 'color_mode', 'hue', 'sat', 'flowing']
+
+def _parse(props: dict) -> dict:
+    """Converts bulb properties to the state structure used by Bulb.status_all()."""
+
+    # pushes carry numbers, get_prop replies strings, '' for properties the bulb does not have,
+    # 0 is a valid value (not flowing, hue 0, sat 0)
+    state = {}
+    if props.get('power') not in (None, ''):
+        state['power'] = props['power']
+    if props.get('bright') not in (None, ''):
+        state['brightness'] = int(props['bright'])
+    if props.get('ct') not in (None, ''):
+        state['ct'] = int(props['ct'])
+    if props.get('rgb') not in (None, ''):
+        rgb = int(props['rgb'])
+        state['rgb'] = (rgb >> 16 & 0xff, rgb >> 8 & 0xff, rgb & 0xff)
+    for prop in ('color_mode', 'hue', 'sat', 'flowing'):
+        if props.get(prop) not in (None, ''):
+            state[prop] = int(props[prop])
+    return state
+
+class StateTracker():
+    """A class to represent bulb states pushed by the bulbs themselves.
+    Holds a listening connection to every watched bulb and updates the state
+    from the props notifications the bulb sends whenever its state changes.
+    A keepalive request on the same connection detects bulbs which went away
+    without closing the connection.
+
+    Methods:
+    --------
+    watch(ip)
+        Starts tracking a bulb.
+    unwatch(ip)
+        Stops tracking a bulb.
+    sync(ips)
+        Tracks exactly the given bulbs.
+    get(ip)
+        Returns the tracked state of a bulb or None.
+    status(ip)
+        Returns online, stale, offline or None if the bulb is not tracked.
+    stop()
+        Stops tracking all bulbs.
+    """
+
+    properties = PROPERTIES
+
+    def __init__(self, port: int = 55443, keepalive: float = 30.0, timeout: float = 5.0, retry: float = 10.0,
+                 quota=None):
+        """
+        Parameters:
+        ----------
+        port:
+            Control port of the bulbs.
+        keepalive:
+            Time in seconds of silence after which the bulb is asked for its state.
+        timeout:
+            Time in seconds to wait for a connection or a keepalive response.
+        retry:
+            Time in seconds between connection attempts to an offline bulb.
+        quota:
+            Dispatcher whose bulb quotas the keepalive requests are taken from, may be set later.
+            Keepalives are not limited if not given.
+        """
+
+        self.port = port
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.retry = retry
+        self.quota = quota
+
+        self.__lock = threading.Lock()
+        self.__states = {} # ip -> state dict
+        self.__sockets = {} # ip -> listening socket
+        self.__stops = {} # ip -> Event stopping the listener
+
+    def watch(self, ip: str):
+        """Starts tracking a bulb, does nothing if it is already tracked."""
+
+        with self.__lock:
+            if ip in self.__stops:
+                return
+            stop = threading.Event()
+            self.__stops[ip] = stop
+            self.__states[ip] = {'ip': ip, 'power': None, 'brightness': None, 'ct': None, 'rgb': None,
+                                 'reachable': False, 'rtt': None, 'status': STALE, 'updated': None}
+        threading.Thread(target=self.__listen, args=(ip, stop), daemon=True).start()
+
+    def unwatch(self, ip: str):
+        """Stops tracking a bulb and drops its state."""
+
+        with self.__lock:
+            stop = self.__stops.pop(ip, None)
+            sock = self.__sockets.pop(ip, None)
+            self.__states.pop(ip, None)
+        if stop != None:
+            stop.set()
+        if sock != None:
+            _shutdown(sock)
+
+    def sync(self, ips):
+        """Tracks the given bulbs and stops tracking all others."""
+
+        ips = set(ips)
+        with self.__lock:
+            watched = set(self.__stops)
+        for ip in watched - ips:
+            self.unwatch(ip)
+        for ip in ips - watched:
+            self.watch(ip)
+
+    def get(self, ip: str) -> dict:
+        """Returns a copy of the tracked state or None if the bulb is not tracked.
+        The state has the keys of a Bulb.status_all() snapshot, status and updated
+        (time.monotonic() of the last notification or response).
+        """
+
+        with self.__lock:
+            state = self.__states.get(ip)
+            return None if state == None else dict(state)
+
+    def status(self, ip: str) -> str:
+        """Returns online, stale, offline or None if the bulb is not tracked."""
+
+        with self.__lock:
+            state = self.__states.get(ip)
+            return None if state == None else state['status']
+
+    def stop(self):
+        """Stops tracking all bulbs."""
+
+        self.sync(())
+
+    def __update(self, ip: str, stop, **changes):
+        """Updates a tracked state unless the bulb is no longer tracked."""
+
+        with self.__lock:
+            if not stop.is_set() and ip in self.__states:
+                self.__states[ip].update(changes)
+
+    def __listen(self, ip: str, stop):
+        """Keeps a listening connection to a bulb until stopped."""
+
+        while not stop.is_set():
+            try:
+                sock = socket.create_connection((ip, self.port), self.timeout)
+            except OSError:
+                self.__update(ip, stop, status=OFFLINE, reachable=False)
+                stop.wait(self.retry)
+                continue
+            with self.__lock:
+                if stop.is_set():
+                    sock.close()
+                    return
+                self.__sockets[ip] = sock
+            try:
+                self.__read(ip, sock, stop)
+            except (OSError, ValueError):
+                pass
+            with self.__lock:
+                if self.__sockets.get(ip) is sock:
+                    del self.__sockets[ip]
+            sock.close()
+            # keep the last known values until the bulb answers again
+            self.__update(ip, stop, status=STALE, reachable=False)
+
+    def __read(self, ip: str, sock, stop):
+        """Reads notifications from a connected bulb, returns when the connection is lost."""
+
+        sock.settimeout(min(1.0, self.timeout))
+        buffer = b''
+        cmd_id = 0
+        sent = None # time the pending keepalive was sent
+        last = 0.0 # time of the last message from the bulb, 0 asks for the state at once
+        while not stop.is_set():
+            now = time.monotonic()
+            if sent != None and now - sent > self.timeout:
+                return # no response to the keepalive
+            if sent == None and now - last >= self.keepalive:
+                wait = self.quota.take(ip) if self.quota != None else 0.0
+                if wait > 0:
+                    last = now - self.keepalive + wait # the keepalive counts against the bulb quota, ask later
+                    continue
+                cmd_id += 1
+                request = {'id': cmd_id, 'method': 'get_prop', 'params': self.properties}
+                sock.sendall((json.dumps(request) + '\r\n').encode('utf8'))
+                sent = now
+
+            try:
+                data = sock.recv(16 * 1024)
+            except socket.timeout:
+                continue
+            if not data:
+                return # closed by the bulb
+            last = time.monotonic()
+            buffer += data
+            *lines, buffer = buffer.split(b'\r\n')
+            for line in lines:
+                if not line:
+                    continue
+                message = json.loads(line.decode('utf8'))
+                if message.get('method') == 'props':
+                    self.__update(ip, stop, status=ONLINE, reachable=True, updated=last,
+                                  **_parse(message.get('params', {})))
+                elif message.get('id') == cmd_id and sent != None:
+                    if 'result' in message:
+                        props = dict(zip(self.properties, message['result']))
+                        self.__update(ip, stop, status=ONLINE, reachable=True, updated=last,
+                                      rtt=last - sent, **_parse(props))
+                    # an error (e.g. quota exceeded) still shows the bulb is alive
+                    sent = None
@@ -0,0 +1,121 @@
+class ZoneExc(Exception):
+    """Generic exception for the Zone class."""
+    def __init__(self, message, head="ZoneException", ):
+        super().__init__(message)
+        self.head = head
+        self.message = message
+
+class Zone():
+    """A class to represent the ambient light zone map.
+    Each bulb is assigned a screen region, stored as fractions of the screen size.
+
+    Attributes:
+    -----------
+    regions: dict
+        Named screen regions as (left, top, right, bottom) fractions.
+
+    Methods:
+    --------
+    list()
+        Returns a list of bulbs with a zone.
+    map()
+        Returns a dict of bulb name -> region.
+    print_list()
+        Prints a formatted list of zones.
+    add(bulb, region)
+        Assigns a screen region to a bulb.
+    remove(bulb)
+        Removes the zone of a bulb.
+    """
+
+    regions = {
+        'full': (0.0, 0.0, 1.0, 1.0),
+        'left': (0.0, 0.0, 0.25, 1.0),
+        'right': (0.75, 0.0, 1.0, 1.0),
+        'top': (0.0, 0.0, 1.0, 0.25),
+        'bottom': (0.0, 0.75, 1.0, 1.0),
+        'center': (0.25, 0.25, 0.75, 0.75),
+        'top-left': (0.0, 0.0, 0.5, 0.5),
+        'top-right': (0.5, 0.0, 1.0, 0.5),
+        'bottom-left': (0.0, 0.5, 0.5, 1.0),
+        'bottom-right': (0.5, 0.5, 1.0, 1.0)
+        }
+
+    def __init__(self, conn, cursor):
+        """
+        Parameters:
+        ----------
+        conn:
+            Connection object for SQLite connection.
+        cursor:
+            Cursor object for SQLite connection.
+        """
+
+        self.__cursor = cursor
+        self.__conn = conn
+        # create db table if not exists
+        self.__cursor.execute('''CREATE TABLE IF NOT EXISTS zones (
+                    bulb TEXT PRIMARY KEY,
+                    x0 REAL NOT NULL,
+                    y0 REAL NOT NULL,
+                    x1 REAL NOT NULL,
+                    y1 REAL NOT NULL
+                    );''')
+
+    def list(self) -> list:
+        """Returns a list of bulbs with a zone."""
+
+        return [zone[0] for zone in self.__cursor.execute('SELECT bulb FROM zones ORDER BY bulb;')]
+
+    def map(self) -> dict:
+        """Returns a dictionary of bulb name -> (left, top, right, bottom) region."""
+
+        return {zone[0]: tuple(zone[1:]) for zone in self.__cursor.execute('SELECT bulb, x0, y0, x1, y1 FROM zones ORDER BY bulb;')}
+
+    def print_list(self):
+        """Prints a formatted list of all zones."""
+
+        zones = self.map()
+        if len(zones) == 0:
+            raise ZoneExc('No zones saved.')
+        names = {region: name for name, region in self.regions.items()}
+        for bulb, region in zones.items():
+            print('{0:<15}{1:<14}{2}'.format(bulb, names.get(region, 'custom'), region))
+
+    def add(self, bulb: str, region):
+        """Assigns a screen region to a bulb, replacing its previous zone.
+
+        Parameters:
+        -----------
+        bulb:
+            Name of the bulb.
+        region:
+            Name of a region from the regions dict,
+            or a (left, top, right, bottom) tuple of screen fractions.
+        """
+
+        if isinstance(region, str):
+            if region not in self.regions.keys():
+                raise ZoneExc('No region with such name: ' + region)
+            region = self.regions.get(region)
+
+        x0, y0, x1, y1 = region
+        if not (0 <= x0 < x1 <= 1 and 0 <= y0 < y1 <= 1):
+            raise ZoneExc('Invalid region: ' + str(region))
+
+        self.__cursor.execute('INSERT OR REPLACE INTO zones (bulb, x0, y0, x1, y1) VALUES (?,?,?,?,?)', (bulb, x0, y0, x1, y1))
+        self.__conn.commit()
+
+    def remove(self, bulb: str):
+        """Removes the zone of a bulb.
+
+        Parameters:
+        -----------
+        bulb:
+            Name of the bulb.
+        """
+
+        self.__cursor.execute('DELETE FROM zones WHERE bulb = ?;', (bulb,))
+        if self.__cursor.rowcount == 0:
+            raise ZoneExc('No zone for bulb: ' + bulb)
+        self.__conn.commit()
@@ -0,0 +1,114 @@
+"""Load tests driving scenes and status against emulated bulbs.
+
+Run from the repository root:
+    python -m pytest tests
+
+The bulbs get their own loopback addresses, which are available on Linux only.
+"""
+
+import json
+import sqlite3
+import sys
+import time
+
+import pytest
+import yeelight
+
+from packages.yeecontrol import parallel
+from packages.yeecontrol.bulbs import Bulb
+from packages.yeecontrol.emulator import FakeBulb, Fleet
+from packages.yeecontrol.presets import Preset
+from packages.yeecontrol.scenes import Scene
+
+BULBS = 8
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='needs the 127.0.0.0/8 loopback range')
+
+@pytest.fixture(scope='module')
+def fleet():
+    with Fleet(BULBS, ssdp_port=0) as fleet:
+        yield fleet
+
+@pytest.fixture
+def app(fleet, tmp_path):
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    bulbs = Bulb(conn, cursor)
+    assert fleet.register(bulbs.registry) == []
+    presets = Preset(conn, cursor)
+    scenes = Scene(conn, cursor)
+
+    names = bulbs.list()
+    filename = tmp_path / 'scenes.json'
+    filename.write_text(json.dumps({
+        'warm': {name: 'warm' for name in names},
+        'split': {name: 'red' if i % 2 else 'off' for i, name in enumerate(names)},
+    }))
+    assert scenes.load(str(filename)) == 2
+
+    yield bulbs, presets, scenes
+    bulbs.close_synchronizer()
+    bulbs.pool.close_all()
+    conn.close()
+
+def test_scene_sets_every_bulb(fleet, app):
+    bulbs, presets, scenes = app
+
+    report = scenes.set('warm', bulbs, presets)
+
+    assert len(report) == BULBS
+    assert all(result['status'] == parallel.OK for result in report.values())
+    for bulb in fleet.bulbs:
+        assert bulb.state['power'] == 'on'
+        assert bulb.state['ct'] == '2700'
+
+def test_status_follows_scenes(fleet, app):
+    bulbs, presets, scenes = app
+
+    scenes.set('split', bulbs, presets)
+    bulbs.invalidate()
+    snapshot = bulbs.status_all()
+
+    assert len(snapshot) == BULBS
+    for i, name in enumerate(bulbs.list()):
+        assert snapshot[name]['reachable']
+        if i % 2:
+            assert snapshot[name]['power'] == 'on'
+            assert snapshot[name]['rgb'] == (255, 0, 0)
+        else:
+            assert snapshot[name]['power'] == 'off'
+
+def test_synchronized_scene_and_diff(fleet, app):
+    bulbs, presets, scenes = app
+
+    report = scenes.set('warm', bulbs, presets, synchronized=True)
+    assert all(result['status'] == parallel.OK for result in report.values())
+
+    commands = fleet.stats()['commands']
+    report = scenes.set('warm', bulbs, presets, diff=True)
+    assert parallel.skipped(report) > 0
+    assert fleet.stats()['commands'] - commands <= BULBS # one probe per bulb, nothing set
+
+def test_music_connection_is_not_counted():
+    bulb = FakeBulb('127.0.0.1', 0, max_connections=1)
+    bulb.start()
+    try:
+        music = yeelight.Bulb(bulb.ip, bulb.port, effect='sudden')
+        music.start_music()
+        music.set_rgb(0, 0, 255)
+
+        # the music connection leaves room for a control connection,
+        # once the bulb sees the control connection of start_music closed
+        deadline = time.monotonic() + 2.0
+        while True:
+            try:
+                props = yeelight.Bulb(bulb.ip, bulb.port).get_properties(['rgb'])
+                break
+            except yeelight.BulbException:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        assert props['rgb'] == str(255)
+        music.stop_music()
+    finally:
+        bulb.stop()
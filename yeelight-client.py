@@ -0,0 +1,3 @@
+from packages.yeecontrol.client import main
+
+main()
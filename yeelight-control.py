@@ -1,45 +1,180 @@
+import argparse
+import json
 import logging
 import sqlite3
-from time import sleep
+import sys
+from time import monotonic, sleep
 
-from yeelight.main import BulbException
-
-from packages.yeecontrol.presets import Preset, PresetExc
+# yeelight, numpy and PIL are imported only by the commands which need them
+from packages.yeecontrol import parallel
+from packages.yeecontrol.presets import Preset, PresetExc, parse_preset
 from packages.yeecontrol.bulbs import Bulb, BulbExc
+from packages.yeecontrol.discovery import DiscoveryService
+from packages.yeecontrol.dispatch import Dispatcher
+from packages.yeecontrol.journal import Journal
+from packages.yeecontrol.metrics import Metrics, MetricsServer
+from packages.yeecontrol.pool import BulbPool, pool_budget
 from packages.yeecontrol.scenes import Scene, SceneExc
-
-print('\nStarting Yeelight Control . . .')
+from packages.yeecontrol.schedule import Schedule, ScheduleExc, Scheduler
+from packages.yeecontrol.state import StateTracker
+from packages.yeecontrol.zones import Zone, ZoneExc
 
 # config
 config_db_path = "yeelight-control.db"
 config_log_path = "yeelight-control.log"
+config_pool_ttl = 60 # seconds an unused bulb connection is kept open
+config_pool_max = 2 # connections open to a single bulb, at most 4 minus the tracker and the synchronizer
+config_quota = 60 # commands accepted by a bulb per minute
+config_discovery_interval = 300 # seconds between background discovery sweeps, 0 - disabled
+config_track_state = True # keep a listening connection to every bulb instead of polling its state
+config_scene_synchronized = False # stage all bulbs of a scene and switch them at the same instant
+config_scene_diff = False # send scene commands only to bulbs which are not in their preset already
+config_scheduler = True # run scheduled jobs while the menu is open, a run taken by the daemon is not repeated
+config_latitude = None # location for sunrise and sunset rules, degrees north
+config_longitude = None # degrees east
+config_journal_path = None # append every bulb command and response to this file, None - disabled
+config_metrics_port = None # serve Prometheus metrics on this loopback port while the menu is open, None - disabled
+config_exit_delay = 0 # seconds the closing message stays on screen when the menu exits, e.g. in its own console window
+config_ambilight_fps = 10 # target frame rate of the ambient light
+config_ambilight_delta_e = 3.0 # smallest color change sent to the bulbs (CIE76 delta E)
+config_ambilight_delta_br = 2 # smallest brightness change sent to the bulbs
+config_ambilight_smoothing = 0.5 # weight of the previous color, 0 - no smoothing
 
-# database
-conn = sqlite3.connect(config_db_path)
-cursor = conn.cursor()
-
-# logger
-FORMAT = '%(name)s:%(levelname)s:%(asctime)s:%(message)s'
-logging.basicConfig(level=logging.INFO, filename=config_log_path, filemode='a', format=FORMAT)
 logger = logging.getLogger()
 
-logger.info('Starting the application')
+# application objects, created by setup()
+conn = None
+cursor = None
+tracker = None
+bulbs = None
+presets = None
+scenes = None
+zones = None
+schedule = None
+scheduler = None
+discovery = None
+metrics_server = None
+journal = None
+
+def setup(db_path, background, journal_path=None):
+    """Opens the database and creates the application objects.
+    Every bulb command is recorded into a journal at journal_path, if given.
+    Background services (state tracking, discovery, scheduler, metrics endpoint) are started only for long-running modes.
+    """
+
+    global conn, cursor, tracker, bulbs, presets, scenes, zones, schedule, scheduler, discovery, metrics_server, journal
+
+    # database
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    # init the application
+    metrics = Metrics()
+    journal = Journal(journal_path) if journal_path != None else None
+    tracked = background and config_track_state
+    # the bulbs accept only a few connections, the tracker and the synchronizer need one each
+    pool = BulbPool(ttl=config_pool_ttl, max_per_bulb=min(config_pool_max, pool_budget(tracked)), metrics=metrics)
+    dispatcher = Dispatcher(pool, quota=config_quota)
+    tracker = StateTracker(quota=dispatcher) if tracked else None
+    bulbs = Bulb(conn, cursor, pool, dispatcher, tracker, metrics=metrics, journal=journal)
+    presets = Preset(conn, cursor)
+    scenes = Scene(conn, cursor)
+    zones = Zone(conn, cursor)
+    schedule = Schedule(conn, cursor, config_latitude, config_longitude)
+
+    # background discovery keeps bulb addresses up to date
+    discovery = None
+    if background and config_discovery_interval > 0:
+        discovery = DiscoveryService(db_path, registry=bulbs.registry, interval=config_discovery_interval)
+        discovery.start()
+
+    # scheduled jobs run on their own connection, sharing the bulb connections and quotas
+    scheduler = None
+    if background and config_scheduler:
+        scheduler = Scheduler(db_path, config_latitude, config_longitude, pool, bulbs.dispatcher, bulbs.health, metrics, journal)
+        scheduler.start()
+
+    metrics_server = None
+    if background and config_metrics_port != None:
+        metrics_server = MetricsServer(metrics, config_metrics_port)
+        metrics_server.start()
+
+def teardown():
+    """Stops background services and closes bulb connections and the database."""
+
+    if metrics_server != None:
+        metrics_server.stop()
+    if scheduler != None:
+        scheduler.stop()
+    if discovery != None:
+        discovery.stop()
+    if tracker != None:
+        tracker.stop()
+    bulbs.health.stop()
+    bulbs.close_synchronizer()
+    bulbs.pool.close_all()
+    conn.close()
+    if journal != None:
+        journal.close()
+    logger.info('Scene plans: ' + str(scenes.plan_stats()))
+    for ip, stats in bulbs.dispatcher.stats().items():
+        logger.info('Commands sent to ' + ip + ': ' + str(stats))
 
-# init the application
-bulbs = Bulb(conn, cursor)
-presets = Preset()
-scenes = Scene(conn, cursor)
+def dump_stats():
+    """Prints the metrics snapshot as JSON to stderr, so it does not mix with the command output."""
+
+    print(json.dumps(bulbs.metrics.snapshot(), indent=4), file=sys.stderr)
 
 # menu
 
+def bulb_names(snapshot):
+    """Returns bulb names with their status taken from a status snapshot."""
+
+    names = []
+    for name in bulbs.list():
+        state = snapshot.get(name)
+        if state == None:
+            names.append(name)
+        elif state.get('breaker') == 'open':
+            names.append(name + ' (offline)')
+        elif state['reachable']:
+            names.append(name + ' (' + str(state['power']) + ')')
+        else:
+            names.append(name + ' (unavailable)')
+    return names
+
+def print_report(report):
+    """Prints a per-bulb report of Scene.set(), returns the number of failed bulbs."""
+
+    failed = 0
+    for bulb, result in report.items():
+        if result.get('skipped'):
+            print('{0:<15}{1:<10}{2:>11}'.format(bulb, 'skipped', '-'))
+            continue
+        print('{0:<15}{1:<10}{2:>8.0f} ms  {3}'.format(bulb, result['status'], result['latency'] * 1000, result.get('error', '')))
+        if result['status'] != 'ok':
+            failed += 1
+            logger.warning('Bulb ' + bulb + ' ' + result['status'] + ': ' + result.get('error', ''))
+    skew = parallel.skew(report)
+    if skew != None:
+        print('Skew: {0:.0f} ms'.format(skew * 1000))
+        logger.info('Scene skew: {0:.1f} ms'.format(skew * 1000))
+    skipped = parallel.skipped(report)
+    if skipped:
+        print('Skipped: {0} command(s), the bulbs were set already'.format(skipped))
+        logger.info('Scene skipped {0} command(s)'.format(skipped))
+    return failed
+
 def menu_bulbs():
     while True:
 
         # list of all bulbs
+        snapshot = {}
         print('\nBULBS LIST:')
         try:
             logger.info('Trying to print bulb list ...')
-            bulbs.print_list()
+            snapshot = bulbs.status_all()
+            bulbs.print_list(snapshot)
         except BulbExc as e:
             logger.warning(e.message)
             print(e.message)
@@ -88,7 +223,7 @@ MENU > BULBS:
                         else:
                             while True:
                                 print('\nEnter a bulb name from the list (enter \'back\' to cancel):')
-                                print('Bulbs:', ', '.join(bulbs.list()))
+                                print('Bulbs:', ', '.join(bulb_names(snapshot)))
                                 try:
                                     bulb_req = input(': ')
                                     if bulb_req == 'back':
@@ -145,17 +280,69 @@ MENU > BULBS:
 def menu_presets():
     while True:
         print('\nPRESETS LIST:')
-        print('', ', '.join(presets.list()))
+        presets.print_list()
 
         print('''
 MENU > PRESETS:
-1. Back''')
+1. Add preset
+2. Remove preset
+3. Back''')
         try:
             opt = int(input(': '))
         except:
             ("\nInvalid input!")
         else:
-            if opt == 1:
+            if opt == 1: # add preset
+                logger.info('Trying to add a new preset ...')
+                try:
+                    name = input('\nEnter a new preset name: ')
+                    mode = input('Enter a mode (OFF, CT, RGB, HSV, FLOW): ').upper()
+                    if mode == 'OFF':
+                        preset = parse_preset(mode)
+                    elif mode == 'FLOW':
+                        print('Transitions: duration ms, then ct <temperature> <brightness>, rgb <r,g,b> <brightness> or sleep')
+                        print('e.g. 1000 ct 2700 100; 1000 rgb 255,0,0 50; 500 sleep')
+                        value = input('Enter transitions: ')
+                        count = input('Enter how many times to repeat the flow (0 - forever): ') or '0'
+                        action = input('Enter what to do after the flow (recover, stay, off): ') or 'recover'
+                        preset = parse_preset(mode, value, count=count, action=action)
+                    else:
+                        examples = {'CT': '1700-6500', 'RGB': 'r,g,b', 'HSV': 'hue,saturation'}
+                        value = input('Enter a value (' + examples.get(mode, '') + '): ')
+                        brightness = input('Enter brightness (1-100): ')
+                        preset = parse_preset(mode, value, brightness)
+                    presets.add(name, preset)
+                except PresetExc as e:
+                    logger.warning(e.message)
+                    print(e.message)
+                except:
+                    logger.error('Something went wrong while adding a preset')
+                    print('Something went wrong!')
+                else:
+                    logger.info('Preset ' + name + ' added successfully')
+
+            elif opt == 2: # remove preset
+                logger.info('Trying to delete a preset ...')
+                try:
+                    print('\nEnter a preset name to remove:')
+                    print('Presets:', ', '.join(presets.list()))
+                    preset_req = input(': ')
+                    used = scenes.find_by_preset(preset_req)
+                    if used:
+                        print('Preset is used by scenes:', ', '.join(used))
+                        if input('Remove anyway? (y/n): ') != 'y':
+                            continue
+                    presets.remove(preset_req)
+                except PresetExc as e:
+                    logger.warning(e.message)
+                    print(e.message)
+                except:
+                    logger.error('Something went wrong while removing a preset')
+                    print('Something went wrong!')
+                else:
+                    logger.info('Preset ' + preset_req + ' removed successfully')
+
+            elif opt == 3:
                 break
 
 def menu_scenes():
@@ -190,7 +377,8 @@ MENU > SCENES:
                         print('\nEnter a scene name to set:')
                         print('Scenes:', ', '.join(scenes.list()))
                         scene_req = input(': ')
-                        scenes.set(scene_req, bulbs, presets)
+                        report = scenes.set(scene_req, bulbs, presets, synchronized=config_scene_synchronized,
+                                            diff=config_scene_diff)
                     except SceneExc as e:
                         logger.warning(e.message)
                         print(e.message)
@@ -198,7 +386,9 @@ MENU > SCENES:
                         logger.error('Something went wrong while setting a scene')
                         print('Something went wrong!')
                     else:
-                        logger.info('Scene ' + scene_req + ' set successfully')
+                        print()
+                        print_report(report)
+                        logger.info('Scene ' + scene_req + ' set')
 
             elif opt == 2: # add scene
                 logger.info('Trying to add a new scene ...')
@@ -239,8 +429,11 @@ MENU > SCENES:
 
             elif opt == 4: # export scenes to JSON
                 logger.info('Trying to export scenes ...')
+                filename = input('\nEnter file name to export scenes to (press Enter for scenes-export.json): ')
+                if filename == '':
+                    filename = 'scenes-export.json'
                 try:
-                    scenes.export()
+                    scenes.export(filename)
                 except SceneExc as e:
                     print()
                     logger.warning(e.message)
@@ -255,8 +448,12 @@ MENU > SCENES:
             elif opt == 5: # import scenes from JSON
                 logger.info('Trying to import scenes from a file ...')
                 filename = input('\nEnter file name to import scenes from: ')
+                print('Saved scenes with the same name:', ', '.join(scenes.policies))
+                policy = input('Enter what to do with them (press Enter to skip): ')
+                if policy == '':
+                    policy = 'skip'
                 try:
-                    scenes.load(filename)
+                    added = scenes.load(filename, policy)
                 except FileNotFoundError:
                     logger.warning('No such file: ' + filename)
                     print('File with this name does not exist!')
@@ -266,92 +463,466 @@ MENU > SCENES:
                 except:
                     logger.error('Something went wrong while importing scenes')
                     print('Something went wrong!')
+                else:
+                    logger.info(str(added) + ' scenes imported successfully')
+                    print(added, 'scene(s) imported.')
 
             elif opt == 6:
                 break
 
-def menu_ambilight():
+def run_ambilight():
     import yeelight
-    import time
-    from PIL import ImageGrab, ImageStat
+    from packages.yeecontrol.ambilight import Ambilight, ColorFilter
+
+    regions = zones.map()
+    if len(regions) == 0: # no zone map, the whole screen drives the desk bulb
+        regions = {'desk': Zone.regions.get('full')}
+
+    # music mode holds its own connection for the whole session, so the bulbs are not taken
+    # from the pool, their outcomes still go to the health monitor and the metrics
+    lights = {}
+    ips = {}
+    for name in regions.keys():
+        ips[name] = bulbs.find_by_name(name)
+        if ips[name] == None:
+            logger.warning(bulbs.missing(name))
+            print(bulbs.missing(name))
+        elif not bulbs.health.allow(ips[name]):
+            logger.warning('Bulb ' + name + ' is offline')
+            print('Bulb', name, 'is offline.')
+        else:
+            lights[name] = yeelight.Bulb(ips[name], effect='sudden')
 
-    bulb = yeelight.Bulb(bulbs.find_by_name('desk'))
-    
-    bulb.turn_on
-    bulb.effect = 'sudden'
-    bulb.start_music()
+    def start(name):
+        t0 = monotonic()
+        try:
+            lights[name].turn_on()
+            lights[name].start_music()
+        except Exception as e:
+            bulbs.record(ips[name], 'start_music', t0, e)
+            raise
+        bulbs.record(ips[name], 'start_music', t0)
+
+    report = parallel.run_all({name: lambda name=name: start(name) for name in lights.keys()}, deadline=10)
+    for name, result in report.items():
+        if result['status'] != parallel.OK:
+            logger.warning('Bulb ' + name + ' unavailable for ambient lighting: ' + result.get('error', ''))
+            print('Bulb', name, 'is unavailable.')
+            del lights[name]
+    if len(lights) == 0:
+        print('No bulbs available for ambient lighting!')
+        return
+
+    def send(name, color):
+        r, g, b, br = color
+        sent = monotonic()
+        try:
+            lights[name].set_scene(yeelight.SceneClass.COLOR, r, g, b, max(1, br // 2))
+        except Exception as e:
+            bulbs.record(ips[name], 'set_scene', sent, e)
+            raise
+        bulbs.record(ips[name], 'set_scene', sent)
+        if journal != None: # music mode sends no response
+            journal.record(ips[name], 'set_scene', ['color', r * 65536 + g * 256 + b, max(1, br // 2)], sent)
+
+    color_filter = ColorFilter(config_ambilight_delta_e, config_ambilight_delta_br, config_ambilight_smoothing)
+    engine = Ambilight(send, {name: regions.get(name) for name in lights.keys()}, fps=config_ambilight_fps,
+                       color_filter=color_filter, metrics=bulbs.metrics)
 
     try:
         logger.info('Ambient lighting started')
+        engine.start()
         while True:
+            sleep(1)
+            stats = engine.stats()
+            print("Set colors:", stats['colors'])
+            print("capture: {0:.1f} ms, color: {1:.1f} ms, send: {2:.1f} ms, dropped: {3}, commands saved: {4}"
+                  .format(stats.get('capture_ms', 0), stats.get('color_ms', 0), stats.get('send_ms', 0), stats['dropped'], stats['saved']),
+                  "| Press CTRL+C to stop ambient lighing")
+            if stats.get('send_errors'):
+                logger.info('An error while running ambi light')
 
-            t1 = time.time_ns()
-
-            img = ImageStat.Stat(ImageGrab.grab())
-            avg = img.rms
+    except KeyboardInterrupt:
+        engine.stop()
+        logger.info('Ambient lighting ended, commands saved: ' + str(engine.stats()['saved']))
+        print('Ambient lighting ended.')
 
-            r = round(avg[0])
-            g = round(avg[1])
-            b = round(avg[2])
+        for name, bulb in lights.items():
+            bulb.stop_music()
+            bulbs.set(name, presets.get('warm'))
 
-            br = (avg[0] + avg[1] + avg[2]) / 3
-            br = round(br * 100 / 255)
+def menu_ambilight():
+    while True:
+        print('\nZONE LIST:')
+        try:
+            zones.print_list()
+        except ZoneExc as e:
+            print(e.message, 'The whole screen drives the desk bulb.')
 
-            print("Set color:", r, g, b, br, "| Press CTRL+C to stop ambient lighing")
-            print(bulb.effect)
+        print('''
+MENU > AMBIENT LIGHT:
+1. Start ambient lighting
+2. Set bulb zone
+3. Remove bulb zone
+4. Back''')
+        try:
+            opt = int(input(': '))
+        except:
+            print('\nInvalid input!')
+        else:
 
-            try:
-                bulb.set_scene(yeelight.SceneClass.COLOR, r, g, b, br / 2)
-            except:
-                logger.info('An error while running ambi light')
-                print('An error occurred')
+            if opt == 1:
+                run_ambilight()
 
-            t2 = time.time_ns()
+            elif opt == 2: # assign a screen region to a bulb
+                logger.info('Trying to set a bulb zone ...')
+                try:
+                    print('\nEnter a bulb name:')
+                    print('Bulbs:', ', '.join(bulbs.list()))
+                    bulb_req = input(': ')
+                    if bulb_req not in bulbs.list():
+                        raise ZoneExc('No bulb with such name: ' + bulb_req)
+                    print('\nEnter a region name:')
+                    print('Regions:', ', '.join(Zone.regions.keys()))
+                    region_req = input(': ')
+                    zones.add(bulb_req, region_req)
+                except ZoneExc as e:
+                    logger.warning(e.message)
+                    print(e.message)
+                except:
+                    logger.error('Something went wrong while setting a bulb zone')
+                    print('Something went wrong!')
+                else:
+                    logger.info('Bulb ' + bulb_req + ' zone set to ' + region_req)
 
-            print("Frame processing time:", (t2 - t1) / 1000000, "ms")
+            elif opt == 3: # remove a bulb zone
+                logger.info('Trying to remove a bulb zone ...')
+                try:
+                    print('\nEnter a bulb name:')
+                    print('Bulbs:', ', '.join(zones.list()))
+                    bulb_req = input(': ')
+                    zones.remove(bulb_req)
+                except ZoneExc as e:
+                    logger.warning(e.message)
+                    print(e.message)
+                except:
+                    logger.error('Something went wrong while removing a bulb zone')
+                    print('Something went wrong!')
+                else:
+                    logger.info('Bulb ' + bulb_req + ' zone removed')
 
-            sleep(0.4)
+            elif opt == 4:
+                break
 
-    except KeyboardInterrupt:
-        logger.info('Ambient lighting ended')
-        print('Ambient lighting ended.')
 
-        bulbs.set('desk', presets.get('warm'))
+def check_job(job):
+    """Raises an exception if a job refers to a scene, bulb or preset which is not saved."""
 
+    if 'scene' in job:
+        scenes.settings(job['scene'])
+    else:
+        if job['bulb'] not in bulbs.list():
+            raise BulbExc('No bulb with such name: ' + job['bulb'])
+        presets.get(job['preset'])
 
-# main menu
-try:
+def menu_schedule():
     while True:
+        print('\nSCHEDULE:')
+        try:
+            schedule.print_list()
+        except ScheduleExc as e:
+            print(e.message)
+
         print('''
-MENU:
-1. Bulbs
-2. Presets
-3. Scenes
-4. Ambient Light
-5. Exit''')
+MENU > SCHEDULE:
+1. Add job
+2. Remove job
+3. Back''')
         try:
             opt = int(input(': '))
         except:
-            ("\nInvalid input!")
+            print('\nInvalid input!')
         else:
 
-            if opt == 1:
-                menu_bulbs()
+            if opt == 1: # add job
+                logger.info('Trying to add a new job ...')
+                try:
+                    name = input('\nEnter a new job name: ')
+                    print('Rule: cron expression (minute hour day month weekday), e.g. 30 6 * * 1-5,')
+                    print('or sunrise/sunset with an offset in minutes, e.g. sunset-30')
+                    rule = input('Enter a rule: ')
+                    print('Scenes:', ', '.join(scenes.list()))
+                    scene_req = input('Enter a scene name (press Enter to set a single bulb): ')
+                    if scene_req != '':
+                        job = {'scene': scene_req}
+                    else:
+                        print('Bulbs:', ', '.join(bulbs.list()))
+                        job = {'bulb': input('Enter a bulb name: ')}
+                        print('Presets:', ', '.join(presets.list()))
+                        job['preset'] = input('Enter a preset name: ')
+                    job['fade'] = int(float(input('Enter fade duration in minutes (press Enter for none): ') or 0) * 60)
+                    check_job(job)
+                    schedule.add(name, rule, job)
+                except (BulbExc, PresetExc, SceneExc, ScheduleExc) as e:
+                    logger.warning(e.message)
+                    print(e.message)
+                except ValueError:
+                    print('Invalid fade duration!')
+                except:
+                    logger.error('Something went wrong while adding a job')
+                    print('Something went wrong!')
+                else:
+                    logger.info('Job ' + name + ' added successfully')
+                    if scheduler != None:
+                        scheduler.reload()
 
-            elif opt == 2:
-                menu_presets()
+            elif opt == 2: # remove job
+                logger.info('Trying to delete a job ...')
+                try:
+                    print('\nEnter a job name to remove:')
+                    print('Jobs:', ', '.join(schedule.list()))
+                    job_req = input(': ')
+                    schedule.remove(job_req)
+                except ScheduleExc as e:
+                    logger.warning(e.message)
+                    print(e.message)
+                except:
+                    logger.error('Something went wrong while removing a job')
+                    print('Something went wrong!')
+                else:
+                    logger.info('Job ' + job_req + ' removed successfully')
+                    if scheduler != None:
+                        scheduler.reload()
 
             elif opt == 3:
-                menu_scenes()
+                break
 
-            elif opt == 4:
-                menu_ambilight()
+def run_menu(db_path, journal_path=None):
+    print('\nStarting Yeelight Control . . .')
+    setup(db_path, True, journal_path)
 
-            elif opt == 5:
-                raise KeyboardInterrupt
-except KeyboardInterrupt:
-    print("\nClosing the application . . . \n")
-    conn.close()
-    logger.info('Closing the application')
+    # main menu
+    try:
+        while True:
+            print('''
+MENU:
+1. Bulbs
+2. Presets
+3. Scenes
+4. Ambient Light
+5. Schedule
+6. Exit''')
+            try:
+                opt = int(input(': '))
+            except:
+                ("\nInvalid input!")
+            else:
+
+                if opt == 1:
+                    menu_bulbs()
 
-sleep(2)
+                elif opt == 2:
+                    menu_presets()
+
+                elif opt == 3:
+                    menu_scenes()
+
+                elif opt == 4:
+                    menu_ambilight()
+
+                elif opt == 5:
+                    menu_schedule()
+
+                elif opt == 6:
+                    raise KeyboardInterrupt
+    except KeyboardInterrupt:
+        print("\nClosing the application . . . \n")
+        teardown()
+        logger.info('Closing the application')
+
+    if config_exit_delay > 0:
+        sleep(config_exit_delay)
+
+# commands
+
+def cmd_scene_list(args):
+    for name in scenes.list():
+        print(name)
+
+def cmd_scene_set(args):
+    report = scenes.set(args.name, bulbs, presets, args.deadline, args.sync, args.diff)
+    logger.info('Scene ' + args.name + ' set')
+    if args.json:
+        print(json.dumps(report, indent=4))
+        return 1 if any(result['status'] != 'ok' for result in report.values()) else 0
+    return 1 if print_report(report) else 0
+
+def cmd_scene_import(args):
+    added = scenes.load(args.file, args.policy)
+    logger.info(str(added) + ' scenes imported successfully')
+    print(added, 'scene(s) imported.')
+
+def cmd_scene_export(args):
+    scenes.export(args.file)
+    logger.info('Scenes exported successfully')
+
+def cmd_bulb_list(args):
+    for name in bulbs.list():
+        print('{0:<15}{1}'.format(bulbs.find_by_name(name) or '-', name))
+
+def cmd_bulb_status(args):
+    snapshot = bulbs.status_all(args.deadline)
+    if args.json:
+        print(json.dumps(snapshot, indent=4))
+    else:
+        bulbs.print_list(snapshot)
+    return 0 if all(state['reachable'] for state in snapshot.values()) else 1
+
+def cmd_bulb_set(args):
+    bulbs.set(args.name, presets.get(args.preset))
+    logger.info('Bulb ' + args.name + ' set to preset ' + args.preset)
+
+def cmd_preset_list(args):
+    presets.print_list()
+
+def cmd_preset_add(args):
+    if args.off:
+        preset = parse_preset('OFF')
+    elif args.flow != None:
+        preset = parse_preset('FLOW', args.flow, count=str(args.count), action=args.action)
+    else:
+        mode, value = [(mode, value) for mode, value in (('CT', args.ct), ('RGB', args.rgb), ('HSV', args.hsv)) if value != None][0]
+        preset = parse_preset(mode, value, str(args.bright))
+    presets.add(args.name, preset)
+    logger.info('Preset ' + args.name + ' added successfully')
+
+def cmd_preset_remove(args):
+    presets.remove(args.name)
+    logger.info('Preset ' + args.name + ' removed successfully')
+
+def cmd_schedule_list(args):
+    schedule.print_list()
+
+def cmd_schedule_add(args):
+    job = {'scene': args.scene} if args.scene != None else {'bulb': args.bulb, 'preset': args.preset}
+    job['fade'] = int(args.fade * 60)
+    check_job(job)
+    schedule.add(args.name, args.rule, job)
+    logger.info('Job ' + args.name + ' added successfully')
+
+def cmd_schedule_remove(args):
+    schedule.remove(args.name)
+    logger.info('Job ' + args.name + ' removed successfully')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Control Yeelight bulbs via LAN. Starts the interactive menu without a command.')
+    parser.add_argument('--db', default=config_db_path, help='database path')
+    parser.add_argument('--journal', default=config_journal_path, metavar='FILE', help='append every bulb command and response to FILE')
+    parser.add_argument('--stats', action='store_true', help='print command latency and outcome metrics as JSON to stderr on exit')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    scene = commands.add_parser('scene', help='list, set, import or export scenes')
+    scene_commands = scene.add_subparsers(dest='action', metavar='action', required=True)
+    scene_commands.add_parser('list', help='list scene names').set_defaults(func=cmd_scene_list)
+    scene_set = scene_commands.add_parser('set', help='set a scene')
+    scene_set.add_argument('name')
+    scene_set.add_argument('--deadline', type=float, default=5.0, help='seconds to wait for the bulbs')
+    scene_set.add_argument('--json', action='store_true', help='print the report as JSON')
+    scene_set.add_argument('--sync', action='store_true', help='switch all bulbs at the same instant')
+    scene_set.add_argument('--diff', action='store_true', help='send only to bulbs which are not in their preset already')
+    scene_set.set_defaults(func=cmd_scene_set)
+    scene_import = scene_commands.add_parser('import', help='import scenes from a JSON file')
+    scene_import.add_argument('file')
+    scene_import.add_argument('--policy', choices=Scene.policies, default='skip', help='what to do with scenes which are already saved')
+    scene_import.set_defaults(func=cmd_scene_import)
+    scene_export = scene_commands.add_parser('export', help='export scenes to a JSON file')
+    scene_export.add_argument('file', nargs='?', default='scenes-export.json')
+    scene_export.set_defaults(func=cmd_scene_export)
+
+    bulb = commands.add_parser('bulb', help='list, query or set bulbs')
+    bulb_commands = bulb.add_subparsers(dest='action', metavar='action', required=True)
+    bulb_commands.add_parser('list', help='list saved bulbs').set_defaults(func=cmd_bulb_list)
+    bulb_status = bulb_commands.add_parser('status', help='print the status of all bulbs')
+    bulb_status.add_argument('--deadline', type=float, default=3.0, help='seconds to wait for the bulbs')
+    bulb_status.add_argument('--json', action='store_true', help='print the status as JSON')
+    bulb_status.set_defaults(func=cmd_bulb_status)
+    bulb_set = bulb_commands.add_parser('set', help='set a bulb to a preset')
+    bulb_set.add_argument('name')
+    bulb_set.add_argument('preset')
+    bulb_set.set_defaults(func=cmd_bulb_set)
+
+    preset = commands.add_parser('preset', help='list, add or remove presets')
+    preset_commands = preset.add_subparsers(dest='action', metavar='action', required=True)
+    preset_commands.add_parser('list', help='list presets').set_defaults(func=cmd_preset_list)
+    preset_add = preset_commands.add_parser('add', help='save a new preset')
+    preset_add.add_argument('name')
+    preset_mode = preset_add.add_mutually_exclusive_group(required=True)
+    preset_mode.add_argument('--off', action='store_true', help='turn the bulb off')
+    preset_mode.add_argument('--ct', help='color temperature 1700-6500')
+    preset_mode.add_argument('--rgb', help='color as r,g,b')
+    preset_mode.add_argument('--hsv', help='color as hue,saturation')
+    preset_mode.add_argument('--flow', help="transitions, e.g. '1000 ct 2700 100; 1000 rgb 255,0,0 50; 500 sleep'")
+    preset_add.add_argument('--bright', type=int, default=100, help='brightness 1-100')
+    preset_add.add_argument('--count', type=int, default=0, help='flow repetitions, 0 - forever')
+    preset_add.add_argument('--action', choices=['recover', 'stay', 'off'], default='recover', help='what to do after a finite flow')
+    preset_add.set_defaults(func=cmd_preset_add)
+    preset_remove = preset_commands.add_parser('remove', help='remove a preset')
+    preset_remove.add_argument('name')
+    preset_remove.set_defaults(func=cmd_preset_remove)
+
+    jobs = commands.add_parser('schedule', help='list, add or remove scheduled jobs')
+    job_commands = jobs.add_subparsers(dest='action', metavar='action', required=True)
+    job_commands.add_parser('list', help='list jobs with their next run').set_defaults(func=cmd_schedule_list)
+    job_add = job_commands.add_parser('add', help='schedule a scene or a bulb preset')
+    job_add.add_argument('name')
+    job_add.add_argument('rule', help="cron expression, e.g. '30 6 * * 1-5', or a sun rule, e.g. sunset-30")
+    job_target = job_add.add_mutually_exclusive_group(required=True)
+    job_target.add_argument('--scene', help='scene to set')
+    job_target.add_argument('--bulb', help='bulb to set, needs --preset')
+    job_add.add_argument('--preset', help='preset to set the bulb to')
+    job_add.add_argument('--fade', type=float, default=0, help='fade in over this many minutes, run by the bulb')
+    job_add.set_defaults(func=cmd_schedule_add)
+    job_remove = job_commands.add_parser('remove', help='remove a job')
+    job_remove.add_argument('name')
+    job_remove.set_defaults(func=cmd_schedule_remove)
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # logger
+    FORMAT = '%(name)s:%(levelname)s:%(asctime)s:%(message)s'
+    logging.basicConfig(level=logging.INFO, filename=config_log_path, filemode='a', format=FORMAT)
+
+    if args.command == None:
+        logger.info('Starting the application')
+        run_menu(args.db, args.journal)
+        if args.stats:
+            dump_stats()
+        return
+
+    logger.info('Running command: ' + args.command + ' ' + args.action)
+    setup(args.db, False, args.journal)
+    try:
+        code = args.func(args)
+    except (BulbExc, PresetExc, SceneExc, ScheduleExc, ZoneExc) as e:
+        logger.warning(e.message)
+        print(e.message, file=sys.stderr)
+        code = 1
+    except FileNotFoundError as e:
+        logger.warning('No such file: ' + str(e.filename))
+        print('File with this name does not exist!', file=sys.stderr)
+        code = 1
+    except Exception as e:
+        logger.exception('Command failed')
+        print('Something went wrong:', e, file=sys.stderr)
+        code = 1
+    finally:
+        teardown()
+        if args.stats:
+            dump_stats()
+    sys.exit(code or 0)
+
+if __name__ == '__main__':
+    main()